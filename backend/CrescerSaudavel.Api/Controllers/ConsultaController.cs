@@ -17,15 +17,18 @@ public class ConsultaController : ControllerBase
     private readonly CrescerSaudavelDbContext _context;
     private readonly ZScoreService _zScoreService;
     private readonly ICurrentUserService _currentUserService;
+    private readonly MLService _mlService;
 
     public ConsultaController(
         CrescerSaudavelDbContext context,
         ZScoreService zScoreService,
-        ICurrentUserService currentUserService)
+        ICurrentUserService currentUserService,
+        MLService mlService)
     {
         _context = context;
         _zScoreService = zScoreService;
         _currentUserService = currentUserService;
+        _mlService = mlService;
     }
 
     [HttpGet("crianca/{recemNascidoId}")]
@@ -217,6 +220,7 @@ public class ConsultaController : ControllerBase
 
         _context.Consultas.Add(consulta);
         await _context.SaveChangesAsync();
+        await _mlService.InvalidarContextoCriancaAsync(consulta.RecemNascidoId);
 
         return CreatedAtAction(nameof(GetById), new { id = consulta.Id }, consulta);
     }
@@ -343,6 +347,7 @@ public class ConsultaController : ControllerBase
         }
 
         await _context.SaveChangesAsync();
+        await _mlService.InvalidarContextoCriancaAsync(consulta.RecemNascidoId);
         return NoContent();
     }
 
@@ -366,6 +371,7 @@ public class ConsultaController : ControllerBase
 
         _context.Consultas.Remove(consulta);
         await _context.SaveChangesAsync();
+        await _mlService.InvalidarContextoCriancaAsync(consulta.RecemNascidoId);
 
         return NoContent();
     }
@@ -3,6 +3,7 @@ using Microsoft.AspNetCore.Mvc;
 using Microsoft.EntityFrameworkCore;
 using CrescerSaudavel.Api.Data;
 using CrescerSaudavel.Api.Models;
+using CrescerSaudavel.Api.Services;
 using CrescerSaudavel.Api.Services.Time;
 using System.Linq;
 
@@ -15,13 +16,16 @@ public class DietaController : ControllerBase
 {
     private readonly CrescerSaudavelDbContext _context;
     private readonly ICurrentUserService _currentUserService;
+    private readonly MLService _mlService;
 
     public DietaController(
         CrescerSaudavelDbContext context,
-        ICurrentUserService currentUserService)
+        ICurrentUserService currentUserService,
+        MLService mlService)
     {
         _context = context;
         _currentUserService = currentUserService;
+        _mlService = mlService;
     }
 
     [HttpGet("crianca/{recemNascidoId}")]
@@ -111,6 +115,7 @@ public class DietaController : ControllerBase
 
         _context.Dietas.Add(dieta);
         await _context.SaveChangesAsync();
+        await _mlService.InvalidarContextoCriancaAsync(dieta.RecemNascidoId);
 
         return CreatedAtAction(nameof(GetById), new { id = dieta.Id }, dieta);
     }
@@ -159,6 +164,7 @@ public class DietaController : ControllerBase
         }).ToList();
 
         await _context.SaveChangesAsync();
+        await _mlService.InvalidarContextoCriancaAsync(dieta.RecemNascidoId);
         return NoContent();
     }
 
@@ -182,6 +188,7 @@ public class DietaController : ControllerBase
 
         _context.Dietas.Remove(dieta);
         await _context.SaveChangesAsync();
+        await _mlService.InvalidarContextoCriancaAsync(dieta.RecemNascidoId);
 
         return NoContent();
     }
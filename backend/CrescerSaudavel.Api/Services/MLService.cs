@@ -219,6 +219,40 @@ public class MLService
         }
     }
 
+    /// <summary>
+    /// Invalida o contexto em cache de uma criança no serviço de ML, que também
+    /// atualiza os casos dela no índice de similaridade em segundo plano
+    /// (chamado após salvar consultas ou dietas; falhas não interrompem a operação
+    /// e a espera é limitada a MLService:InvalidationTimeoutSeconds)
+    /// </summary>
+    public async Task InvalidarContextoCriancaAsync(
+        Guid criancaId,
+        CancellationToken cancellationToken = default)
+    {
+        var timeout = _config.GetValue<int>("MLService:InvalidationTimeoutSeconds", 2);
+        using var cts = CancellationTokenSource.CreateLinkedTokenSource(cancellationToken);
+        cts.CancelAfter(TimeSpan.FromSeconds(timeout));
+
+        try
+        {
+            using var response = await _httpClient.PostAsync(
+                $"/api/v1/analytics/crianca/{criancaId}/invalidate",
+                null,
+                cts.Token);
+
+            if (!response.IsSuccessStatusCode)
+            {
+                _logger.LogWarning(
+                    "Serviço de ML retornou {StatusCode} ao invalidar contexto da criança {CriancaId}",
+                    (int)response.StatusCode, criancaId);
+            }
+        }
+        catch (Exception ex) when (ex is HttpRequestException or OperationCanceledException)
+        {
+            _logger.LogWarning(ex, "Não foi possível invalidar contexto da criança {CriancaId} no serviço de ML", criancaId);
+        }
+    }
+
     /// <summary>
     /// Solicita re-treinamento dos modelos
     /// </summary>
@@ -17,9 +17,55 @@ class Settings(BaseSettings):
     
     # ML Models
     MODEL_PATH: str = "./models"
+    DATA_PATH: str = "./data"
     MODEL_RETRAIN_THRESHOLD_DAYS: int = 30
     MIN_SAMPLES_FOR_TRAINING: int = 50
     
+    # Treino incremental do GrowthPredictor
+    INCREMENTAL_N_ESTIMATORS: int = 20
+    INCREMENTAL_MAX_ESTIMATORS: int = 500
+    INCREMENTAL_MIN_SAMPLES: int = 10
+    INCREMENTAL_DRIFT_TOLERANCE: float = 0.2
+    
+    # Motor de busca de casos similares: brute, kd_tree, ball_tree ou hnsw (requer hnswlib)
+    SIMILARITY_ENGINE: str = "kd_tree"
+    SIMILARITY_HNSW_M: int = 16
+    SIMILARITY_HNSW_EF_CONSTRUCTION: int = 200
+    SIMILARITY_HNSW_EF_SEARCH: int = 64
+    # Casos no buffer incremental + removidos que disparam compactação
+    SIMILARITY_DELTA_MAX_ROWS: int = 5000
+    
+    # Agregados de padrões de dieta
+    DIET_PATTERNS_REFRESH_MINUTES: int = 15
+    DIET_PATTERNS_FULL_REFRESH_HOURS: int = 24
+    
+    # Intervalo mínimo entre verificações de versão do catálogo de alimentos
+    FOOD_CATALOG_PROBE_SECONDS: int = 60
+    # Linhas (criança × alimento) por bloco na recomendação em lote
+    FOOD_RECOMMENDATION_CHUNK_ROWS: int = 100_000
+    # Lotes até este tamanho usam a floresta achatada (ver app.models.forest_engine)
+    FLAT_FOREST_MAX_ROWS: int = 1000
+    # Linhas por bloco na extração do snapshot de treinamento do recomendador
+    FOOD_USAGE_SNAPSHOT_CHUNK_ROWS: int = 50_000
+    # Processos na validação cruzada do recomendador (-1 = todos os núcleos)
+    FOOD_RECOMMENDER_CV_N_JOBS: int = -1
+    
+    # Tabela de episódios de dieta (efetividade de alimentos)
+    DIET_EPISODES_REFRESH_MINUTES: int = 60
+    
+    # Cache de predições
+    PREDICTION_CACHE_SIZE: int = 256
+    # Contexto por criança (perfil, timeline e features); invalidado pelo backend
+    # ao salvar consultas/dietas, o TTL só cobre alterações feitas fora dele
+    CHILD_CONTEXT_CACHE_SIZE: int = 512
+    CHILD_CONTEXT_CACHE_TTL_SECONDS: int = 900
+    
+    # Simulação de trajetórias (passos usados para estimar dias até o objetivo)
+    TRAJECTORY_MAX_PASSOS: int = 26
+    
+    # Job noturno de score de risco
+    RISK_SCORING_CHUNK_SIZE: int = 500
+    
     # API
     API_TITLE: str = "Crescer Saudável ML Service"
     API_VERSION: str = "1.0.0"
@@ -3,7 +3,7 @@ from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.ext.declarative import declarative_base
 import pandas as pd
-from typing import Optional
+from typing import Iterator, Optional
 import logging
 
 from app.config import settings
@@ -64,6 +64,30 @@ def execute_query(query: str, params: Optional[dict] = None) -> pd.DataFrame:
         raise
 
 
+def iter_query(query: str, params: Optional[dict] = None, chunksize: int = 1000) -> Iterator[pd.DataFrame]:
+    """
+    Executa query SQL e retorna os resultados em blocos de DataFrame
+    
+    Evita materializar resultados grandes de uma vez (jobs em lote).
+    
+    Args:
+        query: Query SQL
+        params: Parâmetros para query parametrizada
+        chunksize: Número de linhas por bloco
+        
+    Yields:
+        DataFrames com até chunksize linhas
+    """
+    try:
+        with engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True)
+            for chunk in pd.read_sql(text(query), conn, params=params, chunksize=chunksize):
+                yield chunk
+    except Exception as e:
+        logger.error(f"Erro ao executar query em blocos: {e}")
+        raise
+
+
 def test_connection() -> bool:
     """Testa conexão com o banco de dados"""
     try:
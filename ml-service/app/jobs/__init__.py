@@ -0,0 +1 @@
+"""Jobs em lote (execução agendada)"""
@@ -0,0 +1,24 @@
+"""
+Reconstrução do índice de casos similares (DietAnalyzer)
+
+Extrai a timeline completa, calcula as features, ajusta scaler e KNN e salva
+o índice com a tabela compacta de casos em MODEL_PATH/diet_analyzer.joblib,
+de onde o serviço o carrega na inicialização.
+
+Agendamento sugerido (cron):
+    30 2 * * * cd /app && python -m app.jobs.diet_index
+"""
+import json
+import logging
+
+from app.models.diet_analyzer import DietAnalyzer
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    print(json.dumps(DietAnalyzer().build_index(), indent=2, default=str))
@@ -0,0 +1,86 @@
+"""
+Atualização diária do GrowthPredictor
+
+No modo incremental, continua o boosting do modelo salvo usando apenas as
+amostras cujo desfecho é posterior ao último treino (data_watermark). Se o
+erro de validação derivar além da tolerância, ou se não houver watermark,
+faz um re-treino completo com todo o histórico.
+
+Agendamento sugerido (cron):
+    0 3 * * * cd /app && python -m app.jobs.model_refresh
+"""
+import json
+import logging
+import time
+from typing import Dict
+
+from app.models.growth_predictor import get_growth_predictor
+from app.services.etl_service import ETLService
+
+logger = logging.getLogger(__name__)
+
+# Mínimo de amostras para um re-treino completo
+MIN_FULL_SAMPLES = 10
+
+
+def refresh_growth_model(horizonte_dias: int = 14, modo: str = 'incremental') -> Dict:
+    """
+    Atualiza o modelo de crescimento
+
+    Args:
+        horizonte_dias: Horizonte de predição para treinamento
+        modo: 'incremental' (com fallback para completo) ou 'full'
+
+    Returns:
+        Dicionário com 'modo' efetivamente executado, métricas e tempo
+    """
+    if modo not in ('incremental', 'full'):
+        raise ValueError(f"Modo de atualização inválido: {modo}")
+
+    inicio = time.perf_counter()
+    predictor = get_growth_predictor()
+    resultado = {'modo_solicitado': modo}
+
+    if modo == 'incremental':
+        if predictor.model is None or predictor.data_watermark is None:
+            logger.info("Modelo sem watermark de dados; executando re-treino completo")
+            resultado['fallback'] = 'no_watermark'
+        else:
+            df_new = ETLService.prepare_training_data(
+                horizonte_dias=horizonte_dias, desde=predictor.data_watermark
+            )
+            incremental = predictor.train_incremental(df_new)
+            resultado['incremental'] = incremental
+
+            if incremental['status'] != 'drift':
+                resultado.update(
+                    modo='incremental',
+                    n_samples=len(df_new),
+                    tempo_s=round(time.perf_counter() - inicio, 2)
+                )
+                return resultado
+
+            resultado['fallback'] = incremental.get('reason', 'drift')
+
+    df_train = ETLService.prepare_training_data(horizonte_dias=horizonte_dias)
+    if df_train.empty or len(df_train) < MIN_FULL_SAMPLES:
+        raise ValueError(
+            f"Dados insuficientes para treinamento. Mínimo: {MIN_FULL_SAMPLES} amostras, encontrado: {len(df_train)}"
+        )
+
+    metrics = predictor.train(df_train)
+    resultado.update(
+        modo='full',
+        metrics=metrics,
+        n_samples=len(df_train),
+        tempo_s=round(time.perf_counter() - inicio, 2)
+    )
+    return resultado
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    print(json.dumps(refresh_growth_model(), indent=2, default=str))
@@ -0,0 +1,179 @@
+"""
+Job noturno de score de risco da coorte ativa
+
+Para cada criança com dieta vigente, prediz o Δ z-score sob a dieta atual e
+grava a lista ranqueada (pior Δ primeiro) em DATA_PATH/risk_scores.csv.
+
+Agendamento sugerido (cron):
+    0 2 * * * cd /app && python -m app.jobs.risk_scoring
+"""
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from app.config import settings
+from app.models.growth_predictor import get_growth_predictor
+from app.services.etl_service import ETLService
+
+logger = logging.getLogger(__name__)
+
+RISK_SCORES_FILE = "risk_scores.csv"
+RISK_SCORES_META_FILE = "risk_scores.json"
+
+# Colunas da dieta vigente que substituem as da última consulta
+DIETA_COLUMNS = ['TaxaEnergeticaKcalKg', 'MetaProteinaGKg', 'FrequenciaHoras']
+
+_run_lock = Lock()
+_cache = {'mtime': None, 'df': None, 'meta': None}
+
+
+def _score_chunk(cohort: pd.DataFrame, predictor) -> pd.DataFrame:
+    """
+    Calcula score de um bloco da coorte
+
+    Args:
+        cohort: Bloco com CriancaId e dieta vigente
+        predictor: GrowthPredictor
+
+    Returns:
+        DataFrame com uma linha por criança pontuada
+    """
+    crianca_ids = cohort['CriancaId'].astype(str).tolist()
+    df_timeline = ETLService.get_timeline_for_criancas(crianca_ids)
+
+    if df_timeline.empty:
+        return pd.DataFrame()
+
+    # Features de todas as crianças do bloco de uma vez; última medida de cada uma
+    df_features = ETLService.compute_features(df_timeline)
+    ultimas = df_features.groupby('CriancaId').tail(1).copy()
+    ultimas['CriancaId'] = ultimas['CriancaId'].astype(str)
+
+    dieta = cohort.assign(CriancaId=cohort['CriancaId'].astype(str)).set_index('CriancaId')
+    ultimas['Nome'] = ultimas['CriancaId'].map(dieta['Nome'])
+    ultimas['DietaId'] = ultimas['CriancaId'].map(dieta['DietaId'])
+
+    # Sobrepor dieta vigente (mantendo valores da consulta se a dieta não os define)
+    for col in DIETA_COLUMNS:
+        vigente = ultimas['CriancaId'].map(dieta[col])
+        ultimas[col] = vigente.where(vigente.notna(), ultimas[col])
+
+    X = predictor.build_feature_matrix(ultimas)
+    delta = predictor.predict_batch(X)
+
+    zscore_atual = pd.to_numeric(ultimas['ZScorePeso'], errors='coerce').to_numpy(dtype=np.float64)
+
+    return pd.DataFrame({
+        'crianca_id': ultimas['CriancaId'].to_numpy(),
+        'nome': ultimas['Nome'].to_numpy(),
+        'dieta_id': ultimas['DietaId'].astype(str).to_numpy(),
+        'ultima_consulta': ultimas['DataConsulta'].to_numpy(),
+        'taxa_energetica_kcal_kg': ultimas['TaxaEnergeticaKcalKg'].to_numpy(),
+        'meta_proteina_g_kg': ultimas['MetaProteinaGKg'].to_numpy(),
+        'frequencia_horas': ultimas['FrequenciaHoras'].to_numpy(),
+        'zscore_atual': zscore_atual,
+        'delta_zscore_pred': delta,
+        'zscore_final_esperado': zscore_atual + delta,
+        'probabilidade_melhora': predictor.probabilidade_melhora(delta),
+    })
+
+
+def run_risk_scoring(chunk_size: Optional[int] = None, output_dir: Optional[str] = None) -> Dict:
+    """
+    Pontua toda a coorte ativa e grava a lista ranqueada
+
+    Args:
+        chunk_size: Crianças por bloco (padrão: settings.RISK_SCORING_CHUNK_SIZE)
+        output_dir: Diretório de saída (padrão: settings.DATA_PATH)
+
+    Returns:
+        Metadados da execução
+    """
+    if not _run_lock.acquire(blocking=False):
+        raise RuntimeError("Job de score de risco já está em execução")
+
+    try:
+        inicio = time.perf_counter()
+        chunk_size = chunk_size or settings.RISK_SCORING_CHUNK_SIZE
+        output_dir = output_dir or settings.DATA_PATH
+        predictor = get_growth_predictor()
+
+        resultados = []
+        n_blocos = 0
+        for cohort in ETLService.iter_active_cohort(chunk_size=chunk_size):
+            resultados.append(_score_chunk(cohort, predictor))
+            n_blocos += 1
+            logger.info(f"Score de risco: bloco {n_blocos} ({len(cohort)} crianças)")
+
+        df = pd.concat(resultados, ignore_index=True) if resultados else pd.DataFrame()
+
+        if not df.empty:
+            df = df.sort_values('delta_zscore_pred', kind='stable').reset_index(drop=True)
+            df['risco'] = df['delta_zscore_pred'] < 0
+            df.insert(0, 'ranking', np.arange(1, len(df) + 1))
+
+        meta = {
+            'gerado_em': datetime.now().isoformat(),
+            'model_version': predictor.model_version,
+            'n_criancas': int(len(df)),
+            'n_risco': int(df['risco'].sum()) if not df.empty else 0,
+            'n_blocos': n_blocos,
+            'tempo_s': round(time.perf_counter() - inicio, 2),
+        }
+
+        # Escrita atômica: o endpoint nunca lê um arquivo pela metade
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, RISK_SCORES_FILE)
+        df.to_csv(path + '.tmp', index=False)
+        with open(os.path.join(output_dir, RISK_SCORES_META_FILE), 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+        logger.info(f"Score de risco concluído: {meta}")
+        return meta
+    finally:
+        _run_lock.release()
+
+
+def load_risk_scores(output_dir: Optional[str] = None):
+    """
+    Carrega a última lista gerada (em cache até o arquivo mudar)
+
+    Returns:
+        Tupla (DataFrame, metadados) ou (None, None) se o job nunca rodou
+    """
+    output_dir = output_dir or settings.DATA_PATH
+    path = os.path.join(output_dir, RISK_SCORES_FILE)
+
+    if not os.path.exists(path):
+        return None, None
+
+    mtime = os.path.getmtime(path)
+    if _cache['mtime'] != mtime:
+        try:
+            df = pd.read_csv(path)
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame()
+        meta_path = os.path.join(output_dir, RISK_SCORES_META_FILE)
+        meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        _cache.update(mtime=mtime, df=df, meta=meta)
+
+    return _cache['df'], _cache['meta']
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    print(json.dumps(run_risk_scoring(), indent=2))
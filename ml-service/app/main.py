@@ -48,6 +48,19 @@ async def startup_event():
     else:
         logger.info("Conexão com banco de dados estabelecida")
     
+    # Carregar índice de similaridade salvo; reconstruir em segundo plano se
+    # ausente ou mais antigo que a última consulta
+    from app.models.diet_analyzer import get_diet_analyzer
+    get_diet_analyzer().refresh_index_async()
+    
+    # Agregados de padrões de dieta em memória
+    from app.services.diet_patterns import get_diet_pattern_aggregates
+    get_diet_pattern_aggregates().refresh_async()
+    
+    # Episódios de dieta com desfecho (efetividade de alimentos)
+    from app.services.diet_episode_service import get_diet_episode_table
+    get_diet_episode_table().refresh_async()
+    
     logger.info("Serviço de ML iniciado com sucesso")
 
 
@@ -2,10 +2,19 @@
 import pandas as pd
 import numpy as np
 from typing import List, Dict, Optional
-from sklearn.neighbors import NearestNeighbors
 from sklearn.preprocessing import StandardScaler
+from scipy.spatial.distance import cdist
+from datetime import datetime
+from threading import Lock, Thread
+import joblib
 import logging
+import os
+import time
 
+from app.config import settings
+from app.models.similarity_engine import create_engine
+from app.services.cache import LRUCache
+from app.services.diet_patterns import get_diet_pattern_aggregates
 from app.services.etl_service import ETLService
 
 logger = logging.getLogger(__name__)
@@ -24,12 +33,74 @@ class DietAnalyzer:
         'ZScorePeso',
     ]
     
-    def __init__(self):
-        """Inicializa o analisador"""
+    # Colunas da tabela de casos mantidas no índice (já no formato da resposta)
+    CASE_COLUMNS = [
+        'crianca_id',
+        'idade_gestacional_semanas',
+        'peso_nascimento_gr',
+        'sexo',
+        'classificacao_ig',
+        'classificacao_peso',
+        'taxa_energetica_kcal_kg',
+        'meta_proteina_g_kg',
+        'delta_zscore_real',
+        'dias_acompanhamento',
+        'zscore_inicial',
+        'zscore_final',
+    ]
+    
+    # Limiares de desfecho com sub-índice mantido em memória
+    MAX_OUTCOME_PARTITIONS = 8
+    
+    # Limiar padrão de sucesso (sub-índices construídos junto com o índice)
+    MIN_DELTA_ZSCORE_PADRAO = 0.1
+    
+    # Colunas da tabela de casos que definem os estratos dos sub-índices
+    STRATUM_COLUMNS = ['sexo', 'classificacao_ig']
+    
+    # Versão do formato do índice salvo (versões diferentes são reconstruídas)
+    INDEX_VERSION = 2
+    
+    def __init__(self, model_path: Optional[str] = None):
+        """
+        Inicializa o analisador
+        
+        Args:
+            model_path: Caminho para índice salvo (opcional)
+        """
         self.scaler = StandardScaler()
-        self.knn_model = NearestNeighbors(n_neighbors=20, metric='euclidean')
+        self.engine = settings.SIMILARITY_ENGINE
         self.dataset = None
+        self._case_arrays = {}
+        self.X_scaled = None
         self.is_fitted = False
+        self.feature_columns = []
+        self.medians = {}
+        self.data_watermark = None  # Consulta mais recente presente no índice
+        self.built_at = None
+        self.model_path = model_path or os.path.join(settings.MODEL_PATH, 'diet_analyzer.joblib')
+        self._build_lock = Lock()
+        self._update_lock = Lock()
+        self._refresh_lock = Lock()
+        self._refresh_agendado = False  # Verificação/reconstrução em segundo plano pendente
+        self._partitions = LRUCache(maxsize=self.MAX_OUTCOME_PARTITIONS)
+        
+        # Atualizações incrementais desde a última construção/compactação:
+        # casos novos ficam em um buffer pesquisado por força bruta e casos
+        # substituídos/removidos são marcados (tombstones) até a compactação
+        self._delta_X = None
+        self._delta_table = None
+        self._delta_arrays = {}
+        self._removidos = None
+        self._n_removidos_base = 0
+        self._posicoes = {}
+        self._log = None  # Atualizações recebidas durante uma reconstrução
+        
+        # Tentar carregar índice existente
+        if os.path.exists(self.model_path):
+            self.load_index()
+        else:
+            logger.info("Nenhum índice de similaridade encontrado.")
     
     def fit(self, df: pd.DataFrame):
         """
@@ -53,23 +124,480 @@ class DietAnalyzer:
             return
         
         # Preencher valores nulos
-        df_clean = df[features_for_similarity].fillna(df[features_for_similarity].median())
+        medians = df[features_for_similarity].median()
+        df_clean = df[features_for_similarity].fillna(medians)
+        
+        # Normalizar features em nova instância, trocando o índice em uso
+        # apenas no final (consultas concorrentes não veem um índice pela metade)
+        scaler = StandardScaler()
+        X_scaled = scaler.fit_transform(df_clean)
+        
+        self._install_index(
+            scaler=scaler,
+            X_scaled=X_scaled,
+            dataset=self._build_case_table(df),
+            feature_columns=features_for_similarity,
+            medians=medians.to_dict(),
+            data_watermark=df['DataConsulta'].max() if 'DataConsulta' in df.columns else None,
+            engine=settings.SIMILARITY_ENGINE
+        )
+        
+        logger.info(f"DietAnalyzer treinado com {len(df)} casos (motor: {self.engine})")
+    
+    def _install_index(
+        self,
+        scaler: StandardScaler,
+        X_scaled: np.ndarray,
+        dataset: pd.DataFrame,
+        feature_columns: List[str],
+        medians: Dict,
+        data_watermark,
+        engine: str,
+        particoes_padrao: Optional[Dict] = None,
+        built_at: Optional[datetime] = None
+    ):
+        """
+        Troca o índice em uso e descarta o buffer incremental
+        
+        Atualizações recebidas durante a reconstrução (registradas em _log)
+        são reaplicadas sobre o novo índice.
+        """
+        case_arrays = {col: dataset[col].to_numpy() for col in self.CASE_COLUMNS}
+        
+        # Sub-índices do limiar padrão prontos antes da primeira consulta
+        if particoes_padrao is None:
+            particoes_padrao = self._build_partitions(
+                X_scaled, case_arrays, self.MIN_DELTA_ZSCORE_PADRAO, engine
+            )
+        partitions = LRUCache(maxsize=self.MAX_OUTCOME_PARTITIONS)
+        partitions.set(self.MIN_DELTA_ZSCORE_PADRAO, particoes_padrao)
+        
+        posicoes = pd.Series(np.arange(len(dataset))).groupby(
+            dataset['crianca_id'].str.lower().to_numpy()
+        ).indices
+        
+        with self._update_lock:
+            self.scaler = scaler
+            self.engine = engine
+            self.X_scaled = X_scaled
+            self.dataset = dataset
+            self._case_arrays = case_arrays
+            self._partitions = partitions
+            self.feature_columns = feature_columns
+            self.medians = medians
+            self.data_watermark = data_watermark
+            self.built_at = built_at or datetime.now()
+            
+            self._delta_X = np.empty((0, X_scaled.shape[1]))
+            self._delta_table = dataset.iloc[:0]
+            self._delta_arrays = {col: arr[:0] for col, arr in case_arrays.items()}
+            self._removidos = np.zeros(len(dataset), dtype=bool)
+            self._n_removidos_base = 0
+            self._posicoes = dict(posicoes)
+            self.is_fitted = True
+            
+            if self._log is not None:
+                for crianca_id, df_features in self._log:
+                    self._apply_upsert(crianca_id, df_features)
+                self._log = None
+    
+    @classmethod
+    def _build_case_table(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Tabela compacta de casos com os campos da resposta já convertidos
+        
+        Args:
+            df: Timeline com features computadas
+            
+        Returns:
+            DataFrame com CASE_COLUMNS, uma linha por consulta (mesma ordem de df)
+        """
+        def numerico(col: str, padrao: float = np.nan) -> pd.Series:
+            if col not in df.columns:
+                return pd.Series(padrao, index=df.index, dtype=np.float64)
+            return pd.to_numeric(df[col], errors='coerce')
+        
+        def categoria(col: str, padrao=None, prefixo: Optional[str] = None) -> pd.Series:
+            if col in df.columns:
+                return df[col].astype(object)
+            
+            # compute_features substitui classificações por colunas one-hot
+            dummies = [c for c in df.columns if prefixo and c.startswith(f'{prefixo}_') and c != f'{prefixo}_nan']
+            if not dummies:
+                return pd.Series(padrao, index=df.index, dtype=object)
+            
+            marcadas = df[dummies].to_numpy(dtype=bool)
+            valores = np.array([c[len(prefixo) + 1:] for c in dummies], dtype=object)
+            return pd.Series(
+                np.where(marcadas.any(axis=1), valores[marcadas.argmax(axis=1)], None),
+                index=df.index, dtype=object
+            )
+        
+        zscore_peso = numerico('ZScorePeso', 0.0)
+        
+        tabela = pd.DataFrame({
+            'crianca_id': df['CriancaId'].astype(str) if 'CriancaId' in df.columns else '',
+            'idade_gestacional_semanas': numerico('IdadeGestacionalSemanas', 0.0),
+            'peso_nascimento_gr': numerico('PesoNascimentoGr').fillna(0).astype(np.int64),
+            'sexo': categoria('Sexo', 'M'),
+            'classificacao_ig': categoria('ClassificacaoIG', prefixo='ClassIG'),
+            'classificacao_peso': categoria('ClassificacaoPeso', prefixo='ClassPeso'),
+            'taxa_energetica_kcal_kg': numerico('TaxaEnergeticaKcalKg').fillna(0.0),
+            'meta_proteina_g_kg': numerico('MetaProteinaGKg').fillna(0.0),
+            'delta_zscore_real': numerico('DeltaZScore', 0.0),
+            'dias_acompanhamento': numerico('DiasEntreConsultas').fillna(14).astype(np.int64),
+            'zscore_inicial': numerico('ZScoreAnterior').fillna(zscore_peso),
+            'zscore_final': zscore_peso.fillna(0.0),
+        })
+        
+        # Classificações ausentes viram None (campo opcional na resposta)
+        for col in ('classificacao_ig', 'classificacao_peso'):
+            tabela[col] = tabela[col].where(tabela[col].notna(), None)
+        
+        return tabela.reset_index(drop=True)
+    
+    def _prepare_rows(self, df: pd.DataFrame):
+        """Tabela de casos e features normalizadas (scaler congelado) de novas consultas"""
+        X = df.reindex(columns=self.feature_columns).apply(pd.to_numeric, errors='coerce')
+        X = self.scaler.transform(X.fillna(self.medians).fillna(0))
+        return self._build_case_table(df), X
+    
+    def upsert_crianca(self, crianca_id: str, df_features: Optional[pd.DataFrame]) -> Dict:
+        """
+        Substitui os casos de uma criança no índice sem reconstruí-lo
+        
+        Os casos anteriores da criança são marcados como removidos e os novos
+        entram no buffer incremental, pesquisável imediatamente. O scaler e
+        as medianas permanecem os da última construção completa.
+        
+        Args:
+            crianca_id: ID da criança
+            df_features: Timeline da criança com features computadas
+                (None ou vazio remove a criança do índice)
+            
+        Returns:
+            Dicionário com número de casos inseridos e estado do buffer
+        """
+        if not self.is_fitted:
+            return {'crianca_id': crianca_id, 'n_casos': 0, 'status': 'index_not_ready'}
+        
+        chave = str(crianca_id).lower()
+        with self._update_lock:
+            n_casos = self._apply_upsert(chave, df_features)
+            if self._log is not None:
+                self._log.append((chave, df_features))
+            n_pendentes = len(self._delta_X) + self._n_removidos_base
+        
+        if n_pendentes > settings.SIMILARITY_DELTA_MAX_ROWS:
+            self.compact_async()
+        
+        return {'crianca_id': crianca_id, 'n_casos': n_casos, 'status': 'updated'}
+    
+    def remove_crianca(self, crianca_id: str) -> Dict:
+        """Remove todos os casos de uma criança do índice"""
+        return self.upsert_crianca(crianca_id, None)
+    
+    def _apply_upsert(self, chave: str, df_features: Optional[pd.DataFrame]) -> int:
+        """Aplica substituição dos casos de uma criança (chamar com _update_lock)"""
+        n_base = len(self.X_scaled)
+        
+        # Arrays são substituídos, nunca alterados, para consultas concorrentes
+        removidos = self._removidos.copy()
+        antigas = self._posicoes.pop(chave, None)
+        if antigas is not None:
+            antigas = antigas[~removidos[antigas]]
+            removidos[antigas] = True
+            self._n_removidos_base += int((antigas < n_base).sum())
+        
+        if df_features is None or df_features.empty:
+            self._removidos = removidos
+            return 0
+        
+        tabela, X = self._prepare_rows(df_features)
+        inicio = n_base + len(self._delta_X)
+        
+        delta_table = pd.concat([self._delta_table, tabela], ignore_index=True) if len(self._delta_table) else tabela
+        self._removidos = np.concatenate([removidos, np.zeros(len(tabela), dtype=bool)])
+        self._delta_table = delta_table
+        self._delta_arrays = {col: delta_table[col].to_numpy() for col in self.CASE_COLUMNS}
+        self._delta_X = np.vstack([self._delta_X, X])
+        self._posicoes[chave] = np.arange(inicio, inicio + len(tabela))
+        
+        if 'DataConsulta' in df_features.columns:
+            ultima = df_features['DataConsulta'].max()
+            if self.data_watermark is None or pd.Timestamp(ultima) > pd.Timestamp(self.data_watermark):
+                self.data_watermark = ultima
+        
+        return len(tabela)
+    
+    def compact(self) -> Dict:
+        """
+        Incorpora o buffer incremental ao índice principal
+        
+        Descarta casos removidos e reconstrói os sub-índices com o scaler
+        atual (sem reler o banco nem reajustar a normalização).
+        
+        Raises:
+            RuntimeError: Se já houver uma construção/compactação em andamento
+        """
+        if not self._build_lock.acquire(blocking=False):
+            raise RuntimeError("Construção do índice de similaridade já está em execução")
+        
+        try:
+            inicio = time.perf_counter()
+            with self._update_lock:
+                self._log = []
+                X_base, dataset, delta_X, delta_table = self.X_scaled, self.dataset, self._delta_X, self._delta_table
+                removidos = self._removidos
+            
+            vivos = ~removidos
+            X_scaled = np.vstack([X_base, delta_X])[vivos]
+            dataset = pd.concat([dataset, delta_table], ignore_index=True)[vivos].reset_index(drop=True)
+            
+            self._install_index(
+                scaler=self.scaler,
+                X_scaled=X_scaled,
+                dataset=dataset,
+                feature_columns=self.feature_columns,
+                medians=self.medians,
+                data_watermark=self.data_watermark,
+                engine=self.engine,
+                built_at=self.built_at
+            )
+            self.save_index()
+            
+            info = self.index_info()
+            info['tempo_s'] = round(time.perf_counter() - inicio, 2)
+            logger.info(f"Índice de similaridade compactado: {info}")
+            return info
+        finally:
+            with self._update_lock:
+                self._log = None
+            self._build_lock.release()
+    
+    def compact_async(self) -> bool:
+        """Compacta o índice em segundo plano (False se já houver construção em andamento)"""
+        if self._build_lock.locked():
+            return False
+        
+        def _run():
+            try:
+                self.compact()
+            except RuntimeError:
+                pass
+            except Exception as e:
+                logger.error(f"Erro ao compactar índice de similaridade: {e}", exc_info=True)
+        
+        Thread(target=_run, name="diet-index-compact", daemon=True).start()
+        return True
+    
+    def build_index(self) -> Dict:
+        """
+        Reconstrói o índice a partir do banco e salva em disco
+        
+        Returns:
+            Metadados do índice construído
+            
+        Raises:
+            RuntimeError: Se já houver uma construção em andamento
+        """
+        if not self._build_lock.acquire(blocking=False):
+            raise RuntimeError("Construção do índice de similaridade já está em execução")
+        
+        try:
+            inicio = time.perf_counter()
+            with self._update_lock:
+                self._log = []
+            
+            df_all = ETLService.get_crianca_timeline()
+            if df_all.empty:
+                logger.warning("Não há dados para construir o índice de similaridade")
+                return self.index_info()
+            
+            self.fit(ETLService.compute_features(df_all))
+            self.save_index()
+            
+            info = self.index_info()
+            info['tempo_s'] = round(time.perf_counter() - inicio, 2)
+            return info
+        finally:
+            with self._update_lock:
+                self._log = None
+            self._build_lock.release()
+    
+    def is_stale(self) -> bool:
+        """Verifica se há consultas mais recentes que o índice carregado"""
+        if not self.is_fitted or self.data_watermark is None:
+            return True
+        watermark_banco = ETLService.get_consulta_watermark()
+        return watermark_banco is not None and pd.Timestamp(watermark_banco) > pd.Timestamp(self.data_watermark)
+    
+    def refresh_index_async(self, force: bool = False) -> bool:
+        """
+        Reconstrói o índice em segundo plano se ausente ou desatualizado
+        
+        Args:
+            force: Reconstruir mesmo se o índice estiver atualizado
+            
+        Returns:
+            True se a verificação/construção foi iniciada
+        """
+        # Uma única verificação por vez: enquanto o índice não existe, cada
+        # busca de casos similares pede uma atualização
+        with self._refresh_lock:
+            if self._refresh_agendado or self._build_lock.locked():
+                return False
+            self._refresh_agendado = True
+        
+        def _run():
+            try:
+                if force or self.is_stale():
+                    info = self.build_index()
+                    logger.info(f"Índice de similaridade reconstruído: {info}")
+            except RuntimeError:
+                pass
+            except Exception as e:
+                logger.error(f"Erro ao reconstruir índice de similaridade: {e}", exc_info=True)
+            finally:
+                with self._refresh_lock:
+                    self._refresh_agendado = False
+        
+        Thread(target=_run, name="diet-index-build", daemon=True).start()
+        return True
+    
+    def index_info(self) -> Dict:
+        """Metadados do índice em memória"""
+        return {
+            'is_fitted': self.is_fitted,
+            'n_casos': len(self.dataset) if self.dataset is not None else 0,
+            'n_casos_buffer': len(self._delta_X) if self._delta_X is not None else 0,
+            'n_removidos': self._n_removidos_base,
+            'engine': self.engine,
+            'data_watermark': self.data_watermark,
+            'built_at': self.built_at,
+            'building': self._build_lock.locked(),
+        }
+    
+    def save_index(self):
+        """Salva índice principal em disco (escrita atômica; o buffer incremental não é salvo)"""
+        os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
+        
+        index_data = {
+            'versao': self.INDEX_VERSION,
+            'scaler': self.scaler,
+            'engine': self.engine,
+            'particoes_padrao': self._partitions.get(self.MIN_DELTA_ZSCORE_PADRAO),
+            'dataset': self.dataset,
+            'X_scaled': self.X_scaled,
+            'feature_columns': self.feature_columns,
+            'medians': self.medians,
+            'data_watermark': self.data_watermark,
+            'built_at': self.built_at
+        }
+        
+        joblib.dump(index_data, self.model_path + '.tmp')
+        os.replace(self.model_path + '.tmp', self.model_path)
+        logger.info(f"Índice de similaridade salvo em {self.model_path}")
+    
+    def load_index(self):
+        """Carrega índice do disco (arquivo ausente ou inválido deixa o analisador sem índice)"""
+        try:
+            index_data = joblib.load(self.model_path)
+            if index_data.get('versao') != self.INDEX_VERSION:
+                logger.info("Índice de similaridade salvo em formato antigo; será reconstruído")
+                return
+            
+            self._install_index(
+                scaler=index_data['scaler'],
+                X_scaled=index_data['X_scaled'],
+                dataset=index_data['dataset'],
+                feature_columns=index_data['feature_columns'],
+                medians=index_data.get('medians', {}),
+                data_watermark=index_data.get('data_watermark'),
+                engine=index_data['engine'],
+                particoes_padrao=index_data.get('particoes_padrao'),
+                built_at=index_data.get('built_at')
+            )
+            logger.info(f"Índice de similaridade carregado de {self.model_path} ({len(self.dataset)} casos)")
+        except Exception as e:
+            logger.warning(f"Não foi possível carregar índice de similaridade: {e}")
+    
+    @classmethod
+    def _build_partitions(
+        cls, X_scaled: np.ndarray, case_arrays: Dict, min_delta_zscore: float, engine: str
+    ) -> Dict:
+        """
+        Sub-índices com as linhas cujo DeltaZScore atinge o limiar
+        
+        Constrói, em uma única passada sobre as linhas elegíveis, o sub-índice
+        global (chave None) e um por estrato (sexo, classificacao_ig), todos
+        no espaço do mesmo scaler.
+        
+        Returns:
+            Dicionário chave → tupla (índice de vizinhos, posições na tabela de casos)
+        """
+        elegiveis = np.flatnonzero(case_arrays['delta_zscore_real'].astype(np.float64) >= min_delta_zscore)
+        if len(elegiveis) == 0:
+            return {}
         
-        # Normalizar features
-        X_scaled = self.scaler.fit_transform(df_clean)
+        particoes = {None: (create_engine(engine).fit(X_scaled[elegiveis]), elegiveis)}
         
-        # Treinar KNN
-        self.knn_model.fit(X_scaled)
-        self.dataset = df.copy()
-        self.is_fitted = True
+        estratos = pd.Series(elegiveis).groupby(
+            [pd.Series(case_arrays[col][elegiveis]).fillna('') for col in cls.STRATUM_COLUMNS]
+        ).indices
+        for chave, linhas in estratos.items():
+            chave = tuple(valor if valor != '' else None for valor in chave)
+            linhas = elegiveis[linhas]
+            particoes[chave] = (create_engine(engine).fit(X_scaled[linhas]), linhas)
         
-        logger.info(f"DietAnalyzer treinado com {len(df)} casos")
+        return particoes
+    
+    def _outcome_partitions(self, indice: Dict, min_delta_zscore: float) -> Dict:
+        """
+        Sub-índices apenas com casos de sucesso (DeltaZScore >= limiar)
+        
+        Construídos na primeira consulta de cada limiar e mantidos em cache
+        até a próxima reconstrução do índice. Casos sem desfecho (DeltaZScore
+        nulo) nunca são elegíveis.
+        
+        Returns:
+            Dicionário de sub-índices (ver _build_partitions; vazio se não houver casos)
+        """
+        chave = float(min_delta_zscore)
+        particoes = indice['partitions'].get(chave)
+        
+        if particoes is None:
+            particoes = self._build_partitions(
+                indice['X_scaled'], indice['case_arrays'], chave, indice['engine']
+            )
+            indice['partitions'].set(chave, particoes)
+        
+        return particoes
+    
+    def _snapshot(self) -> Dict:
+        """Referências consistentes ao índice e ao buffer para uma consulta"""
+        with self._update_lock:
+            return {
+                'X_scaled': self.X_scaled,
+                'case_arrays': self._case_arrays,
+                'partitions': self._partitions,
+                'engine': self.engine,
+                'scaler': self.scaler,
+                'feature_columns': self.feature_columns,
+                'medians': self.medians,
+                'delta_X': self._delta_X,
+                'delta_arrays': self._delta_arrays,
+                'removidos': self._removidos,
+                'n_removidos_base': self._n_removidos_base,
+            }
     
     def find_similar_cases(
         self, 
         crianca_perfil: Dict, 
         top_n: int = 10,
-        min_delta_zscore: float = 0.1
+        min_delta_zscore: float = MIN_DELTA_ZSCORE_PADRAO,
+        sexo: Optional[str] = None,
+        classificacao_ig: Optional[str] = None
     ) -> List[Dict]:
         """
         Encontra casos similares no histórico com bons desfechos
@@ -78,92 +606,200 @@ class DietAnalyzer:
             crianca_perfil: Dicionário com perfil da criança
             top_n: Número de casos a retornar
             min_delta_zscore: Mínimo de melhora no z-score para considerar sucesso
+            sexo: Restringir a casos deste sexo (opcional)
+            classificacao_ig: Restringir a casos desta classificação IG (opcional)
             
         Returns:
             Lista de casos similares com suas dietas e desfechos
         """
+        return self.find_similar_cases_batch(
+            [crianca_perfil], top_n, min_delta_zscore, sexo=sexo, classificacao_ig=classificacao_ig
+        )[0]
+    
+    def find_similar_cases_batch(
+        self,
+        perfis: List[Dict],
+        top_n: int = 10,
+        min_delta_zscore: float = MIN_DELTA_ZSCORE_PADRAO,
+        sexo: Optional[str] = None,
+        classificacao_ig: Optional[str] = None
+    ) -> List[List[Dict]]:
+        """
+        Encontra casos similares para vários perfis com uma única busca no índice
+        
+        Com filtro de estrato, a busca é feita apenas nos sub-índices do
+        estrato, sem pós-filtragem de uma busca global.
+        
+        Args:
+            perfis: Lista de perfis (dicionários com as features de similaridade)
+            top_n: Número de casos a retornar por perfil
+            min_delta_zscore: Mínimo de melhora no z-score para considerar sucesso
+            sexo: Restringir a casos deste sexo (opcional)
+            classificacao_ig: Restringir a casos desta classificação IG (opcional)
+            
+        Returns:
+            Uma lista de casos similares por perfil, na ordem recebida
+        """
+        if not perfis:
+            return []
+        
         if not self.is_fitted or self.dataset is None:
-            # Se não tiver treinado, treinar agora
-            df_all = ETLService.get_crianca_timeline()
-            if not df_all.empty:
-                df_all = ETLService.compute_features(df_all)
-                self.fit(df_all)
-            else:
-                logger.warning("Não há dados para encontrar casos similares")
-                return []
-        
-        # Preparar features do perfil atual
-        features = []
-        for col in self.SIMILARITY_FEATURES:
-            if col in crianca_perfil:
-                features.append(crianca_perfil[col])
-            else:
-                # Usar valor médio se não disponível
-                if col in self.dataset.columns:
-                    features.append(self.dataset[col].median())
-                else:
-                    features.append(0)
+            # Índice é construído fora da requisição
+            self.refresh_index_async()
+            logger.warning("Índice de similaridade ainda não disponível; construção em segundo plano")
+            return [[] for _ in perfis]
+        
+        indice = self._snapshot()
+        
+        # Matriz de consulta: valores ausentes recebem a mediana do índice
+        X_query = pd.DataFrame.from_records(perfis).reindex(columns=indice['feature_columns'])
+        X_query = X_query.apply(pd.to_numeric, errors='coerce')
+        X_query = X_query.fillna(indice['medians']).fillna(0)
         
         # Normalizar
-        X_query = self.scaler.transform([features])
-        
-        # Encontrar vizinhos mais próximos
-        distances, indices = self.knn_model.kneighbors(X_query, n_neighbors=min(top_n * 3, len(self.dataset)))
-        
-        # Coletar casos
-        similar_cases = []
-        for dist, idx in zip(distances[0], indices[0]):
-            caso = self.dataset.iloc[idx]
-            
-            # Verificar se teve melhora significativa
-            delta_zscore = caso.get('DeltaZScore', 0)
-            if delta_zscore < min_delta_zscore:
-                continue  # Pular casos sem sucesso
-            
-            # Calcular score de similaridade (0-1, onde 1 é idêntico)
-            similarity_score = 1.0 / (1.0 + dist)
-            
-            similar_case = {
-                'crianca_id': str(caso.get('CriancaId', '')),
-                'idade_gestacional_semanas': float(caso.get('IdadeGestacionalSemanas', 0)),
-                'peso_nascimento_gr': int(caso.get('PesoNascimentoGr', 0)) if not pd.isna(caso.get('PesoNascimentoGr')) else 0,
-                'sexo': caso.get('Sexo', 'M'),
-                'classificacao_ig': caso.get('ClassificacaoIG', None) if 'ClassificacaoIG' in caso else None,
-                'classificacao_peso': caso.get('ClassificacaoPeso', None) if 'ClassificacaoPeso' in caso else None,
-                
-                # Dieta usada
-                'taxa_energetica_kcal_kg': float(caso.get('TaxaEnergeticaKcalKg', 0)) if not pd.isna(caso.get('TaxaEnergeticaKcalKg')) else 0.0,
-                'meta_proteina_g_kg': float(caso.get('MetaProteinaGKg', 0)) if not pd.isna(caso.get('MetaProteinaGKg')) else 0.0,
-                
-                # Desfecho
-                'delta_zscore_real': float(delta_zscore),
-                'dias_acompanhamento': int(caso.get('DiasEntreConsultas', 14)) if not pd.isna(caso.get('DiasEntreConsultas')) else 14,
-                'zscore_inicial': float(caso.get('ZScoreAnterior', caso.get('ZScorePeso', 0))) if not pd.isna(caso.get('ZScoreAnterior')) else float(caso.get('ZScorePeso', 0)),
-                'zscore_final': float(caso.get('ZScorePeso', 0)) if not pd.isna(caso.get('ZScorePeso')) else 0.0,
-                'sucesso': delta_zscore >= min_delta_zscore,
-                
-                # Similaridade
-                'similarity_score': float(similarity_score)
-            }
-            
-            similar_cases.append(similar_case)
+        X_query = indice['scaler'].transform(X_query)
+        
+        estrato = (sexo, classificacao_ig)
+        distances, indices = self._search(indice, X_query, top_n, min_delta_zscore, estrato)
+        if distances is None:
+            return [[] for _ in perfis]
+        
+        return self._build_similar_cases(indice, distances, indices, min_delta_zscore)
+    
+    def _search(
+        self,
+        indice: Dict,
+        X_query: np.ndarray,
+        top_n: int,
+        min_delta_zscore: float,
+        estrato: tuple = (None, None)
+    ):
+        """
+        Busca os top_n vizinhos elegíveis no índice principal e no buffer
+        
+        Sem filtro usa o sub-índice global; com filtro, os sub-índices dos
+        estratos compatíveis (um só quando sexo e classificação IG são
+        informados). Em cada sub-índice são pedidos vizinhos extras em número
+        igual ao de casos removidos, o que garante top_n vizinhos válidos; o
+        buffer é pesquisado por força bruta. Posições >= len(X_scaled)
+        referem-se ao buffer. Distância infinita marca posições sem caso válido.
+        
+        Args:
+            estrato: Filtro (sexo, classificacao_ig); None em um campo aceita qualquer valor
+        
+        Returns:
+            Tupla (distâncias, posições), cada uma (n_consultas, k), ou (None, None)
+        """
+        n_base = len(indice['X_scaled'])
+        removidos = indice['removidos']
+        distancias, posicoes = [], []
+        
+        # Buscar apenas entre os casos com desfecho de sucesso do estrato
+        particoes = self._outcome_partitions(indice, min_delta_zscore)
+        if all(valor is None for valor in estrato):
+            selecionadas = [particoes[None]] if None in particoes else []
+        else:
+            selecionadas = [
+                particao for chave, particao in particoes.items()
+                if chave is not None and all(v is None or v == c for v, c in zip(estrato, chave))
+            ]
+        
+        for knn_sucesso, linhas in selecionadas:
+            k = min(top_n + indice['n_removidos_base'], len(linhas))
+            dist, idx = knn_sucesso.kneighbors(X_query, n_neighbors=k)
+            pos = linhas[idx]
+            distancias.append(np.where(removidos[pos], np.inf, dist))
+            posicoes.append(pos)
+        
+        delta_X = indice['delta_X']
+        if len(delta_X) > 0:
+            delta = indice['delta_arrays']['delta_zscore_real'].astype(np.float64)
+            mascara = (delta >= min_delta_zscore) & ~removidos[n_base:n_base + len(delta_X)]
+            for col, valor in zip(self.STRATUM_COLUMNS, estrato):
+                if valor is not None:
+                    mascara &= indice['delta_arrays'][col] == valor
+            elegiveis = np.flatnonzero(mascara)
+            if len(elegiveis) > 0:
+                dist = cdist(X_query, delta_X[elegiveis])
+                distancias.append(dist)
+                posicoes.append(np.broadcast_to(n_base + elegiveis, dist.shape))
+        
+        if not distancias:
+            return None, None
+        
+        distancias = np.concatenate(distancias, axis=1)
+        posicoes = np.concatenate(posicoes, axis=1)
+        ordem = np.argsort(distancias, axis=1, kind='stable')[:, :top_n]
+        
+        return np.take_along_axis(distancias, ordem, axis=1), np.take_along_axis(posicoes, ordem, axis=1)
+    
+    @staticmethod
+    def _case_column(indice: Dict, col: str, posicoes: np.ndarray) -> np.ndarray:
+        """Valores de uma coluna da tabela de casos (índice principal ou buffer)"""
+        base = indice['case_arrays'][col]
+        buffer = indice['delta_arrays'][col]
+        n_base = len(base)
+        
+        if len(buffer) == 0:
+            return base[posicoes]
+        if n_base == 0:
+            return buffer[posicoes]
+        
+        valores = base[np.minimum(posicoes, n_base - 1)]
+        no_buffer = posicoes >= n_base
+        valores[no_buffer] = buffer[posicoes[no_buffer] - n_base]
+        return valores
+    
+    def _build_similar_cases(
+        self,
+        indice: Dict,
+        distances: np.ndarray,
+        indices: np.ndarray,
+        min_delta_zscore: float
+    ) -> List[List[Dict]]:
+        """
+        Monta os casos de todas as consultas de uma vez
+        
+        Args:
+            indice: Snapshot do índice usado na busca
+            distances: Distâncias (n_consultas, k)
+            indices: Posições na tabela de casos (n_consultas, k)
+            min_delta_zscore: Limiar de sucesso
             
-            if len(similar_cases) >= top_n:
-                break
+        Returns:
+            Uma lista de casos por consulta, ordenada pela combinação de
+            similaridade e desfecho
+        """
+        # Calcular score de similaridade (0-1, onde 1 é idêntico)
+        similarity = 1.0 / (1.0 + distances)
+        delta = self._case_column(indice, 'delta_zscore_real', indices).astype(np.float64)
         
-        # Ordenar por combinação de similaridade e sucesso
-        similar_cases.sort(
-            key=lambda x: (x['similarity_score'] * 0.5 + x['delta_zscore_real'] * 0.5),
-            reverse=True
-        )
+        # Ordenar por combinação de similaridade e sucesso (estável, maior primeiro)
+        ordem = np.argsort(-(similarity * 0.5 + delta * 0.5), axis=1, kind='stable')
+        indices = np.take_along_axis(indices, ordem, axis=1)
+        similarity = np.take_along_axis(similarity, ordem, axis=1)
+        delta = np.take_along_axis(delta, ordem, axis=1)
+        validos = np.isfinite(np.take_along_axis(distances, ordem, axis=1))
+        
+        colunas = {col: self._case_column(indice, col, indices) for col in self.CASE_COLUMNS}
+        colunas['sucesso'] = delta >= min_delta_zscore
+        colunas['similarity_score'] = similarity
+        
+        nomes = list(colunas)
+        resultados = []
+        for i in range(indices.shape[0]):
+            valores = [colunas[nome][i][validos[i]].tolist() for nome in nomes]
+            resultados.append([dict(zip(nomes, linha)) for linha in zip(*valores)])
         
-        return similar_cases[:top_n]
+        return resultados
     
     def compare_diet_scenarios(
         self, 
         crianca_perfil: Dict,
         dietas_cenarios: List[Dict],
-        growth_predictor
+        growth_predictor,
+        incluir_contribuicoes: bool = False,
+        predicoes: Optional[List[Dict]] = None
     ) -> List[Dict]:
         """
         Compara múltiplos cenários de dieta
@@ -172,47 +808,46 @@ class DietAnalyzer:
             crianca_perfil: Perfil da criança
             dietas_cenarios: Lista de cenários de dieta
             growth_predictor: Instância do GrowthPredictor para fazer predições
+            incluir_contribuicoes: Incluir contribuição de cada feature nas predições
+            predicoes: Predições já calculadas para os cenários (opcional)
             
         Returns:
             Lista de comparações ranqueadas
         """
+        # Todos os cenários em um único lote
+        if predicoes is None:
+            predicoes = growth_predictor.predict_scenarios(
+                crianca_features=crianca_perfil,
+                cenarios=dietas_cenarios,
+                horizonte_dias=14,
+                incluir_contribuicoes=incluir_contribuicoes
+            )
+        
         comparisons = []
         
-        for idx, cenario in enumerate(dietas_cenarios):
-            # Fazer predição para este cenário
-            try:
-                predicao = growth_predictor.predict_zscore_change(
-                    crianca_features=crianca_perfil,
-                    dieta_features=cenario,
-                    horizonte_dias=14
-                )
-                
-                # Calcular score de adequação (0-100)
-                # Baseado em:
-                # - Delta z-score esperado
-                # - Probabilidade de melhora
-                # - Confiabilidade do modelo
-                
-                delta_score = min(max(predicao['delta_zscore_pred'] * 20, 0), 50)
-                prob_score = predicao['probabilidade_melhora'] * 30
-                
-                confiabilidade_scores = {'alta': 20, 'media': 10, 'baixa': 5}
-                conf_score = confiabilidade_scores.get(predicao['confiabilidade'], 10)
-                
-                score = delta_score + prob_score + conf_score
-                
-                comparison = {
-                    'cenario': cenario,
-                    'predicao': predicao,
-                    'score': float(score),
-                    'ranking': 0  # Será preenchido depois
-                }
-                
-                comparisons.append(comparison)
-                
-            except Exception as e:
-                logger.error(f"Erro ao fazer predição para cenário {idx}: {e}")
-                continue
+        for cenario, predicao in zip(dietas_cenarios, predicoes):
+            # Calcular score de adequação (0-100)
+            # Baseado em:
+            # - Delta z-score esperado
+            # - Probabilidade de melhora
+            # - Confiabilidade do modelo
+            
+            delta_score = min(max(predicao['delta_zscore_pred'] * 20, 0), 50)
+            prob_score = predicao['probabilidade_melhora'] * 30
+            
+            confiabilidade_scores = {'alta': 20, 'media': 10, 'baixa': 5}
+            conf_score = confiabilidade_scores.get(predicao['confiabilidade'], 10)
+            
+            score = delta_score + prob_score + conf_score
+            
+            comparison = {
+                'cenario': cenario,
+                'predicao': predicao,
+                'score': float(score),
+                'ranking': 0  # Será preenchido depois
+            }
+            
+            comparisons.append(comparison)
         
         # Ordenar por score e atribuir ranking
         comparisons.sort(key=lambda x: x['score'], reverse=True)
@@ -221,55 +856,134 @@ class DietAnalyzer:
         
         return comparisons
     
-    def get_diet_patterns(self, classification_ig: Optional[str] = None) -> Dict:
+    def optimize_diet_scenario(
+        self,
+        crianca_perfil: Dict,
+        growth_predictor,
+        energia_min: float = 80,
+        energia_max: float = 200,
+        proteina_min: float = 1.5,
+        proteina_max: float = 5.0,
+        frequencias: Optional[List[float]] = None,
+        horizonte_dias: int = 14,
+        n_pontos: int = 11,
+        n_refinamentos: int = 3
+    ) -> Dict:
         """
-        Analisa padrões de dieta por classificação IG
+        Busca o cenário de dieta com maior Δ z-score previsto sob restrições
+        
+        Busca coarse-to-fine: cada etapa avalia uma grade n_pontos × n_pontos
+        (× frequências permitidas) em um único lote e a etapa seguinte
+        refina a grade em torno do melhor ponto encontrado até então.
         
         Args:
-            classification_ig: Filtrar por classificação específica
+            crianca_perfil: Perfil da criança (última medida com features)
+            growth_predictor: Instância do GrowthPredictor para fazer predições
+            energia_min: Taxa energética mínima (kcal/kg/dia)
+            energia_max: Taxa energética máxima (kcal/kg/dia)
+            proteina_min: Meta proteica mínima (g/kg/dia)
+            proteina_max: Meta proteica máxima (g/kg/dia)
+            frequencias: Frequências permitidas (horas)
+            horizonte_dias: Horizonte de predição em dias
+            n_pontos: Pontos por eixo em cada etapa
+            n_refinamentos: Número de etapas de refinamento após a grade inicial
             
         Returns:
-            Dicionário com padrões encontrados
+            Dicionário com melhor cenário, predição e custo da busca
         """
-        # Buscar dados originais (sem transformações)
-        df = ETLService.get_crianca_timeline()
-        if df.empty:
-            return {}
+        inicio = time.perf_counter()
+        frequencias = np.asarray(sorted(set(frequencias or [3.0])), dtype=np.float64)
         
-        # Computar apenas as features necessárias (DeltaZScore)
-        df = df.sort_values(['CriancaId', 'DataConsulta'])
-        df['ZScoreAnterior'] = df.groupby('CriancaId')['ZScorePeso'].shift(1)
-        df['DeltaZScore'] = df['ZScorePeso'] - df['ZScoreAnterior']
+        e_lo, e_hi = energia_min, energia_max
+        p_lo, p_hi = proteina_min, proteina_max
+        melhor_delta = -np.inf
+        melhor = None
+        n_avaliacoes = 0
+        n_lotes = 0
+        
+        for _ in range(n_refinamentos + 1):
+            energias = np.linspace(e_lo, e_hi, n_pontos)
+            proteinas = np.linspace(p_lo, p_hi, n_pontos)
+            
+            grid = growth_predictor.predict_diet_grid(
+                crianca_features=crianca_perfil,
+                energias=energias,
+                proteinas=proteinas,
+                frequencias=frequencias
+            )
+            n_avaliacoes += grid.size
+            n_lotes += 1
+            
+            i_freq, i_energia, i_proteina = np.unravel_index(np.argmax(grid), grid.shape)
+            if grid[i_freq, i_energia, i_proteina] > melhor_delta:
+                melhor_delta = float(grid[i_freq, i_energia, i_proteina])
+                melhor = (energias[i_energia], proteinas[i_proteina], frequencias[i_freq])
+            
+            # Refinar em torno do melhor ponto (± um passo da grade atual)
+            passo_e = (e_hi - e_lo) / (n_pontos - 1)
+            passo_p = (p_hi - p_lo) / (n_pontos - 1)
+            if passo_e == 0 and passo_p == 0:
+                break
+            e_lo, e_hi = max(energia_min, melhor[0] - passo_e), min(energia_max, melhor[0] + passo_e)
+            p_lo, p_hi = max(proteina_min, melhor[1] - passo_p), min(proteina_max, melhor[1] + passo_p)
         
-        if classification_ig:
-            df = df[df['ClassificacaoIG'] == classification_ig]
+        cenario_busca = {
+            'TaxaEnergeticaKcalKg': float(melhor[0]),
+            'MetaProteinaGKg': float(melhor[1]),
+            'FrequenciaHoras': float(melhor[2]),
+        }
         
-        if df.empty:
-            return {}
+        # Predição completa (intervalo, probabilidade) no ponto exato da busca
+        predicao = growth_predictor.predict_zscore_change(
+            crianca_features={**crianca_perfil, **cenario_busca},
+            dieta_features=cenario_busca,
+            horizonte_dias=horizonte_dias
+        )
         
-        # Filtrar apenas casos com sucesso (delta z-score positivo)
-        df_sucesso = df[df['DeltaZScore'] > 0.1]
-        
-        patterns = {
-            'total_casos': len(df),
-            'casos_sucesso': len(df_sucesso),
-            'taxa_sucesso': len(df_sucesso) / len(df) if len(df) > 0 else 0,
-            'energia': {
-                'media': float(df_sucesso['TaxaEnergeticaKcalKg'].mean()) if len(df_sucesso) > 0 else 0,
-                'mediana': float(df_sucesso['TaxaEnergeticaKcalKg'].median()) if len(df_sucesso) > 0 else 0,
-                'q25': float(df_sucesso['TaxaEnergeticaKcalKg'].quantile(0.25)) if len(df_sucesso) > 0 else 0,
-                'q75': float(df_sucesso['TaxaEnergeticaKcalKg'].quantile(0.75)) if len(df_sucesso) > 0 else 0,
-            },
-            'proteina': {
-                'media': float(df_sucesso['MetaProteinaGKg'].mean()) if len(df_sucesso) > 0 else 0,
-                'mediana': float(df_sucesso['MetaProteinaGKg'].median()) if len(df_sucesso) > 0 else 0,
-                'q25': float(df_sucesso['MetaProteinaGKg'].quantile(0.25)) if len(df_sucesso) > 0 else 0,
-                'q75': float(df_sucesso['MetaProteinaGKg'].quantile(0.75)) if len(df_sucesso) > 0 else 0,
-            },
-            'delta_zscore_medio': float(df_sucesso['DeltaZScore'].mean()) if len(df_sucesso) > 0 else 0,
+        # Arredondado só para exibição, sem sair dos limites pedidos
+        melhor_cenario = {
+            'TaxaEnergeticaKcalKg': min(max(round(cenario_busca['TaxaEnergeticaKcalKg'], 2), energia_min), energia_max),
+            'MetaProteinaGKg': min(max(round(cenario_busca['MetaProteinaGKg'], 3), proteina_min), proteina_max),
+            'FrequenciaHoras': cenario_busca['FrequenciaHoras'],
         }
+        n_avaliacoes += 1
         
-        return patterns
+        return {
+            'cenario': melhor_cenario,
+            'predicao': predicao,
+            'custo_busca': {
+                'n_avaliacoes': int(n_avaliacoes),
+                'n_lotes': n_lotes,
+                'tempo_ms': (time.perf_counter() - inicio) * 1000
+            }
+        }
+    
+    def get_diet_patterns(
+        self,
+        classification_ig: Optional[str] = None,
+        sexo: Optional[str] = None,
+        classificacao_peso: Optional[str] = None
+    ) -> Dict:
+        """
+        Analisa padrões de dieta por classificação IG
+        
+        Responde a partir dos agregados por estrato mantidos em memória
+        (ver app.services.diet_patterns); quantis são aproximados pela
+        resolução dos histogramas.
+        
+        Args:
+            classification_ig: Filtrar por classificação específica
+            sexo: Filtrar por sexo ('M' ou 'F')
+            classificacao_peso: Filtrar por classificação de peso ao nascer
+            
+        Returns:
+            Dicionário com padrões encontrados
+        """
+        return get_diet_pattern_aggregates().get_patterns(
+            classificacao_ig=classification_ig,
+            sexo=sexo,
+            classificacao_peso=classificacao_peso
+        )
 
 
 # Instância global (singleton)
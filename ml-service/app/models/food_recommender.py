@@ -3,18 +3,70 @@ Modelo de ML para recomendação de alimentos baseado em perfil da criança
 """
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import StandardScaler
-from typing import Dict, List, Optional
+from sklearn.model_selection import cross_val_score
+from typing import Dict, Iterator, List, Optional
+from threading import Lock
 import logging
 import joblib
 import os
+import tempfile
+import time
 from datetime import datetime
 
-from app.database import execute_query
+from app.config import settings
+from app.models.forest_engine import FlatForest
+from app.database import execute_query, iter_query
+from app.services.diet_episode_service import get_diet_episode_table
+from app.services.training_snapshot import ColumnarSnapshot
 
 logger = logging.getLogger(__name__)
 
+# Esquema do snapshot de treinamento (colunas de _food_usage_query)
+USAGE_SNAPSHOT_SCHEMA = {
+    'AlimentoId': 'str',
+    'AlimentoNome': 'str',
+    'Categoria': 'str',
+    'EnergiaKcalPor100': 'float',
+    'ProteinaGPor100': 'float',
+    'EhPreTermo': 'bool',
+    'Sexo': 'str',
+    'IdadeGestacionalSemanas': 'float',
+    'PesoNascimentoGr': 'float',
+    'ClassificacaoIG': 'str',
+    'ClassificacaoPeso': 'str',
+    'Quantidade': 'float',
+    'DataInicio': 'datetime',
+    'TaxaEnergeticaKcalKg': 'float',
+    'MetaProteinaGKg': 'float',
+    'DataInicial': 'datetime',
+    'PesoInicial': 'float',
+    'ZScoreInicial': 'float',
+    'DataFinal': 'datetime',
+    'PesoFinal': 'float',
+    'ZScoreFinal': 'float',
+    'DiasDeVida': 'float',
+    'DiasAcompanhamento': 'float',
+}
+
+# Features numéricas, na ordem do modelo
+NUMERIC_FEATURES = [
+    'IdadeGestacionalSemanas', 'PesoNascimentoGr', 'SexoNumerico',
+    'DiasDeVida', 'ZScoreInicial',
+    'EnergiaKcalPor100', 'ProteinaGPor100', 'Quantidade',
+    'TaxaEnergeticaKcalKg', 'MetaProteinaGKg',
+    'EhPreTermo'
+]
+
+# Colunas categóricas codificadas em one-hot e o prefixo de suas features
+ONE_HOT_FEATURES = {
+    'ClassificacaoIG': 'ClassIG',
+    'ClassificacaoPeso': 'ClassPeso',
+    'Categoria': 'Cat',
+}
+
 
 class FoodRecommender:
     """
@@ -25,13 +77,27 @@ class FoodRecommender:
     def __init__(self, model_path: str = "./models/food_recommender.joblib"):
         self.model_path = model_path
         self.model = None
-        self.scaler = StandardScaler()
+        # Floresta achatada em arrays mapeados em memória, usada na inferência
+        self.forest = None
+        self.forest_path = os.path.splitext(model_path)[0] + "_forest"
         self.feature_columns = []
+        self.vocabulario = {}  # Mapa: coluna categórica -> categorias one-hot
         self.alimento_encoder = {}  # Mapa: alimentoId -> índice
         self.alimento_decoder = {}  # Mapa: índice -> alimentoId
         self.metrics = {}
         self.trained_at = None
         
+        # Catálogo de alimentos ativos em memória (ver get_catalog)
+        self._catalog = None
+        self._catalog_lock = Lock()
+        
+        # Snapshot colunar dos episódios de treinamento (ver refresh_usage_snapshot)
+        self.usage_snapshot = ColumnarSnapshot(
+            os.path.join(settings.DATA_PATH, "food_usage_snapshot"),
+            USAGE_SNAPSHOT_SCHEMA,
+            watermark_column='DataFinal'
+        )
+        
         # Tentar carregar modelo existente
         if os.path.exists(model_path):
             try:
@@ -40,11 +106,17 @@ class FoodRecommender:
             except Exception as e:
                 logger.warning(f"Não foi possível carregar modelo: {e}")
     
-    def get_food_usage_data(self) -> pd.DataFrame:
+    @staticmethod
+    def _food_usage_query(incremental: bool = False) -> str:
         """
-        Extrai dados de uso de alimentos com resultados
+        Query de episódios de uso de alimentos com resultados
+        
+        Args:
+            incremental: Restringir a episódios com consulta final após :desde
         """
-        query = """
+        filtro = "AND c_final.DataHora > :desde" if incremental else ""
+        
+        return f"""
         SELECT 
             a.Id as AlimentoId,
             a.Nome as AlimentoNome,
@@ -100,14 +172,84 @@ class FoodRecommender:
         ) c_final
         
         WHERE c_final.ZScorePeso IS NOT NULL
+        {filtro}
         """
+    
+    def get_food_usage_data(self) -> pd.DataFrame:
+        """
+        Extrai dados de uso de alimentos com resultados
+        """
+        return execute_query(self._food_usage_query())
+    
+    def iter_food_usage_data(self, desde: Optional[datetime] = None) -> Iterator[pd.DataFrame]:
+        """
+        Extrai dados de uso de alimentos em blocos (sem materializar o resultado)
         
-        df = execute_query(query)
-        return df
+        Args:
+            desde: Apenas episódios com consulta final após esta data
+        """
+        params = {'desde': desde} if desde is not None else None
+        return iter_query(
+            self._food_usage_query(incremental=desde is not None),
+            params,
+            chunksize=settings.FOOD_USAGE_SNAPSHOT_CHUNK_ROWS
+        )
+    
+    def refresh_usage_snapshot(self, full: bool = False) -> Dict:
+        """
+        Atualiza o snapshot dos dados de treinamento
+        
+        Args:
+            full: Reextrair todo o histórico em uma nova versão (padrão:
+                acrescentar apenas episódios com consulta final após o watermark)
+        
+        Returns:
+            Metadados do snapshot
+        """
+        inicio = time.perf_counter()
+        watermark = self.usage_snapshot.watermark
+        incremental = not full and self.usage_snapshot.manifest is not None
+        
+        if incremental:
+            n_antes = self.usage_snapshot.manifest['n_linhas']
+            manifest = self.usage_snapshot.append(self.iter_food_usage_data(desde=watermark))
+        else:
+            n_antes = 0
+            manifest = self.usage_snapshot.rebuild(self.iter_food_usage_data())
+        
+        info = {
+            'modo': 'incremental' if incremental else 'full',
+            'versao': manifest['versao'],
+            'n_novas': manifest['n_linhas'] - n_antes,
+            'n_linhas': manifest['n_linhas'],
+            'n_partes': len(manifest['partes']),
+            'watermark': manifest['watermark'],
+            'tempo_s': round(time.perf_counter() - inicio, 2),
+        }
+        logger.info(f"Snapshot de uso de alimentos atualizado: {info}")
+        return info
+    
+    def snapshot_info(self) -> Optional[Dict]:
+        """Metadados do snapshot atual (None se ainda não extraído)"""
+        manifest = self.usage_snapshot.manifest
+        if manifest is None:
+            return None
+        return {
+            'versao': manifest['versao'],
+            'n_linhas': manifest['n_linhas'],
+            'n_partes': len(manifest['partes']),
+            'watermark': manifest['watermark'],
+            'criado_em': manifest['criado_em'],
+            'atualizado_em': manifest['atualizado_em'],
+        }
     
     def prepare_features(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Prepara features para treinamento ou predição
+        
+        Calcula as colunas derivadas, preenche ausentes nas numéricas e fixa
+        o vocabulário das colunas one-hot e a ordem de feature_columns; a
+        matriz é montada por encode_features.
         """
         df = df.copy()
         
@@ -123,52 +265,87 @@ class FoodRecommender:
         # Converter sexo para numérico
         df['SexoNumerico'] = df['Sexo'].map({'M': 0, 'F': 1})
         
-        # One-hot encoding para classificações
-        if 'ClassificacaoIG' in df.columns:
-            df = pd.get_dummies(df, columns=['ClassificacaoIG'], prefix='ClassIG', drop_first=False, dummy_na=True)
-        
-        if 'ClassificacaoPeso' in df.columns:
-            df = pd.get_dummies(df, columns=['ClassificacaoPeso'], prefix='ClassPeso', drop_first=False, dummy_na=True)
-        
-        # One-hot encoding para categoria de alimento
-        if 'Categoria' in df.columns:
-            df = pd.get_dummies(df, columns=['Categoria'], prefix='Cat', drop_first=False, dummy_na=True)
-        
-        # Features finais
-        feature_cols = [
-            'IdadeGestacionalSemanas', 'PesoNascimentoGr', 'SexoNumerico',
-            'DiasDeVida', 'ZScoreInicial',
-            'EnergiaKcalPor100', 'ProteinaGPor100', 'Quantidade',
-            'TaxaEnergeticaKcalKg', 'MetaProteinaGKg',
-            'EhPreTermo'
-        ]
-        
-        # Adicionar colunas de classificação (one-hot)
-        for col in df.columns:
-            if col.startswith('ClassIG_') or col.startswith('ClassPeso_') or col.startswith('Cat_'):
-                feature_cols.append(col)
-        
-        # Filtrar apenas colunas que existem
-        feature_cols = [c for c in feature_cols if c in df.columns]
-        self.feature_columns = feature_cols
+        # Features numéricas existentes
+        feature_cols = [c for c in NUMERIC_FEATURES if c in df.columns]
         
         # Preencher valores faltantes
         for col in feature_cols:
             if df[col].dtype in [np.float64, np.int64]:
-                df[col] = df[col].fillna(df[col].median())
+                # Coluna toda ausente não tem mediana: fica constante em 0 (a
+                # floresta esparsa não aceita NaN e não dividiria por ela)
+                df[col] = df[col].fillna(df[col].median()).fillna(0)
             else:
                 df[col] = df[col].fillna(0)
         
+        # Vocabulário fixo das colunas one-hot (categorias em ordem, mais a
+        # coluna de ausentes), nos mesmos nomes de pd.get_dummies(dummy_na=True)
+        self.vocabulario = {
+            col: sorted(df[col].dropna().unique().tolist())
+            for col in ONE_HOT_FEATURES if col in df.columns
+        }
+        for col, prefixo in ONE_HOT_FEATURES.items():
+            if col in self.vocabulario:
+                feature_cols += [f"{prefixo}_{valor}" for valor in self.vocabulario[col]] + [f"{prefixo}_nan"]
+        
+        self.feature_columns = feature_cols
+        
         return df
     
-    def train(self, horizonte_dias: int = 14) -> Dict:
+    def encode_features(self, df: pd.DataFrame) -> sparse.csc_matrix:
+        """
+        Matriz esparsa (float32) de features na ordem de feature_columns
+        
+        As numéricas entram com seus valores; cada coluna categórica vira um
+        1 na coluna da sua categoria no vocabulário (ou na coluna '_nan' se
+        ausente). Categorias fora do vocabulário ficam sem coluna ativa, como
+        as colunas descartadas no reindex do one-hot denso.
+        """
+        n = len(df)
+        numericas = [c for c in NUMERIC_FEATURES if c in self.feature_columns]
+        blocos = [sparse.csc_matrix(df[numericas].to_numpy(dtype=np.float32))]
+        
+        for col in ONE_HOT_FEATURES:
+            if col not in self.vocabulario:
+                continue
+            categorias = self.vocabulario[col]
+            codigos = pd.Categorical(df[col], categories=categorias).codes.astype(np.int64)
+            codigos[df[col].isna().to_numpy()] = len(categorias)
+            ativos = codigos >= 0
+            blocos.append(sparse.csc_matrix(
+                (np.ones(ativos.sum(), dtype=np.float32), (np.flatnonzero(ativos), codigos[ativos])),
+                shape=(n, len(categorias) + 1)
+            ))
+        
+        return sparse.hstack(blocos, format='csc', dtype=np.float32)
+    
+    def train(self, horizonte_dias: int = 14, snapshot: str = "incremental") -> Dict:
         """
         Treina modelo de classificação: alimento X + perfil Y -> sucesso?
+        
+        Os dados vêm do snapshot colunar em DATA_PATH, atualizado antes do
+        treino conforme `snapshot`: 'incremental' (só episódios novos),
+        'full' (reextrai todo o histórico) ou 'none' (usa o snapshot como está).
         """
         logger.info("Iniciando treinamento do recomendador de alimentos")
         
+        if snapshot not in ("incremental", "full", "none"):
+            raise ValueError(f"Modo de snapshot inválido: {snapshot}")
+        
+        tempos = {}
+        inicio = time.perf_counter()
+        
+        def etapa(nome: str):
+            nonlocal inicio
+            agora = time.perf_counter()
+            tempos[nome] = round(agora - inicio, 3)
+            inicio = agora
+        
         # Carregar dados
-        df = self.get_food_usage_data()
+        if snapshot != "none" or self.usage_snapshot.manifest is None:
+            self.refresh_usage_snapshot(full=snapshot == "full")
+            etapa('snapshot')
+        df = self.usage_snapshot.read()
+        etapa('leitura')
         
         if df.empty or len(df) < 50:
             logger.warning(f"Dados insuficientes para treinamento: {len(df)} amostras")
@@ -184,9 +361,14 @@ class FoodRecommender:
         self.alimento_encoder = {str(alimento): idx for idx, alimento in enumerate(alimentos_unicos)}
         self.alimento_decoder = {idx: str(alimento) for alimento, idx in self.alimento_encoder.items()}
         
-        # Preparar X e y
-        X = df[self.feature_columns].values
+        # Preparar X e y (esparsa em float32/CSC, o formato usado
+        # internamente pelas árvores, para não haver cópia por ajuste)
+        X = self.encode_features(df)
+        if np.isnan(X.data).any():
+            raise ValueError("Features de treinamento contêm valores ausentes (NaN)")
         y = df['Sucesso'].values  # 1 = sucesso (Δ Z-Score > 0), 0 = não sucesso
+        del df
+        etapa('features')
         
         # Treinar modelo
         self.model = RandomForestClassifier(
@@ -199,28 +381,46 @@ class FoodRecommender:
         )
         
         self.model.fit(X, y)
-        self.scaler.fit(X)
-        
-        # Calcular métricas
-        from sklearn.model_selection import cross_val_score
-        cv_scores = cross_val_score(self.model, X, y, cv=5, scoring='accuracy')
+        accuracy = float(self.model.score(X, y))
+        etapa('fit')
+        
+        # Validação cruzada: folds em processos paralelos lendo X de um
+        # arquivo mapeado em memória (sem cópia por worker); cada floresta do
+        # fold usa uma thread para não disputar núcleos com os demais folds
+        with tempfile.TemporaryDirectory(prefix="food_recommender_cv_") as tmp:
+            X_path = os.path.join(tmp, "X.joblib")
+            joblib.dump(X, X_path)
+            X_mmap = joblib.load(X_path, mmap_mode='r')
+            
+            cv_scores = cross_val_score(
+                clone(self.model).set_params(n_jobs=1),
+                X_mmap, y,
+                cv=5,
+                scoring='accuracy',
+                n_jobs=settings.FOOD_RECOMMENDER_CV_N_JOBS
+            )
+            del X_mmap
+        etapa('cv')
         
         self.metrics = {
-            'accuracy': float(self.model.score(X, y)),
+            'accuracy': accuracy,
             'cv_accuracy_mean': float(cv_scores.mean()),
             'cv_accuracy_std': float(cv_scores.std()),
-            'n_samples': len(X),
+            'n_samples': X.shape[0],
             'n_alimentos': len(alimentos_unicos),
-            'n_features': len(self.feature_columns)
+            'n_features': len(self.feature_columns),
+            'snapshot_versao': self.usage_snapshot.manifest['versao'],
+            'tempos_s': tempos
         }
         
         self.trained_at = datetime.now()
         
-        logger.info(f"Modelo treinado - Accuracy: {self.metrics['accuracy']:.3f}, "
-                   f"CV Accuracy: {self.metrics['cv_accuracy_mean']:.3f}")
-        
         # Salvar modelo
         self.save_model()
+        etapa('salvar')
+        
+        logger.info(f"Modelo treinado - Accuracy: {self.metrics['accuracy']:.3f}, "
+                   f"CV Accuracy: {self.metrics['cv_accuracy_mean']:.3f}, tempos (s): {tempos}")
         
         return self.metrics
     
@@ -239,80 +439,84 @@ class FoodRecommender:
         Returns:
             Lista de alimentos ranqueados por probabilidade de sucesso
         """
-        if self.model is None:
-            raise ValueError("Modelo não treinado. Execute train() primeiro.")
+        return self.recommend_foods_batch([crianca_perfil], top_n)[0]
+    
+    def recommend_foods_batch(
+        self,
+        perfis: List[Dict],
+        top_n: int = 10,
+        chunk_rows: Optional[int] = None
+    ) -> List[List[Dict]]:
+        """
+        Recomenda alimentos para vários perfis de criança
         
-        # Buscar todos os alimentos disponíveis
-        query = """
-        SELECT 
-            Id as AlimentoId,
-            Nome,
-            Categoria,
-            EnergiaKcalPor100,
-            ProteinaGPor100,
-            EhPreTermo
-        FROM nutricao.Alimento
-        WHERE Ativo = 1 AND Excluido = 0
+        O produto criança × alimento é pontuado como uma única matriz por
+        bloco de crianças, com no máximo chunk_rows linhas por bloco.
+        
+        Args:
+            perfis: Características de cada criança
+            top_n: Número de alimentos a recomendar por criança
+            chunk_rows: Linhas (criança × alimento) por bloco
+                (padrão: settings.FOOD_RECOMMENDATION_CHUNK_ROWS)
+            
+        Returns:
+            Uma lista de alimentos ranqueados por perfil, na ordem recebida
         """
+        if self.model is None:
+            raise ValueError("Modelo não treinado. Execute train() primeiro.")
         
-        alimentos_df = execute_query(query)
+        catalogo = self.get_catalog()
+        n_alimentos = catalogo['n_alimentos']
         
-        if alimentos_df.empty:
+        if n_alimentos == 0:
             logger.warning("Nenhum alimento encontrado para recomendação")
-            return []
-        
-        # Criar features para cada alimento com o perfil da criança
-        recomendacoes = []
-        
-        for _, alimento in alimentos_df.iterrows():
-            # Combinar perfil da criança com características do alimento
-            features = {
-                'IdadeGestacionalSemanas': crianca_perfil.get('idade_gestacional_semanas', 37),
-                'PesoNascimentoGr': crianca_perfil.get('peso_atual_gr', 3000),
-                'SexoNumerico': 0 if crianca_perfil.get('sexo', 'M') == 'M' else 1,
-                'DiasDeVida': crianca_perfil.get('dias_de_vida', 0),
-                'ZScoreInicial': crianca_perfil.get('zscore_atual', 0),
-                'EnergiaKcalPor100': float(alimento['EnergiaKcalPor100']),
-                'ProteinaGPor100': float(alimento['ProteinaGPor100']),
-                'Quantidade': 100.0,  # Quantidade padrão
-                'TaxaEnergeticaKcalKg': 120.0,  # Padrão
-                'MetaProteinaGKg': 3.0,  # Padrão
-                'EhPreTermo': int(alimento['EhPreTermo'])
-            }
-            
-            # Criar DataFrame com features
-            X = pd.DataFrame([features])
-            
-            # Adicionar colunas de classificação que faltam (preencher com 0)
-            for col in self.feature_columns:
-                if col not in X.columns:
-                    X[col] = 0
-            
-            # Garantir ordem correta das colunas
-            X = X[self.feature_columns]
+            return [[] for _ in perfis]
+        
+        chunk_rows = chunk_rows or settings.FOOD_RECOMMENDATION_CHUNK_ROWS
+        por_bloco = max(1, chunk_rows // n_alimentos)
+        
+        resultados = []
+        for inicio in range(0, len(perfis), por_bloco):
+            bloco = perfis[inicio:inicio + por_bloco]
             
-            # Predizer probabilidade de sucesso
             try:
-                prob_sucesso = self.model.predict_proba(X)[0][1]  # Probabilidade da classe "sucesso"
+                X = self.build_feature_matrix(bloco, catalogo)
+                prob_sucesso = self._predict_proba(X)[:, 1].reshape(len(bloco), n_alimentos)
             except Exception as e:
-                logger.warning(f"Erro ao predizer para alimento {alimento['Nome']}: {e}")
-                prob_sucesso = 0.5  # Fallback
+                # Isolar a criança (e o alimento) que falhou
+                logger.warning(f"Erro ao predizer bloco de {len(bloco)} crianças: {e}")
+                prob_sucesso = [
+                    self._predict_success(self.build_feature_matrix([perfil], catalogo)) for perfil in bloco
+                ]
             
-            recomendacoes.append({
-                'alimento_id': str(alimento['AlimentoId']),
-                'nome': alimento['Nome'],
-                'categoria': alimento['Categoria'],
-                'probabilidade_sucesso': float(prob_sucesso),
-                'energia_kcal_por_100': float(alimento['EnergiaKcalPor100']),
-                'proteina_g_por_100': float(alimento['ProteinaGPor100']),
-                'eh_pre_termo': bool(alimento['EhPreTermo'])
-            })
-        
-        # Ordenar por probabilidade e retornar top N
-        recomendacoes.sort(key=lambda x: x['probabilidade_sucesso'], reverse=True)
+            for perfil, prob in zip(bloco, prob_sucesso):
+                resultados.append(self._format_recommendations(perfil, catalogo, prob, top_n))
+        
+        return resultados
+    
+    def _format_recommendations(
+        self, crianca_perfil: Dict, catalogo: Dict, prob_sucesso: np.ndarray, top_n: int
+    ) -> List[Dict]:
+        """Top N alimentos de uma criança com ranking e justificativa"""
+        # Top N por probabilidade (maior primeiro; empates na ordem do catálogo)
+        selecionados = self._top_n(prob_sucesso, top_n)
+        
+        colunas = {col: valores[selecionados] for col, valores in catalogo['colunas'].items()}
+        recomendacoes = [
+            {
+                'alimento_id': str(colunas['AlimentoId'][i]),
+                'nome': colunas['Nome'][i],
+                'categoria': colunas['Categoria'][i],
+                'probabilidade_sucesso': float(prob_sucesso[selecionados[i]]),
+                'energia_kcal_por_100': float(colunas['EnergiaKcalPor100'][i]),
+                'proteina_g_por_100': float(colunas['ProteinaGPor100'][i]),
+                'eh_pre_termo': bool(colunas['EhPreTermo'][i])
+            }
+            for i in range(len(selecionados))
+        ]
         
         # Adicionar ranking e justificativa
-        for idx, rec in enumerate(recomendacoes[:top_n]):
+        for idx, rec in enumerate(recomendacoes):
             rec['ranking'] = idx + 1
             
             # Justificativa baseada em características
@@ -335,87 +539,260 @@ class FoodRecommender:
             
             rec['justificativa'] = ". ".join(justificativa) + "."
         
-        return recomendacoes[:top_n]
+        return recomendacoes
     
-    def analyze_food_effectiveness(
-        self,
-        alimento_id: str,
-        perfil_filter: Optional[Dict] = None
-    ) -> Dict:
-        """
-        Analisa efetividade de um alimento específico para um perfil
+    def build_feature_matrix(self, perfis: List[Dict], catalogo: Optional[Dict] = None) -> sparse.csr_matrix:
         """
-        # Buscar histórico de uso do alimento
-        filter_clause = f"AND a.Id = '{alimento_id}'"
+        Matriz de features do produto criança × alimento
         
-        if perfil_filter:
-            if perfil_filter.get('classificacao_ig'):
-                filter_clause += f" AND rn.ClassificacaoIG = '{perfil_filter['classificacao_ig']}'"
-            if perfil_filter.get('sexo'):
-                filter_clause += f" AND rn.Sexo = '{perfil_filter['sexo']}'"
+        Parte do bloco esparso de features dos alimentos (pré-calculado por
+        catálogo), repetido para cada criança, e soma as colunas do perfil;
+        colunas do modelo ausentes (classificações e categorias one-hot)
+        ficam com 0 implícito.
         
-        query = f"""
-        SELECT 
-            COUNT(*) as TotalUsos,
-            AVG((c_final.ZScorePeso - c_inicial.ZScorePeso)) as MediaDeltaZScore,
-            AVG((c_final.PesoKg - c_inicial.PesoKg) * 1000 / 
-                DATEDIFF(day, c_inicial.DataHora, c_final.DataHora)) as MediaGanhoPeso,
-            SUM(CASE WHEN (c_final.ZScorePeso - c_inicial.ZScorePeso) > 0 THEN 1 ELSE 0 END) * 100.0 / COUNT(*) as TaxaSucesso
+        Args:
+            perfis: Características de cada criança
+            catalogo: Catálogo de alimentos (padrão: get_catalog())
             
-        FROM nutricao.Alimento a
-        INNER JOIN nutricao.DietaItem di ON a.Id = di.AlimentoId
-        INNER JOIN nutricao.Dieta d ON di.DietaId = d.Id
-        INNER JOIN clinica.RecemNascido rn ON d.RecemNascidoId = rn.Id
+        Returns:
+            Matriz esparsa (n_perfis * n_alimentos, feature_columns); as
+            linhas de cada criança são consecutivas, na ordem do catálogo
+        """
+        catalogo = catalogo or self.get_catalog()
+        bloco = self._food_feature_block(catalogo)
+        n_alimentos = bloco.shape[0]
+        n_linhas = len(perfis) * n_alimentos
+        
+        X = bloco if len(perfis) == 1 else bloco[np.tile(np.arange(n_alimentos), len(perfis))]
+        
+        colunas_perfil = {
+            'IdadeGestacionalSemanas': [p.get('idade_gestacional_semanas', 37) for p in perfis],
+            'PesoNascimentoGr': [p.get('peso_atual_gr', 3000) for p in perfis],
+            'SexoNumerico': [0 if p.get('sexo', 'M') == 'M' else 1 for p in perfis],
+            'DiasDeVida': [p.get('dias_de_vida', 0) for p in perfis],
+            'ZScoreInicial': [p.get('zscore_atual', 0) for p in perfis],
+        }
+        colunas_perfil = {
+            self.feature_columns.index(col): valores
+            for col, valores in colunas_perfil.items() if col in self.feature_columns
+        }
+        if not colunas_perfil:
+            return X.tocsr()
+        
+        # Valores do perfil repetidos para cada alimento (None vira NaN)
+        valores = np.repeat(np.array(list(colunas_perfil.values()), dtype=np.float32).T, n_alimentos, axis=0)
+        perfil = sparse.csr_matrix(
+            (valores.ravel(), np.tile(list(colunas_perfil), n_linhas), np.arange(n_linhas + 1) * len(colunas_perfil)),
+            shape=(n_linhas, len(self.feature_columns))
+        )
+        return (X + perfil).tocsr()
+    
+    def _food_feature_block(self, catalogo: Dict) -> sparse.csr_matrix:
+        """
+        Colunas de features que dependem só do alimento, já na ordem do modelo
         
-        CROSS APPLY (
-            SELECT TOP 1 * FROM clinica.Consulta
-            WHERE RecemNascidoId = rn.Id 
-            AND DataHora >= d.DataInicio
-            AND ZScorePeso IS NOT NULL
-            ORDER BY DataHora
-        ) c_inicial
+        Calculado uma vez por catálogo e conjunto de features do modelo;
+        colunas do perfil da criança ficam vazias até build_feature_matrix.
+        """
+        chave = tuple(self.feature_columns)
+        bloco = catalogo.get('features')
+        if bloco is not None and bloco[0] == chave:
+            return bloco[1]
+        
+        colunas = catalogo['colunas']
+        n = catalogo['n_alimentos']
+        features = pd.DataFrame({
+            'EnergiaKcalPor100': colunas['EnergiaKcalPor100'].astype(np.float64),
+            'ProteinaGPor100': colunas['ProteinaGPor100'].astype(np.float64),
+            'Quantidade': np.full(n, 100.0),  # Quantidade padrão
+            'TaxaEnergeticaKcalKg': np.full(n, 120.0),  # Padrão
+            'MetaProteinaGKg': np.full(n, 3.0),  # Padrão
+            'EhPreTermo': colunas['EhPreTermo'].astype(np.int64)
+        })
+        features = features[[c for c in features.columns if c in self.feature_columns]]
+        
+        valores = features.to_numpy(dtype=np.float32)
+        linhas, posicoes = np.nonzero(valores != 0)
+        indices = np.array([self.feature_columns.index(c) for c in features.columns], dtype=np.int64)
+        features = sparse.csr_matrix(
+            (valores[linhas, posicoes], (linhas, indices[posicoes])),
+            shape=(n, len(self.feature_columns))
+        )
         
-        CROSS APPLY (
-            SELECT TOP 1 * FROM clinica.Consulta
-            WHERE RecemNascidoId = rn.Id 
-            AND DataHora > c_inicial.DataHora
-            AND DATEDIFF(day, c_inicial.DataHora, DataHora) BETWEEN 7 AND 21
-            AND ZScorePeso IS NOT NULL
-            ORDER BY DataHora
-        ) c_final
+        catalogo['features'] = (chave, features)
+        return features
+    
+    def _catalog_version(self) -> tuple:
+        """Versão do catálogo: total de linhas, ativas e última alteração"""
+        query = """
+        SELECT 
+            COUNT(*) as Total,
+            SUM(CASE WHEN Ativo = 1 AND Excluido = 0 THEN 1 ELSE 0 END) as Ativos,
+            MAX(COALESCE(AtualizadoEm, CriadoEm)) as UltimaAlteracao
+        FROM nutricao.Alimento
+        """
         
-        WHERE a.Id = '{alimento_id}'
-        {filter_clause}
+        row = execute_query(query).iloc[0]
+        ultima = row['UltimaAlteracao']
+        return (
+            int(row['Total']),
+            int(row['Ativos']) if pd.notna(row['Ativos']) else 0,
+            None if pd.isna(ultima) else pd.Timestamp(ultima)
+        )
+    
+    def _load_catalog(self, versao: tuple) -> Dict:
+        """Carrega os alimentos ativos como arrays por coluna"""
+        query = """
+        SELECT 
+            Id as AlimentoId,
+            Nome,
+            Categoria,
+            EnergiaKcalPor100,
+            ProteinaGPor100,
+            EhPreTermo
+        FROM nutricao.Alimento
+        WHERE Ativo = 1 AND Excluido = 0
         """
         
-        result = execute_query(query)
+        alimentos_df = execute_query(query)
+        agora = time.monotonic()
+        
+        catalogo = {
+            'versao': versao,
+            'n_alimentos': len(alimentos_df),
+            'colunas': {col: alimentos_df[col].to_numpy() for col in alimentos_df.columns},
+            'carregado_em': datetime.now(),
+            'verificado_em': agora,
+        }
+        logger.info(f"Catálogo de alimentos carregado: {len(alimentos_df)} alimentos ativos")
+        return catalogo
+    
+    def get_catalog(self, force: bool = False) -> Dict:
+        """
+        Catálogo de alimentos ativos em memória
         
-        if result.empty:
-            return {
-                'alimento_id': alimento_id,
-                'total_usos': 0,
-                'media_delta_zscore': 0,
-                'media_ganho_peso': 0,
-                'taxa_sucesso': 0
-            }
+        A versão no banco (consulta agregada barata) é verificada no máximo a
+        cada FOOD_CATALOG_PROBE_SECONDS; o catálogo só é relido quando a
+        versão muda ou com force=True.
+        
+        Args:
+            force: Reler o catálogo sem verificar a versão
+            
+        Returns:
+            Dicionário com 'colunas' (arrays por coluna), 'n_alimentos' e 'versao'
+        """
+        catalogo = self._catalog
+        if not force and catalogo is not None and \
+                time.monotonic() - catalogo['verificado_em'] < settings.FOOD_CATALOG_PROBE_SECONDS:
+            return catalogo
+        
+        with self._catalog_lock:
+            # Outra requisição pode ter atualizado enquanto esperávamos
+            if not force and self._catalog is not catalogo:
+                return self._catalog
+            
+            versao = self._catalog_version()
+            if force or catalogo is None or catalogo['versao'] != versao:
+                self._catalog = self._load_catalog(versao)
+            else:
+                catalogo['verificado_em'] = time.monotonic()
+            
+            return self._catalog
+    
+    def refresh_catalog(self) -> Dict:
+        """Relê o catálogo de alimentos do banco e retorna seus metadados"""
+        self.get_catalog(force=True)
+        return self.catalog_info()
+    
+    def catalog_info(self) -> Dict:
+        """Metadados do catálogo em memória"""
+        catalogo = self._catalog
+        if catalogo is None:
+            return {'carregado': False}
         
-        row = result.iloc[0]
         return {
-            'alimento_id': alimento_id,
-            'total_usos': int(row['TotalUsos']),
-            'media_delta_zscore': float(row['MediaDeltaZScore']),
-            'media_ganho_peso': float(row['MediaGanhoPeso']),
-            'taxa_sucesso': float(row['TaxaSucesso'])
+            'carregado': True,
+            'n_alimentos': catalogo['n_alimentos'],
+            'ultima_alteracao': catalogo['versao'][2],
+            'carregado_em': catalogo['carregado_em'],
         }
     
+    def _predict_proba(self, X: sparse.csr_matrix) -> np.ndarray:
+        """
+        Probabilidades por classe
+        
+        Lotes de até FLAT_FOREST_MAX_ROWS linhas (uma criança contra o
+        catálogo) usam a floresta achatada, sem o overhead por chamada do
+        sklearn; lotes maiores usam o predict_proba do modelo, que percorre
+        as árvores em código compilado e multithread. Os resultados são
+        idênticos.
+        """
+        if self.forest is not None and X.shape[0] <= settings.FLAT_FOREST_MAX_ROWS:
+            return self.forest.predict_proba(X)
+        if sparse.issparse(X) and np.isnan(X.data).any():
+            # O sklearn só aceita ausentes (NaN) em entrada densa
+            X = X.toarray()
+        return self.model.predict_proba(X)
+    
+    def _predict_success(self, X: sparse.csr_matrix) -> np.ndarray:
+        """
+        Probabilidade da classe "sucesso" para cada linha, em uma única chamada
+        
+        Se o lote falhar, cada linha é predita isoladamente e as que falharem
+        recebem 0.5.
+        """
+        try:
+            return self._predict_proba(X)[:, 1]
+        except Exception as e:
+            logger.warning(f"Erro ao predizer em lote ({X.shape[0]} linhas): {e}")
+        
+        prob_sucesso = np.full(X.shape[0], 0.5)
+        for i in range(X.shape[0]):
+            try:
+                prob_sucesso[i] = self._predict_proba(X[i:i + 1])[0][1]
+            except Exception as e:
+                logger.warning(f"Erro ao predizer para linha {i}: {e}")
+        return prob_sucesso
+    
+    @staticmethod
+    def _top_n(scores: np.ndarray, top_n: int) -> np.ndarray:
+        """
+        Posições dos top_n maiores scores, em ordem decrescente
+        
+        Empates mantêm a ordem original (como uma ordenação estável).
+        """
+        if top_n <= 0 or len(scores) == 0:
+            return np.empty(0, dtype=np.int64)
+        if top_n < len(scores):
+            # Todos os empatados com o N-ésimo maior entram como candidatos
+            limiar = np.partition(scores, len(scores) - top_n)[len(scores) - top_n]
+            candidatos = np.flatnonzero(scores >= limiar)
+        else:
+            candidatos = np.arange(len(scores))
+        ordem = np.argsort(-scores[candidatos], kind='stable')
+        return candidatos[ordem[:top_n]]
+    
+    def analyze_food_effectiveness(
+        self,
+        alimento_id: str,
+        perfil_filter: Optional[Dict] = None
+    ) -> Dict:
+        """
+        Analisa efetividade de um alimento específico para um perfil
+        
+        Responde a partir da tabela de episódios de dieta em memória
+        (ver app.services.diet_episode_service), sem query por alimento.
+        """
+        return get_diet_episode_table().food_effectiveness(alimento_id, perfil_filter)
+    
     def save_model(self):
         """Salva modelo em disco"""
         os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
         
         model_data = {
             'model': self.model,
-            'scaler': self.scaler,
             'feature_columns': self.feature_columns,
+            'vocabulario': self.vocabulario,
             'alimento_encoder': self.alimento_encoder,
             'alimento_decoder': self.alimento_decoder,
             'metrics': self.metrics,
@@ -424,17 +801,42 @@ class FoodRecommender:
         
         joblib.dump(model_data, self.model_path)
         logger.info(f"Modelo de recomendação salvo em {self.model_path}")
+        
+        self.forest = self._load_forest()
+    
+    def _forest_version(self) -> Optional[str]:
+        return self.trained_at.isoformat() if self.trained_at else None
+    
+    def _load_forest(self) -> Optional[FlatForest]:
+        """
+        Carrega a floresta achatada do disco (mapeada em memória), gerando-a
+        a partir do modelo se estiver ausente ou for de outro treino
+        
+        Em caso de erro, a inferência volta a usar o modelo sklearn.
+        """
+        if self.model is None:
+            return None
+        
+        try:
+            versao = FlatForest.read_version(self.forest_path)
+            if versao is None or versao != self._forest_version():
+                FlatForest.from_sklearn(self.model).save(self.forest_path, versao=self._forest_version())
+            return FlatForest.load(self.forest_path, mmap=True)
+        except Exception as e:
+            logger.warning(f"Floresta achatada indisponível, usando predict_proba do modelo: {e}")
+            return None
     
     def load_model(self):
         """Carrega modelo do disco"""
         model_data = joblib.load(self.model_path)
         self.model = model_data['model']
-        self.scaler = model_data.get('scaler', StandardScaler())
         self.feature_columns = model_data['feature_columns']
+        self.vocabulario = model_data.get('vocabulario', {})
         self.alimento_encoder = model_data.get('alimento_encoder', {})
         self.alimento_decoder = model_data.get('alimento_decoder', {})
         self.metrics = model_data.get('metrics', {})
         self.trained_at = model_data.get('trained_at')
+        self.forest = self._load_forest()
         logger.info(f"Modelo de recomendação carregado de {self.model_path}")
 
 
@@ -0,0 +1,219 @@
+"""Inferência de florestas de decisão sobre arrays contíguos de nós"""
+import json
+import os
+import shutil
+from typing import Dict, Optional
+import logging
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+# Arrays de nós gravados em disco (um .npy por array, mapeáveis em memória)
+NODE_ARRAYS = ('feature', 'threshold', 'children', 'missing_left', 'value', 'roots')
+
+# Elementos (amostras × árvores) percorridos por bloco
+MAX_BLOCK_ELEMENTS = 1 << 20
+
+
+class FlatForest:
+    """
+    Floresta de classificação achatada em arrays de nós
+
+    Todos os nós de todas as árvores ficam em arrays únicos (feature,
+    threshold, filhos, direção dos ausentes e probabilidades por classe),
+    com índices globais; `roots` aponta o nó raiz de cada árvore e
+    `children` guarda os filhos intercalados (2·nó = esquerda, 2·nó + 1 =
+    direita). As folhas apontam para si mesmas, de modo que um lote de
+    amostras percorre todas as árvores ao mesmo tempo em `max_depth` passos
+    vetorizados.
+
+    As probabilidades são as mesmas de RandomForestClassifier.predict_proba:
+    X em float32 comparado com `<=` aos thresholds em float64, NaN seguindo
+    a direção aprendida no nó e média das folhas acumulada árvore a árvore.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], classes: np.ndarray, n_features: int, max_depth: int):
+        for nome in NODE_ARRAYS:
+            setattr(self, nome, arrays[nome])
+        self.classes_ = classes
+        self.n_features = n_features
+        self.max_depth = max_depth
+
+    @property
+    def n_trees(self) -> int:
+        return len(self.roots)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.feature)
+
+    @classmethod
+    def from_sklearn(cls, model) -> 'FlatForest':
+        """
+        Achata uma RandomForestClassifier treinada (saída única)
+
+        Args:
+            model: Floresta sklearn com estimators_ ajustados
+        """
+        if getattr(model, 'n_outputs_', 1) != 1:
+            raise ValueError("Apenas florestas com uma saída são suportadas")
+
+        n_classes = len(model.classes_)
+        partes = {nome: [] for nome in NODE_ARRAYS if nome != 'roots'}
+        roots = []
+        offset = 0
+
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            n = tree.node_count
+            folha = tree.children_left == -1
+            indices = np.arange(offset, offset + n)
+
+            partes['feature'].append(np.where(folha, 0, tree.feature))
+            partes['threshold'].append(np.where(folha, 0.0, tree.threshold))
+            partes['children'].append(np.stack([
+                np.where(folha, indices, tree.children_left + offset),
+                np.where(folha, indices, tree.children_right + offset),
+            ], axis=1).ravel())
+            missing = getattr(tree, 'missing_go_to_left', None)
+            partes['missing_left'].append(np.zeros(n, dtype=bool) if missing is None else np.asarray(missing, dtype=bool))
+            # Como DecisionTreeClassifier.predict_proba: frações de classe da folha
+            partes['value'].append(tree.value[:, 0, :n_classes])
+
+            roots.append(offset)
+            offset += n
+
+        arrays = {
+            'feature': np.concatenate(partes['feature']).astype(np.int32),
+            'threshold': np.concatenate(partes['threshold']).astype(np.float64),
+            'children': np.concatenate(partes['children']).astype(np.int32),
+            'missing_left': np.concatenate(partes['missing_left']),
+            'value': np.ascontiguousarray(np.concatenate(partes['value']), dtype=np.float64),
+            'roots': np.asarray(roots, dtype=np.int32),
+        }
+        max_depth = max(estimator.tree_.max_depth for estimator in model.estimators_)
+        return cls(arrays, np.asarray(model.classes_), int(model.n_features_in_), int(max_depth))
+
+    def save(self, path: str, versao: Optional[str] = None):
+        """
+        Grava os arrays em um diretório (substituído de forma atômica)
+
+        Args:
+            path: Diretório de destino
+            versao: Identificador gravado nos metadados (ex.: data do treino)
+        """
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        for nome in NODE_ARRAYS:
+            np.save(os.path.join(tmp, f'{nome}.npy'), getattr(self, nome))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({
+                'versao': versao,
+                'classes': self.classes_.tolist(),
+                'n_features': self.n_features,
+                'max_depth': self.max_depth,
+                'n_trees': self.n_trees,
+                'n_nodes': self.n_nodes,
+            }, f)
+
+        antigo = path + '.old'
+        shutil.rmtree(antigo, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, antigo)
+        os.replace(tmp, path)
+        shutil.rmtree(antigo, ignore_errors=True)
+
+        logger.info(f"Floresta achatada salva em {path} ({self.n_trees} árvores, {self.n_nodes} nós)")
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'FlatForest':
+        """
+        Carrega os arrays de um diretório gravado por save()
+
+        Args:
+            path: Diretório com os arrays
+            mmap: Mapear os arrays em memória (somente leitura, compartilhados
+                entre processos pelo cache de páginas)
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        modo = 'r' if mmap else None
+        # np.asarray mantém o mapeamento, mas evita o custo da subclasse memmap
+        # em cada operação
+        arrays = {
+            nome: np.asarray(np.load(os.path.join(path, f'{nome}.npy'), mmap_mode=modo))
+            for nome in NODE_ARRAYS
+        }
+        forest = cls(arrays, np.asarray(meta['classes']), meta['n_features'], meta['max_depth'])
+        forest.versao = meta.get('versao')
+        return forest
+
+    @staticmethod
+    def read_version(path: str) -> Optional[str]:
+        """Versão gravada em disco (None se não houver floresta salva)"""
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f).get('versao')
+
+    def _validate(self, X) -> np.ndarray:
+        if sparse.issparse(X):
+            X = X.toarray()
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"X deve ter {self.n_features} colunas, recebido shape {X.shape}")
+        if np.isinf(X).any():
+            raise ValueError("X contém valores infinitos")
+        return X
+
+    def apply(self, X) -> np.ndarray:
+        """
+        Folha alcançada por cada amostra em cada árvore
+
+        Returns:
+            Array (n_amostras, n_árvores) de índices globais de nós
+        """
+        X = self._validate(X)
+        n, n_features = X.shape
+        folhas = np.empty((n, self.n_trees), dtype=np.int32)
+        bloco = max(1, MAX_BLOCK_ELEMENTS // max(self.n_trees, 1))
+
+        for inicio in range(0, n, bloco):
+            Xb = X[inicio:inicio + bloco]
+            valores = Xb.ravel()
+            base = (np.arange(len(Xb), dtype=np.int32) * n_features)[:, None]
+            tem_nan = np.isnan(Xb).any()
+            node = np.broadcast_to(self.roots, (len(Xb), self.n_trees)).copy()
+
+            # Folhas apontam para si mesmas: max_depth passos levam todas as
+            # amostras até uma folha
+            for _ in range(self.max_depth):
+                x = valores[base + self.feature[node]]
+                direita = x > self.threshold[node]
+                if tem_nan:
+                    direita |= np.isnan(x) & ~self.missing_left[node]
+                node = self.children[2 * node + direita]
+
+            folhas[inicio:inicio + bloco] = node
+
+        return folhas
+
+    def predict_proba(self, X) -> np.ndarray:
+        """
+        Probabilidades por classe (mesma ordem de classes_)
+
+        Returns:
+            Array (n_amostras, n_classes)
+        """
+        folhas = self.apply(X)
+        proba = np.zeros((len(folhas), self.value.shape[1]), dtype=np.float64)
+        for t in range(self.n_trees):
+            proba += self.value[folhas[:, t]]
+        proba /= self.n_trees
+        return proba
@@ -7,7 +7,7 @@ from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 import xgboost as xgb
 import joblib
 import os
-from typing import Dict, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 import logging
 from datetime import datetime
 
@@ -51,19 +51,25 @@ class GrowthPredictor:
         self.model_path = model_path or os.path.join(settings.MODEL_PATH, 'growth_predictor.joblib')
         self.metrics = {}
         self.trained_at = None
+        self.data_watermark = None  # Data mais recente vista no treino (DataFutura)
         
         # Tentar carregar modelo existente
         if os.path.exists(self.model_path):
             self.load_model()
         else:
             logger.info("Nenhum modelo treinado encontrado. Criando novo modelo.")
-            self.model = xgb.XGBRegressor(
-                n_estimators=100,
-                max_depth=5,
-                learning_rate=0.1,
-                random_state=42,
-                n_jobs=-1
-            )
+            self.model = self._new_model()
+    
+    @staticmethod
+    def _new_model() -> xgb.XGBRegressor:
+        """Regressor com os hiperparâmetros de base do treino completo"""
+        return xgb.XGBRegressor(
+            n_estimators=100,
+            max_depth=5,
+            learning_rate=0.1,
+            random_state=42,
+            n_jobs=-1
+        )
     
     def prepare_features(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -133,7 +139,9 @@ class GrowthPredictor:
         
         logger.info(f"Treinando modelo com {len(X_train)} amostras de treino e {len(X_test)} de teste")
         
-        # Treinar modelo
+        # Treinar modelo (sempre do zero: após um treino incremental o modelo
+        # atual tem n_estimators da continuação)
+        self.model = self._new_model()
         self.model.fit(X_train, y_train)
         
         # Avaliar modelo
@@ -165,6 +173,8 @@ class GrowthPredictor:
         self.metrics['cv_mae_std'] = cv_scores.std()
         
         self.trained_at = datetime.now()
+        if 'DataFutura' in df_train.columns:
+            self.data_watermark = df_train['DataFutura'].max()
         
         logger.info(f"Modelo treinado - Test MAE: {self.metrics['test']['mae']:.4f}, "
                    f"Test RMSE: {self.metrics['test']['rmse']:.4f}, "
@@ -175,6 +185,79 @@ class GrowthPredictor:
         
         return self.metrics
     
+    def train_incremental(self, df_new: pd.DataFrame, test_size: float = 0.2) -> Dict:
+        """
+        Continua o boosting do modelo atual usando apenas amostras novas
+        
+        Adiciona INCREMENTAL_N_ESTIMATORS árvores ao booster existente. Se o
+        erro de validação (holdout das amostras novas) ultrapassar o MAE de
+        teste do último treino completo além da tolerância, ou se o modelo
+        já tiver árvores demais, o modelo não é alterado e o status 'drift'
+        indica que um re-treino completo é necessário.
+        
+        Args:
+            df_new: Amostras posteriores ao data_watermark (com 'Target_DeltaZScore')
+            test_size: Proporção das amostras novas usada para validação
+            
+        Returns:
+            Dicionário com 'status' ('updated', 'drift' ou 'insufficient_data') e métricas
+        """
+        if self.model is None or not self.metrics.get('test'):
+            raise ValueError("Treino incremental requer um modelo já treinado.")
+        
+        if len(df_new) < settings.INCREMENTAL_MIN_SAMPLES:
+            return {'status': 'insufficient_data', 'n_new_samples': len(df_new)}
+        
+        n_arvores = self.model.get_booster().num_boosted_rounds()
+        if n_arvores + settings.INCREMENTAL_N_ESTIMATORS > settings.INCREMENTAL_MAX_ESTIMATORS:
+            logger.info(f"Modelo já tem {n_arvores} árvores; re-treino completo necessário")
+            return {'status': 'drift', 'reason': 'max_estimators', 'n_estimators': n_arvores}
+        
+        X = self.prepare_features(df_new)
+        y = df_new['Target_DeltaZScore'].values
+        X_train, X_val, y_train, y_val = train_test_split(
+            X, y, test_size=test_size, random_state=42
+        )
+        
+        # Continuar boosting a partir do booster atual
+        params = self.model.get_params()
+        params['n_estimators'] = settings.INCREMENTAL_N_ESTIMATORS
+        model = xgb.XGBRegressor(**params)
+        model.fit(X_train, y_train, xgb_model=self.model.get_booster())
+        
+        mae_anterior = mean_absolute_error(y_val, self.model.predict(X_val))
+        mae_novo = mean_absolute_error(y_val, model.predict(X_val))
+        mae_referencia = self.metrics['test']['mae']
+        limite = mae_referencia * (1 + settings.INCREMENTAL_DRIFT_TOLERANCE)
+        
+        resultado = {
+            'n_new_samples': len(df_new),
+            'val_mae_before': float(mae_anterior),
+            'val_mae_after': float(mae_novo),
+            'reference_mae': float(mae_referencia),
+            'drift_threshold': float(limite),
+        }
+        
+        if mae_novo > limite:
+            logger.warning(f"Drift detectado no treino incremental: MAE {mae_novo:.4f} > {limite:.4f}")
+            return {'status': 'drift', 'reason': 'validation_error', **resultado}
+        
+        self.model = model
+        self.trained_at = datetime.now()
+        self.data_watermark = df_new['DataFutura'].max()
+        self.metrics['last_incremental'] = {
+            **resultado,
+            'n_estimators': model.get_booster().num_boosted_rounds(),
+            'trained_at': self.trained_at.isoformat(),
+        }
+        
+        logger.info(f"Modelo atualizado incrementalmente com {len(df_new)} amostras - "
+                   f"Val MAE: {mae_anterior:.4f} -> {mae_novo:.4f}")
+        
+        self.save_model()
+        
+        return {'status': 'updated', **self.metrics['last_incremental']}
+    
     def predict_zscore_change(
         self, 
         crianca_features: Dict,
@@ -205,6 +288,25 @@ class GrowthPredictor:
         # Fazer predição
         delta_zscore_pred = self.model.predict(X)[0]
         
+        return self._build_prediction_result(delta_zscore_pred, features, horizonte_dias)
+    
+    def _build_prediction_result(
+        self,
+        delta_zscore_pred: float,
+        features: Dict,
+        horizonte_dias: int
+    ) -> Dict:
+        """
+        Monta dicionário de resposta a partir do Δ z-score previsto
+        
+        Args:
+            delta_zscore_pred: Mudança prevista no z-score
+            features: Features usadas na predição
+            horizonte_dias: Horizonte de predição em dias
+            
+        Returns:
+            Dicionário com predição e intervalo de confiança
+        """
         # Estimar intervalo de confiança usando erro do modelo
         # (método simples - pode ser melhorado com quantile regression)
         std_error = self.metrics.get('test', {}).get('rmse', 0.5)
@@ -217,7 +319,7 @@ class GrowthPredictor:
         }
         
         # Calcular probabilidade de melhora (z-score aumentar)
-        probabilidade_melhora = 1.0 / (1.0 + np.exp(-delta_zscore_pred * 2))
+        probabilidade_melhora = self.probabilidade_melhora(delta_zscore_pred)
         
         # Avaliar confiabilidade da predição
         if self.metrics.get('test', {}).get('r2', 0) > 0.7:
@@ -241,6 +343,163 @@ class GrowthPredictor:
         
         return result
     
+    @staticmethod
+    def probabilidade_melhora(delta_zscore_pred):
+        """Probabilidade de melhora (z-score aumentar); aceita escalar ou array"""
+        return 1.0 / (1.0 + np.exp(-np.asarray(delta_zscore_pred) * 2))
+    
+    def build_feature_matrix(self, rows) -> np.ndarray:
+        """
+        Monta matriz de features para inferência em lote
+        
+        Equivale a chamar prepare_features linha a linha: nenhuma estatística
+        entre linhas (mediana, quantis) é usada, então cada linha recebe a mesma
+        predição que teria em predict_zscore_change.
+        
+        Args:
+            rows: DataFrame ou lista de dicionários com features
+            
+        Returns:
+            Matriz (n_linhas, n_features) na ordem de feature_columns
+        """
+        df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(list(rows))
+        X = np.zeros((len(df), len(self.feature_columns)), dtype=np.float64)
+        
+        for j, col in enumerate(self.feature_columns):
+            if col in df.columns:
+                X[:, j] = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        
+        return np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
+    
+    def predict_batch(self, X: np.ndarray) -> np.ndarray:
+        """
+        Prediz Δ z-score para uma matriz de features em uma única chamada
+        
+        Args:
+            X: Matriz montada por build_feature_matrix
+            
+        Returns:
+            Vetor com Δ z-score previsto por linha
+        """
+        if self.model is None:
+            raise ValueError("Modelo não treinado. Execute train() primeiro.")
+        
+        return np.asarray(self.model.predict(X), dtype=np.float64)
+    
+    def predict_contributions(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Prediz Δ z-score e contribuição de cada feature em uma única chamada
+        
+        Usa a saída nativa de contribuições do booster (TreeSHAP); a predição
+        é a soma das contribuições com o valor base.
+        
+        Args:
+            X: Matriz montada por build_feature_matrix
+            
+        Returns:
+            Tupla (predições, contribuições (n, n_features), valor base por linha)
+        """
+        if self.model is None:
+            raise ValueError("Modelo não treinado. Execute train() primeiro.")
+        
+        dmatrix = xgb.DMatrix(X, feature_names=self.feature_columns)
+        contribs = self.model.get_booster().predict(dmatrix, pred_contribs=True).astype(np.float64)
+        
+        return contribs.sum(axis=1), contribs[:, :-1], contribs[:, -1]
+    
+    def predict_scenarios(
+        self,
+        crianca_features: Dict,
+        cenarios: List[Dict],
+        horizonte_dias: int = 14,
+        incluir_contribuicoes: bool = False
+    ) -> List[Dict]:
+        """
+        Prediz vários cenários de dieta para uma criança em um único lote
+        
+        Args:
+            crianca_features: Dicionário com características da criança
+            cenarios: Lista de dicionários com características da dieta
+            horizonte_dias: Horizonte de predição em dias
+            incluir_contribuicoes: Incluir contribuição de cada feature
+            
+        Returns:
+            Lista de predições no mesmo formato de predict_zscore_change
+        """
+        rows = [{**crianca_features, **cenario} for cenario in cenarios]
+        X = self.build_feature_matrix(rows)
+        
+        if incluir_contribuicoes:
+            preds, contribs, base = self.predict_contributions(X)
+        else:
+            preds = self.predict_batch(X)
+        
+        results = []
+        for i, features in enumerate(rows):
+            result = self._build_prediction_result(preds[i], features, horizonte_dias)
+            
+            if incluir_contribuicoes:
+                ordem = np.argsort(-np.abs(contribs[i]), kind='stable')
+                result['contribuicao_base'] = float(base[i])
+                result['contribuicoes'] = [
+                    {
+                        'feature': self.feature_columns[j],
+                        'valor': float(X[i, j]),
+                        'contribuicao': float(contribs[i, j])
+                    }
+                    for j in ordem
+                ]
+            
+            results.append(result)
+        
+        return results
+    
+    def predict_diet_grid(
+        self,
+        crianca_features: Dict,
+        energias: np.ndarray,
+        proteinas: np.ndarray,
+        frequencias: np.ndarray
+    ) -> np.ndarray:
+        """
+        Avalia uma grade energia × proteína × frequência em um único lote
+        
+        Args:
+            crianca_features: Features da última medida da criança
+            energias: Taxas energéticas (kcal/kg/dia)
+            proteinas: Metas proteicas (g/kg/dia)
+            frequencias: Frequências (horas)
+            
+        Returns:
+            Array (n_frequencias, n_energias, n_proteinas) com Δ z-score previsto
+        """
+        energias = np.asarray(energias, dtype=np.float64)
+        proteinas = np.asarray(proteinas, dtype=np.float64)
+        frequencias = np.asarray(frequencias, dtype=np.float64)
+        shape = (len(frequencias), len(energias), len(proteinas))
+        
+        base = self.build_feature_matrix([crianca_features])[0]
+        X = np.tile(base, (int(np.prod(shape)), 1))
+        
+        freq_grid, energia_grid, proteina_grid = np.meshgrid(
+            frequencias, energias, proteinas, indexing='ij'
+        )
+        grid_columns = {
+            'TaxaEnergeticaKcalKg': energia_grid,
+            'MetaProteinaGKg': proteina_grid,
+            'FrequenciaHoras': freq_grid,
+        }
+        for col, values in grid_columns.items():
+            if col in self.feature_columns:
+                X[:, self.feature_columns.index(col)] = values.ravel()
+        
+        return self.predict_batch(X).reshape(shape)
+    
+    @property
+    def model_version(self) -> str:
+        """Identificador do modelo carregado (usado em chaves de cache)"""
+        return str(self.trained_at) if self.trained_at else 'untrained'
+    
     def get_feature_importance(self) -> Dict[str, float]:
         """Retorna importância das features"""
         if self.model is None:
@@ -257,7 +516,8 @@ class GrowthPredictor:
             'model': self.model,
             'feature_columns': self.feature_columns,
             'metrics': self.metrics,
-            'trained_at': self.trained_at
+            'trained_at': self.trained_at,
+            'data_watermark': self.data_watermark
         }
         
         joblib.dump(model_data, self.model_path)
@@ -271,6 +531,7 @@ class GrowthPredictor:
             self.feature_columns = model_data['feature_columns']
             self.metrics = model_data.get('metrics', {})
             self.trained_at = model_data.get('trained_at')
+            self.data_watermark = model_data.get('data_watermark')
             logger.info(f"Modelo carregado de {self.model_path}")
         except Exception as e:
             logger.error(f"Erro ao carregar modelo: {e}")
@@ -0,0 +1,183 @@
+"""Motores de busca de vizinhos mais próximos para casos similares"""
+import numpy as np
+from typing import Optional, Tuple
+from sklearn.neighbors import NearestNeighbors
+import logging
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import hnswlib
+    HNSW_AVAILABLE = True
+except ImportError:
+    HNSW_AVAILABLE = False
+
+
+# Motores exatos (sklearn) e o algoritmo correspondente
+EXACT_ENGINES = {
+    'brute': 'brute',
+    'kd_tree': 'kd_tree',
+    'ball_tree': 'ball_tree',
+}
+
+ENGINES = list(EXACT_ENGINES) + ['hnsw']
+
+
+class HNSWIndex:
+    """
+    Índice aproximado baseado em grafo (HNSW) com a mesma interface de
+    NearestNeighbors: fit(X) e kneighbors(X, n_neighbors)
+
+    Requer o pacote opcional hnswlib.
+    """
+
+    def __init__(
+        self,
+        M: Optional[int] = None,
+        ef_construction: Optional[int] = None,
+        ef_search: Optional[int] = None
+    ):
+        """
+        Inicializa o índice
+
+        Args:
+            M: Conexões por nó do grafo (padrão: settings.SIMILARITY_HNSW_M)
+            ef_construction: Tamanho da lista de candidatos na construção
+            ef_search: Tamanho da lista de candidatos na consulta
+        """
+        if not HNSW_AVAILABLE:
+            raise ImportError("Motor 'hnsw' requer o pacote hnswlib (pip install hnswlib)")
+
+        self.M = M or settings.SIMILARITY_HNSW_M
+        self.ef_construction = ef_construction or settings.SIMILARITY_HNSW_EF_CONSTRUCTION
+        self.ef_search = ef_search or settings.SIMILARITY_HNSW_EF_SEARCH
+        self.index = None
+        self.n_samples_fit_ = 0
+
+    def fit(self, X: np.ndarray) -> 'HNSWIndex':
+        """Constrói o grafo com todas as linhas de X"""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        self.index = hnswlib.Index(space='l2', dim=X.shape[1])
+        self.index.init_index(max_elements=max(len(X), 1), M=self.M, ef_construction=self.ef_construction)
+        self.index.add_items(X, np.arange(len(X)))
+        self.n_samples_fit_ = len(X)
+        return self
+
+    def kneighbors(self, X: np.ndarray, n_neighbors: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Busca os vizinhos aproximados
+
+        Returns:
+            Tupla (distâncias euclidianas, índices), cada uma (n_consultas, n_neighbors)
+        """
+        n_neighbors = min(n_neighbors, self.n_samples_fit_)
+        self.index.set_ef(max(self.ef_search, n_neighbors))
+        indices, distancias = self.index.knn_query(np.ascontiguousarray(X, dtype=np.float32), k=n_neighbors)
+        # hnswlib retorna distância euclidiana ao quadrado
+        return np.sqrt(distancias).astype(np.float64), indices.astype(np.int64)
+
+
+def create_engine(nome: Optional[str] = None):
+    """
+    Cria um índice de vizinhos vazio para o motor configurado
+
+    Args:
+        nome: 'brute', 'kd_tree', 'ball_tree' ou 'hnsw' (padrão: settings.SIMILARITY_ENGINE)
+
+    Returns:
+        Objeto com fit(X) e kneighbors(X, n_neighbors)
+    """
+    nome = nome or settings.SIMILARITY_ENGINE
+
+    if nome in EXACT_ENGINES:
+        return NearestNeighbors(metric='euclidean', algorithm=EXACT_ENGINES[nome])
+
+    if nome == 'hnsw':
+        if not HNSW_AVAILABLE:
+            logger.warning("hnswlib não instalado; usando motor exato 'kd_tree'")
+            return NearestNeighbors(metric='euclidean', algorithm='kd_tree')
+        return HNSWIndex()
+
+    raise ValueError(f"Motor de similaridade desconhecido: {nome}. Opções: {ENGINES}")
+
+
+def benchmark(
+    tamanhos=(100_000, 1_000_000, 10_000_000),
+    engines=None,
+    n_features: int = 6,
+    n_consultas: int = 200,
+    k: int = 10,
+    seed: int = 42
+):
+    """
+    Mede tempo de construção, latência por consulta e recall@k de cada motor
+
+    Os dados são sintéticos e já padronizados (como a saída do StandardScaler),
+    com a mesma dimensionalidade das features de similaridade. O recall é
+    medido contra a busca exata por força bruta.
+
+    Returns:
+        Lista de dicionários (um por tamanho × motor)
+    """
+    import time
+
+    engines = engines or [e for e in ENGINES if e != 'hnsw' or HNSW_AVAILABLE]
+    rng = np.random.default_rng(seed)
+    resultados = []
+
+    for n in tamanhos:
+        X = rng.standard_normal((n, n_features)).astype(np.float64)
+        consultas = rng.standard_normal((n_consultas, n_features))
+
+        verdade = None
+        for nome in ['brute'] + [e for e in engines if e != 'brute']:
+            engine = create_engine(nome)
+
+            inicio = time.perf_counter()
+            engine.fit(X)
+            tempo_build = time.perf_counter() - inicio
+
+            # Consultas individuais (padrão de uso do endpoint)
+            latencias = np.empty(n_consultas)
+            indices = np.empty((n_consultas, k), dtype=np.int64)
+            for i in range(n_consultas):
+                inicio = time.perf_counter()
+                _, idx = engine.kneighbors(consultas[i:i + 1], n_neighbors=k)
+                latencias[i] = time.perf_counter() - inicio
+                indices[i] = idx[0]
+
+            if verdade is None:
+                verdade = indices
+            recall = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(indices, verdade)])
+
+            if nome in engines:
+                resultado = {
+                    'n_casos': n,
+                    'motor': nome,
+                    'build_s': round(tempo_build, 3),
+                    'latencia_p50_ms': round(float(np.percentile(latencias, 50)) * 1000, 3),
+                    'latencia_p95_ms': round(float(np.percentile(latencias, 95)) * 1000, 3),
+                    f'recall@{k}': round(float(recall), 4),
+                }
+                resultados.append(resultado)
+                logger.info(resultado)
+
+        del X
+
+    return resultados
+
+
+if __name__ == "__main__":
+    """Benchmark de recall × latência: python -m app.models.similarity_engine [tamanhos...]"""
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+    tamanhos = tuple(int(float(t)) for t in sys.argv[1:]) or (100_000, 1_000_000, 10_000_000)
+
+    print(f"{'casos':>12} {'motor':>10} {'build (s)':>10} {'p50 (ms)':>10} {'p95 (ms)':>10} {'recall@10':>10}")
+    for r in benchmark(tamanhos=tamanhos):
+        print(f"{r['n_casos']:>12,} {r['motor']:>10} {r['build_s']:>10} "
+              f"{r['latencia_p50_ms']:>10} {r['latencia_p95_ms']:>10} {r['recall@10']:>10}")
@@ -0,0 +1,181 @@
+"""Simulação de trajetórias de z-score em múltiplos passos"""
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional
+import logging
+
+from app.models.growth_predictor import GrowthPredictor, get_growth_predictor
+
+logger = logging.getLogger(__name__)
+
+
+class TrajectorySimulator:
+    """
+    Projeta curvas de z-score aplicando o GrowthPredictor passo a passo
+
+    Cada passo equivale a uma nova consulta sob o cenário de dieta: o z-score,
+    o peso e os dias de vida avançam e as médias móveis de energia/proteína
+    são recalculadas a partir de um histórico deslizante. Todas as crianças e
+    cenários avançam juntos como linhas de uma mesma matriz, com uma única
+    chamada ao modelo por passo.
+    """
+
+    # Maior janela móvel (em consultas) usada pelas features do modelo
+    JANELA_HISTORICO = 14
+
+    def __init__(self, growth_predictor: Optional[GrowthPredictor] = None):
+        """
+        Inicializa o simulador
+
+        Args:
+            growth_predictor: Preditor a usar (padrão: singleton)
+        """
+        self.growth_predictor = growth_predictor or get_growth_predictor()
+
+    def _historico(self, df_features: pd.DataFrame, coluna: str) -> np.ndarray:
+        """Últimos JANELA_HISTORICO valores de uma coluna (NaN à esquerda se faltar)"""
+        valores = np.full(self.JANELA_HISTORICO, np.nan)
+        if coluna in df_features.columns:
+            ultimos = pd.to_numeric(df_features[coluna], errors='coerce').to_numpy(dtype=np.float64)
+            ultimos = ultimos[-self.JANELA_HISTORICO:]
+            valores[self.JANELA_HISTORICO - len(ultimos):] = ultimos
+        return valores
+
+    def simulate(
+        self,
+        timelines: List[pd.DataFrame],
+        cenarios: List[Dict],
+        n_passos: int = 6,
+        passo_dias: int = 14,
+        zscore_alvo: Optional[float] = None
+    ) -> Dict:
+        """
+        Simula trajetórias para todas as combinações criança × cenário
+
+        O primeiro passo reproduz exatamente predict_zscore_change para o
+        cenário. O peso avança pela última velocidade de ganho observada,
+        que é mantida constante ao longo da simulação.
+
+        Args:
+            timelines: Timelines com features computadas, uma por criança
+            cenarios: Cenários de dieta (TaxaEnergeticaKcalKg, MetaProteinaGKg, FrequenciaHoras)
+            n_passos: Número de passos a simular
+            passo_dias: Dias por passo (idealmente o horizonte de treino do modelo)
+            zscore_alvo: Z-score alvo para estimar dias até o objetivo (opcional)
+
+        Returns:
+            Dicionário com arrays 'dias' (n_passos + 1), 'zscores' e 'pesos'
+            (n_criancas, n_cenarios, n_passos + 1) e 'dias_para_objetivo'
+            (n_criancas, n_cenarios; NaN se o alvo não for atingido)
+        """
+        n_criancas, n_cenarios = len(timelines), len(cenarios)
+        colunas = self.growth_predictor.feature_columns
+        idx = {col: colunas.index(col) for col in colunas}
+
+        # Estado inicial: última medida de cada criança repetida por cenário
+        ultimas = [df.iloc[-1].to_dict() for df in timelines]
+        base = self.growth_predictor.build_feature_matrix(ultimas)
+        X = np.repeat(base, n_cenarios, axis=0)
+
+        energia_hist = np.repeat(
+            np.stack([self._historico(df, 'TaxaEnergeticaKcalKg') for df in timelines]), n_cenarios, axis=0
+        )
+        proteina_hist = np.repeat(
+            np.stack([self._historico(df, 'MetaProteinaGKg') for df in timelines]), n_cenarios, axis=0
+        )
+
+        # Colunas de dieta de cada linha (cenários variam mais rápido)
+        cenario_energia = np.tile([c['TaxaEnergeticaKcalKg'] for c in cenarios], n_criancas).astype(np.float64)
+        cenario_proteina = np.tile([c['MetaProteinaGKg'] for c in cenarios], n_criancas).astype(np.float64)
+        cenario_freq = np.tile([c.get('FrequenciaHoras', 3.0) for c in cenarios], n_criancas).astype(np.float64)
+        for col, valores in (('TaxaEnergeticaKcalKg', cenario_energia),
+                             ('MetaProteinaGKg', cenario_proteina),
+                             ('FrequenciaHoras', cenario_freq)):
+            if col in idx:
+                X[:, idx[col]] = valores
+
+        zscores = np.empty((X.shape[0], n_passos + 1))
+        pesos = np.empty((X.shape[0], n_passos + 1))
+        zscores[:, 0] = X[:, idx['ZScorePeso']] if 'ZScorePeso' in idx else 0.0
+        pesos[:, 0] = X[:, idx['PesoGr']] if 'PesoGr' in idx else 0.0
+        velocidade = X[:, idx['VelocidadePeso']] if 'VelocidadePeso' in idx else np.zeros(X.shape[0])
+
+        for passo in range(1, n_passos + 1):
+            delta = self.growth_predictor.predict_batch(X)
+
+            zscores[:, passo] = zscores[:, passo - 1] + delta
+            pesos[:, passo] = pesos[:, passo - 1] + velocidade * passo_dias
+
+            # Nova consulta simulada sob o cenário: atualizar lags e janelas móveis
+            energia_hist = np.concatenate([energia_hist[:, 1:], cenario_energia[:, None]], axis=1)
+            proteina_hist = np.concatenate([proteina_hist[:, 1:], cenario_proteina[:, None]], axis=1)
+
+            atualizacoes = {
+                'ZScorePeso': zscores[:, passo],
+                'PesoGr': pesos[:, passo],
+                'DiasDeVida': X[:, idx['DiasDeVida']] + passo_dias if 'DiasDeVida' in idx else None,
+                'EnergiaMedia_7d': np.nanmean(energia_hist[:, -7:], axis=1),
+                'EnergiaMedia_14d': np.nanmean(energia_hist, axis=1),
+                'ProteinaMedia_7d': np.nanmean(proteina_hist[:, -7:], axis=1),
+                'ProteinaMedia_14d': np.nanmean(proteina_hist, axis=1),
+            }
+            for col, valores in atualizacoes.items():
+                if col in idx and valores is not None:
+                    X[:, idx[col]] = valores
+
+        dias = np.arange(n_passos + 1) * passo_dias
+
+        dias_para_objetivo = np.full(X.shape[0], np.nan)
+        if zscore_alvo is not None:
+            dias_para_objetivo = self._dias_para_objetivo(zscores, dias, zscore_alvo)
+
+        shape = (n_criancas, n_cenarios, n_passos + 1)
+        return {
+            'dias': dias,
+            'zscores': zscores.reshape(shape),
+            'pesos': pesos.reshape(shape),
+            'dias_para_objetivo': dias_para_objetivo.reshape(n_criancas, n_cenarios)
+        }
+
+    @staticmethod
+    def _dias_para_objetivo(zscores: np.ndarray, dias: np.ndarray, zscore_alvo: float) -> np.ndarray:
+        """
+        Estima dias até o z-score atingir o alvo (interpolação linear entre passos)
+
+        Args:
+            zscores: Trajetórias (n_linhas, n_pontos)
+            dias: Dias de cada ponto
+            zscore_alvo: Z-score alvo
+
+        Returns:
+            Dias até o alvo por linha (NaN se não atingido no horizonte simulado)
+        """
+        atingiu = zscores >= zscore_alvo
+        resultado = np.full(zscores.shape[0], np.nan)
+
+        alguma = atingiu.any(axis=1)
+        primeiro = np.argmax(atingiu, axis=1)
+
+        # Já está no alvo
+        resultado[alguma & (primeiro == 0)] = 0.0
+
+        # Cruzou o alvo entre os pontos k-1 e k
+        linhas = np.where(alguma & (primeiro > 0))[0]
+        k = primeiro[linhas]
+        z_antes, z_depois = zscores[linhas, k - 1], zscores[linhas, k]
+        fracao = (zscore_alvo - z_antes) / (z_depois - z_antes)
+        resultado[linhas] = dias[k - 1] + fracao * (dias[k] - dias[k - 1])
+
+        return resultado
+
+
+# Instância global (singleton)
+_trajectory_simulator = None
+
+
+def get_trajectory_simulator() -> TrajectorySimulator:
+    """Retorna instância singleton do simulador"""
+    global _trajectory_simulator
+    if _trajectory_simulator is None:
+        _trajectory_simulator = TrajectorySimulator()
+    return _trajectory_simulator
@@ -1,9 +1,15 @@
 """Router para endpoints de analytics"""
-from fastapi import APIRouter, HTTPException, Query, status
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
 from typing import List, Optional
+from uuid import UUID
 import logging
 
-from app.schemas import SimilarCase, AnalyticsStats
+from app.schemas import (
+    SimilarCase, AnalyticsStats, RiskScoresPage,
+    SimilarCasesBatchRequest, SimilarCasesBatchResponse
+)
+from app.jobs import risk_scoring
 from app.services.prediction_service import get_prediction_service
 from app.models.diet_analyzer import get_diet_analyzer
 from app.services.etl_service import ETLService
@@ -15,22 +21,29 @@ router = APIRouter()
 @router.get("/similar-cases/{crianca_id}", response_model=List[SimilarCase])
 async def get_similar_cases(
     crianca_id: str,
-    limit: int = Query(10, ge=1, le=50, description="Número de casos a retornar")
+    limit: int = Query(10, ge=1, le=50, description="Número de casos a retornar"),
+    sexo: Optional[str] = Query(None, pattern="^[MF]$", description="Restringir a casos deste sexo"),
+    classificacao_ig: Optional[str] = Query(None, description="Restringir a casos desta classificação IG")
 ):
     """
     Busca casos similares com bons resultados
     
     - **crianca_id**: ID da criança de referência
     - **limit**: Número máximo de casos a retornar (1-50)
+    - **sexo**: Apenas casos do sexo informado (M/F, opcional)
+    - **classificacao_ig**: Apenas casos da classificação IG informada (opcional)
     
     Retorna lista de casos similares ordenados por similaridade e sucesso
     """
     try:
         prediction_service = get_prediction_service()
         
-        casos = prediction_service.get_similar_cases(
+        casos = await run_in_threadpool(
+            prediction_service.get_similar_cases,
             crianca_id=crianca_id,
-            top_n=limit
+            top_n=limit,
+            sexo=sexo,
+            classificacao_ig=classificacao_ig
         )
         
         return casos
@@ -73,21 +86,31 @@ async def get_statistics():
 
 @router.get("/diet-patterns")
 async def get_diet_patterns(
-    classificacao_ig: Optional[str] = Query(None, description="Filtrar por classificação IG")
+    classificacao_ig: Optional[str] = Query(None, description="Filtrar por classificação IG"),
+    sexo: Optional[str] = Query(None, pattern="^[MF]$", description="Filtrar por sexo"),
+    classificacao_peso: Optional[str] = Query(None, description="Filtrar por classificação de peso ao nascer")
 ):
     """
     Analisa padrões de dieta associados a bons resultados
     
     - **classificacao_ig**: Filtrar por classificação específica (opcional)
+    - **sexo**: Filtrar por sexo (opcional)
+    - **classificacao_peso**: Filtrar por classificação de peso ao nascer (opcional)
     
     Retorna padrões agregados de energia, proteína e resultados
     """
     try:
         diet_analyzer = get_diet_analyzer()
-        patterns = diet_analyzer.get_diet_patterns(classification_ig=classificacao_ig)
+        patterns = diet_analyzer.get_diet_patterns(
+            classification_ig=classificacao_ig,
+            sexo=sexo,
+            classificacao_peso=classificacao_peso
+        )
         
         return {
             'classificacao_ig': classificacao_ig or 'todas',
+            'sexo': sexo or 'todos',
+            'classificacao_peso': classificacao_peso or 'todas',
             'patterns': patterns
         }
         
@@ -99,6 +122,198 @@ async def get_diet_patterns(
         )
 
 
+@router.get("/risk-scores", response_model=RiskScoresPage)
+async def get_risk_scores(
+    pagina: int = Query(1, ge=1, description="Página (começa em 1)"),
+    tamanho_pagina: int = Query(50, ge=1, le=500, description="Itens por página"),
+    apenas_risco: bool = Query(True, description="Somente crianças com Δ z-score previsto negativo")
+):
+    """
+    Lista crianças ranqueadas pelo Δ z-score previsto sob a dieta vigente
+    
+    A lista é gerada pelo job noturno (python -m app.jobs.risk_scoring)
+    ou sob demanda via POST /risk-scores/run
+    """
+    try:
+        df, meta = risk_scoring.load_risk_scores()
+        
+        if df is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Lista de risco ainda não gerada. Execute o job de score de risco."
+            )
+        
+        if apenas_risco and not df.empty:
+            df = df[df['risco']]
+        
+        inicio = (pagina - 1) * tamanho_pagina
+        pagina_df = df.iloc[inicio:inicio + tamanho_pagina]
+        itens = pagina_df.astype(object).where(pagina_df.notna(), None).to_dict('records')
+        
+        return {
+            'itens': itens,
+            'total': len(df),
+            'pagina': pagina,
+            'tamanho_pagina': tamanho_pagina,
+            'gerado_em': meta.get('gerado_em'),
+            'model_version': meta.get('model_version')
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erro ao obter scores de risco: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao processar scores de risco: {str(e)}"
+        )
+
+
+@router.post("/risk-scores/run", status_code=status.HTTP_202_ACCEPTED)
+async def run_risk_scores(background_tasks: BackgroundTasks):
+    """
+    Dispara o job de score de risco da coorte ativa em segundo plano
+    
+    ⚠️ Normalmente executado por agendamento noturno
+    """
+    background_tasks.add_task(risk_scoring.run_risk_scoring)
+    
+    return {
+        'status': 'accepted',
+        'message': 'Job de score de risco iniciado em segundo plano'
+    }
+
+
+@router.post("/similar-cases/batch", response_model=SimilarCasesBatchResponse)
+async def get_similar_cases_batch(request: SimilarCasesBatchRequest):
+    """
+    Busca casos similares para várias crianças e/ou perfis avulsos de uma vez
+    
+    - **crianca_ids**: IDs das crianças de referência (até 500)
+    - **perfis**: Perfis avulsos (IG, peso ao nascer, sexo, Apgar, z-score)
+    - **top_n**: Número de casos por criança/perfil (1-50)
+    - **sexo** / **classificacao_ig**: Restringir os casos a um estrato (opcional)
+    
+    Todas as buscas são feitas em uma única passada pelo índice; crianças
+    inexistentes são listadas em nao_encontradas
+    """
+    try:
+        prediction_service = get_prediction_service()
+        
+        # Perfis avulsos no formato das features de similaridade
+        perfis = [
+            {
+                'identificador': perfil.identificador,
+                'IdadeGestacionalSemanas': perfil.idade_gestacional_semanas,
+                'PesoNascimentoGr': perfil.peso_nascimento_gr,
+                'SexoNumerico': {'M': 0, 'F': 1}.get(perfil.sexo),
+                'Apgar1Minuto': perfil.apgar_1_minuto,
+                'Apgar5Minuto': perfil.apgar_5_minuto,
+                'ZScorePeso': perfil.zscore_peso,
+            }
+            for perfil in request.perfis
+        ]
+        
+        return await run_in_threadpool(
+            prediction_service.get_similar_cases_batch,
+            crianca_ids=[str(crianca_id) for crianca_id in request.crianca_ids],
+            perfis=perfis,
+            top_n=request.top_n,
+            sexo=request.sexo,
+            classificacao_ig=request.classificacao_ig
+        )
+        
+    except Exception as e:
+        logger.error(f"Erro ao buscar casos similares em lote: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao processar busca: {str(e)}"
+        )
+
+
+@router.get("/similarity-index")
+async def get_similarity_index_info():
+    """
+    Retorna metadados do índice de casos similares (tamanho, watermark, construção em andamento)
+    """
+    return get_diet_analyzer().index_info()
+
+
+@router.post("/similarity-index/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_similarity_index():
+    """
+    Reconstrói o índice de casos similares em segundo plano
+    
+    ⚠️ Normalmente executado por agendamento (python -m app.jobs.diet_index)
+    """
+    iniciado = get_diet_analyzer().refresh_index_async(force=True)
+    
+    if not iniciado:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Construção do índice de similaridade já está em execução"
+        )
+    
+    return {
+        'status': 'accepted',
+        'message': 'Reconstrução do índice de similaridade iniciada em segundo plano'
+    }
+
+
+@router.put("/similarity-index/criancas/{crianca_id}")
+async def upsert_similarity_index_crianca(crianca_id: UUID):
+    """
+    Atualiza os casos de uma criança no índice de casos similares
+    
+    - **crianca_id**: ID da criança cujas consultas foram registradas ou corrigidas
+    
+    Os casos ficam pesquisáveis imediatamente, sem reconstruir o índice
+    """
+    try:
+        prediction_service = get_prediction_service()
+        return await run_in_threadpool(
+            prediction_service.refresh_similarity_index_for_crianca, str(crianca_id)
+        )
+        
+    except Exception as e:
+        logger.error(f"Erro ao atualizar índice de similaridade: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao atualizar índice: {str(e)}"
+        )
+
+
+@router.delete("/similarity-index/criancas/{crianca_id}")
+async def remove_similarity_index_crianca(crianca_id: UUID):
+    """
+    Remove todos os casos de uma criança do índice de casos similares
+    
+    - **crianca_id**: ID da criança
+    """
+    return await run_in_threadpool(get_diet_analyzer().remove_crianca, str(crianca_id))
+
+
+@router.post("/similarity-index/compact", status_code=status.HTTP_202_ACCEPTED)
+async def compact_similarity_index():
+    """
+    Incorpora as atualizações incrementais ao índice de casos similares em segundo plano
+    
+    Mantém a normalização atual; use /similarity-index/rebuild para reconstruir do banco
+    """
+    iniciado = get_diet_analyzer().compact_async()
+    
+    if not iniciado:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Construção do índice de similaridade já está em execução"
+        )
+    
+    return {
+        'status': 'accepted',
+        'message': 'Compactação do índice de similaridade iniciada em segundo plano'
+    }
+
+
 @router.get("/crianca/{crianca_id}/profile")
 async def get_crianca_profile(crianca_id: str):
     """
@@ -110,7 +325,7 @@ async def get_crianca_profile(crianca_id: str):
     """
     try:
         etl_service = ETLService()
-        perfil = etl_service.get_crianca_perfil(crianca_id)
+        perfil = await run_in_threadpool(etl_service.get_crianca_perfil, crianca_id)
         
         if not perfil:
             raise HTTPException(
@@ -141,7 +356,7 @@ async def get_crianca_timeline(crianca_id: str):
     """
     try:
         etl_service = ETLService()
-        df_timeline = etl_service.get_crianca_timeline(crianca_id)
+        df_timeline = await run_in_threadpool(etl_service.get_crianca_timeline, crianca_id)
         
         if df_timeline.empty:
             raise HTTPException(
@@ -168,47 +383,78 @@ async def get_crianca_timeline(crianca_id: str):
         )
 
 
+@router.post("/crianca/{crianca_id}/invalidate")
+async def invalidate_crianca_context(crianca_id: UUID, background_tasks: BackgroundTasks):
+    """
+    Descarta o contexto em cache de uma criança (perfil, timeline e features)
+    e atualiza seus casos no índice de similaridade em segundo plano
+
+    - **crianca_id**: ID da criança cujas consultas ou dietas foram salvas
+
+    Chamado pelo backend após salvar uma consulta ou dieta; a próxima
+    predição ou comparação da criança recarrega os dados do banco e os
+    casos novos ou corrigidos ficam pesquisáveis sem reconstruir o índice
+    """
+    removido = get_prediction_service().invalidate_crianca_context(str(crianca_id))
+    background_tasks.add_task(_refresh_similarity_index_crianca, str(crianca_id))
+    return {
+        'crianca_id': str(crianca_id),
+        'removido': removido
+    }
+
+
+def _refresh_similarity_index_crianca(crianca_id: str):
+    """Atualização do índice de similaridade disparada pela invalidação"""
+    try:
+        resultado = get_prediction_service().refresh_similarity_index_for_crianca(crianca_id)
+        logger.info(f"Índice de similaridade atualizado para criança {crianca_id}: {resultado}")
+    except Exception as e:
+        logger.error(f"Erro ao atualizar índice de similaridade da criança {crianca_id}: {e}", exc_info=True)
+
+
+@router.get("/context-cache")
+async def get_context_cache_stats():
+    """
+    Retorna métricas do cache de contexto por criança (hits, misses, descartes e expirações)
+    """
+    return get_prediction_service().context_cache_stats()
+
+
 @router.post("/retrain")
-async def retrain_models(horizonte_dias: int = Query(14, ge=7, le=90)):
+async def retrain_models(
+    horizonte_dias: int = Query(14, ge=7, le=90),
+    modo: str = Query("full", pattern="^(full|incremental)$")
+):
     """
     Re-treina os modelos de ML com dados atualizados
     
     - **horizonte_dias**: Horizonte de predição para treinamento
+    - **modo**: 'full' (todo o histórico) ou 'incremental' (continua o boosting
+      com amostras posteriores ao último treino; volta ao completo se houver drift)
     
     ⚠️ Esta operação pode demorar alguns minutos
     """
     try:
-        from app.models.growth_predictor import get_growth_predictor
-        from app.services.etl_service import ETLService
-        
-        logger.info(f"Iniciando re-treinamento dos modelos (horizonte: {horizonte_dias} dias)")
+        from app.jobs.model_refresh import refresh_growth_model
         
-        # Preparar dados de treinamento
-        etl_service = ETLService()
-        df_train = etl_service.prepare_training_data(horizonte_dias=horizonte_dias)
-        
-        if df_train.empty or len(df_train) < 10:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Dados insuficientes para treinamento. Mínimo: 10 amostras, encontrado: {len(df_train)}"
-            )
+        logger.info(f"Iniciando re-treinamento dos modelos (horizonte: {horizonte_dias} dias, modo: {modo})")
         
-        # Treinar modelo
-        predictor = get_growth_predictor()
-        metrics = predictor.train(df_train)
+        resultado = refresh_growth_model(horizonte_dias=horizonte_dias, modo=modo)
         
-        logger.info(f"Modelo re-treinado com sucesso. Métricas: {metrics}")
+        logger.info(f"Modelo re-treinado com sucesso: {resultado}")
         
         return {
             'status': 'success',
             'message': 'Modelo re-treinado com sucesso',
-            'metrics': metrics,
-            'n_samples': len(df_train),
-            'horizonte_dias': horizonte_dias
+            'horizonte_dias': horizonte_dias,
+            **resultado
         }
         
-    except HTTPException:
-        raise
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
     except Exception as e:
         logger.error(f"Erro ao re-treinar modelos: {e}", exc_info=True)
         raise HTTPException(
@@ -1,11 +1,14 @@
 """Router para analytics de alimentos"""
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Literal, Optional, Dict, Any
 import logging
 from datetime import datetime
+import time
 
 from app.models.food_recommender import get_food_recommender
+from app.services.diet_episode_service import get_diet_episode_table
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -45,6 +48,27 @@ class FoodRecommendationResponse(BaseModel):
     timestamp: datetime
 
 
+class PerfilCriancaLote(PerfilCrianca):
+    identificador: Optional[str] = Field(None, description="Identificador livre devolvido na resposta")
+
+
+class FoodRecommendationBatchRequest(BaseModel):
+    perfis: List[PerfilCriancaLote] = Field(..., min_length=1, max_length=1000)
+    top_n: int = Field(default=10, ge=1, le=50)
+
+
+class FoodRecommendationResult(BaseModel):
+    identificador: Optional[str] = None
+    crianca_perfil: Dict[str, Any]
+    alimentos_recomendados: List[AlimentoRecomendado]
+
+
+class FoodRecommendationBatchResponse(BaseModel):
+    resultados: List[FoodRecommendationResult]
+    tempo_ms: float
+    timestamp: datetime
+
+
 class FoodEffectivenessRequest(BaseModel):
     alimento_id: str
     perfil_filter: Optional[Dict[str, Any]] = None
@@ -105,6 +129,67 @@ async def recommend_foods(request: FoodRecommendationRequest):
         )
 
 
+@router.post("/food-recommendation/batch", response_model=FoodRecommendationBatchResponse)
+async def recommend_foods_batch(request: FoodRecommendationBatchRequest):
+    """
+    Recomenda alimentos para várias crianças de uma vez (ex.: uma unidade inteira)
+    
+    - **perfis**: Características de cada criança (até 1000), com identificador opcional
+    - **top_n**: Número de alimentos a recomendar por criança (padrão: 10)
+    
+    O produto criança × alimento é pontuado em blocos de uma única matriz;
+    os resultados seguem a ordem dos perfis recebidos
+    """
+    try:
+        inicio = time.perf_counter()
+        recommender = get_food_recommender()
+        
+        # Sem treino dentro da requisição: o lote exige o modelo pronto
+        if recommender.model is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Modelo de recomendação ainda não treinado. Execute POST /api/v1/analytics/train-food-recommender."
+            )
+        
+        perfis = [perfil.dict(exclude={'identificador'}) for perfil in request.perfis]
+        
+        recomendacoes = await run_in_threadpool(
+            recommender.recommend_foods_batch,
+            perfis=perfis,
+            top_n=request.top_n
+        )
+        
+        resultados = [
+            FoodRecommendationResult(
+                identificador=perfil.identificador,
+                crianca_perfil=perfil_dict,
+                alimentos_recomendados=[AlimentoRecomendado(**rec) for rec in recs]
+            )
+            for perfil, perfil_dict, recs in zip(request.perfis, perfis, recomendacoes)
+        ]
+        
+        return FoodRecommendationBatchResponse(
+            resultados=resultados,
+            tempo_ms=(time.perf_counter() - inicio) * 1000,
+            timestamp=datetime.now()
+        )
+        
+    except HTTPException:
+        raise
+    except ValueError as e:
+        logger.error(f"Erro de validação: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.error(f"Erro ao recomendar alimentos em lote: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao processar recomendação: {str(e)}"
+        )
+
+
 @router.post("/food-effectiveness")
 async def analyze_food_effectiveness(request: FoodEffectivenessRequest):
     """
@@ -133,18 +218,68 @@ async def analyze_food_effectiveness(request: FoodEffectivenessRequest):
         )
 
 
+@router.get("/food-effectiveness/leaderboard")
+async def get_food_effectiveness_leaderboard(
+    classificacao_ig: Optional[str] = Query(None, description="Considerar apenas esta classificação IG"),
+    sexo: Optional[str] = Query(None, pattern="^[MF]$", description="Considerar apenas este sexo"),
+    agrupar_por: Optional[List[Literal['sexo', 'classificacao_ig']]] = Query(
+        None, description="Dimensões adicionais do ranking"
+    ),
+    min_usos: int = Query(1, ge=1, description="Mínimo de usos para entrar no ranking"),
+    limit: Optional[int] = Query(None, ge=1, description="Número máximo de linhas")
+):
+    """
+    Ranking de efetividade de todos os alimentos em uma única agregação
+    
+    - **classificacao_ig** / **sexo**: Filtros de perfil (opcionais)
+    - **agrupar_por**: Quebrar o ranking por sexo e/ou classificação IG
+    - **min_usos**: Ignorar alimentos (ou grupos) com menos usos
+    - **limit**: Limitar o número de linhas retornadas
+    
+    Para cada alimento retorna total de usos, Δ z-score médio, ganho de peso
+    médio (g/dia) e taxa de sucesso (%), ordenados por taxa de sucesso.
+    O resultado fica em cache até a próxima atualização dos episódios
+    """
+    try:
+        resultado = get_diet_episode_table().leaderboard(
+            classificacao_ig=classificacao_ig,
+            sexo=sexo,
+            agrupar_por=agrupar_por,
+            min_usos=min_usos
+        )
+        
+        return {
+            **resultado,
+            'alimentos': resultado['alimentos'][:limit] if limit else resultado['alimentos'],
+            'n_alimentos': len(resultado['alimentos'])
+        }
+        
+    except Exception as e:
+        logger.error(f"Erro ao calcular ranking de efetividade: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao processar ranking: {str(e)}"
+        )
+
+
 @router.post("/train-food-recommender")
-async def train_food_recommender():
+async def train_food_recommender(
+    snapshot: str = Query("incremental", pattern="^(incremental|full|none)$")
+):
     """
     Treina o modelo de recomendação de alimentos
     
     Deve ser executado periodicamente ou após acúmulo de novos dados
+    
+    - **snapshot**: atualização do snapshot de treinamento antes do treino:
+      'incremental' (só episódios novos), 'full' (reextrai todo o histórico)
+      ou 'none' (treina com o snapshot atual, sem acessar o banco)
     """
     try:
         recommender = get_food_recommender()
         
-        logger.info("Iniciando treinamento do recomendador de alimentos...")
-        metrics = recommender.train()
+        logger.info(f"Iniciando treinamento do recomendador de alimentos (snapshot: {snapshot})...")
+        metrics = recommender.train(snapshot=snapshot)
         
         return {
             "status": "success",
@@ -161,6 +296,56 @@ async def train_food_recommender():
         )
 
 
+@router.post("/food-catalog/refresh")
+async def refresh_food_catalog():
+    """
+    Relê o catálogo de alimentos ativos mantido em memória
+    
+    Alterações no catálogo são detectadas automaticamente (contagem e data
+    da última alteração); use este endpoint para aplicá-las imediatamente
+    """
+    try:
+        recommender = get_food_recommender()
+        
+        return {
+            "status": "success",
+            "catalogo": recommender.refresh_catalog(),
+            "timestamp": datetime.now()
+        }
+        
+    except Exception as e:
+        logger.error(f"Erro ao atualizar catálogo de alimentos: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao atualizar catálogo: {str(e)}"
+        )
+
+
+@router.post("/food-usage-snapshot/refresh")
+async def refresh_food_usage_snapshot(full: bool = False):
+    """
+    Atualiza o snapshot de treinamento do recomendador sem treinar
+    
+    - **full**: reextrair todo o histórico em uma nova versão (padrão:
+      acrescentar apenas episódios com consulta final após o watermark)
+    """
+    try:
+        recommender = get_food_recommender()
+        
+        return {
+            "status": "success",
+            "snapshot": recommender.refresh_usage_snapshot(full=full),
+            "timestamp": datetime.now()
+        }
+        
+    except Exception as e:
+        logger.error(f"Erro ao atualizar snapshot de treinamento: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao atualizar snapshot: {str(e)}"
+        )
+
+
 @router.get("/food-recommender-status")
 async def get_recommender_status():
     """
@@ -174,7 +359,9 @@ async def get_recommender_status():
             "trained_at": recommender.trained_at.isoformat() if recommender.trained_at else None,
             "metrics": recommender.metrics,
             "n_alimentos": len(recommender.alimento_decoder),
-            "n_features": len(recommender.feature_columns)
+            "n_features": len(recommender.feature_columns),
+            "catalogo": recommender.catalog_info(),
+            "snapshot": recommender.snapshot_info()
         }
         
     except Exception as e:
@@ -1,13 +1,21 @@
 """Router para endpoints de predições"""
 from fastapi import APIRouter, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from typing import List
 import logging
+import numpy as np
 
 from app.schemas import (
     GrowthPredictionRequest,
     CompareDietsRequest,
+    DietResponseSurfaceRequest,
+    DietOptimizationRequest,
+    TrajectoryRequest,
     PredictionResponse,
-    ComparisonResponse
+    ComparisonResponse,
+    DietResponseSurface,
+    DietOptimizationResponse,
+    TrajectoryResponse
 )
 from app.services.prediction_service import get_prediction_service
 
@@ -23,6 +31,8 @@ async def predict_growth(request: GrowthPredictionRequest):
     - **crianca_id**: ID da criança
     - **dieta_cenario**: Cenário de dieta a avaliar
     - **horizonte_dias**: Horizonte de predição em dias (padrão: 14)
+    - **zscore_alvo**: Z-score alvo para estimar dias até o objetivo (opcional)
+    - **incluir_contribuicoes**: Incluir contribuição de cada feature (opcional)
     
     Retorna predição de Δ z-score, intervalo de confiança e casos similares
     """
@@ -39,10 +49,13 @@ async def predict_growth(request: GrowthPredictionRequest):
         if request.dieta_cenario.peso_referencia_kg:
             cenario_dict['PesoReferenciaKg'] = request.dieta_cenario.peso_referencia_kg
         
-        result = prediction_service.predict_growth_for_crianca(
+        result = await run_in_threadpool(
+            prediction_service.predict_growth_for_crianca,
             crianca_id=str(request.crianca_id),
             dieta_cenario=cenario_dict,
-            horizonte_dias=request.horizonte_dias
+            horizonte_dias=request.horizonte_dias,
+            zscore_alvo=request.zscore_alvo,
+            incluir_contribuicoes=request.incluir_contribuicoes
         )
         
         return result
@@ -68,6 +81,7 @@ async def compare_diet_scenarios(request: CompareDietsRequest):
     
     - **crianca_id**: ID da criança
     - **cenarios**: Lista de 2 a 10 cenários de dieta para comparar
+    - **incluir_contribuicoes**: Incluir contribuição de cada feature (opcional)
     
     Retorna comparação ranqueada dos cenários
     """
@@ -87,9 +101,11 @@ async def compare_diet_scenarios(request: CompareDietsRequest):
             
             cenarios_list.append(cenario_dict)
         
-        result = prediction_service.compare_diets_for_crianca(
+        result = await run_in_threadpool(
+            prediction_service.compare_diets_for_crianca,
             crianca_id=str(request.crianca_id),
-            cenarios=cenarios_list
+            cenarios=cenarios_list,
+            incluir_contribuicoes=request.incluir_contribuicoes
         )
         
         return result
@@ -108,6 +124,147 @@ async def compare_diet_scenarios(request: CompareDietsRequest):
         )
 
 
+@router.post("/response-surface", response_model=DietResponseSurface, status_code=status.HTTP_200_OK)
+async def diet_response_surface(request: DietResponseSurfaceRequest):
+    """
+    Avalia Δ z-score previsto sobre uma grade energia × proteína × frequência
+    
+    - **crianca_id**: ID da criança
+    - **energia_min/energia_max/energia_passos**: Eixo de energia (kcal/kg/dia)
+    - **proteina_min/proteina_max/proteina_passos**: Eixo de proteína (g/kg/dia)
+    - **frequencias_horas**: Frequências a avaliar
+    
+    A grade é predita em um único lote e fica em cache por versão dos dados da criança
+    """
+    try:
+        prediction_service = get_prediction_service()
+        
+        energias = np.linspace(request.energia_min, request.energia_max, request.energia_passos).round(4).tolist()
+        proteinas = np.linspace(request.proteina_min, request.proteina_max, request.proteina_passos).round(4).tolist()
+        
+        result = await run_in_threadpool(
+            prediction_service.get_diet_response_surface,
+            crianca_id=str(request.crianca_id),
+            energias=energias,
+            proteinas=proteinas,
+            frequencias=sorted(set(request.frequencias_horas)),
+            horizonte_dias=request.horizonte_dias
+        )
+        
+        return result
+        
+    except ValueError as e:
+        logger.error(f"Erro de validação: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.error(f"Erro ao calcular superfície de resposta: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao processar superfície de resposta: {str(e)}"
+        )
+
+
+@router.post("/optimize-diet", response_model=DietOptimizationResponse, status_code=status.HTTP_200_OK)
+async def optimize_diet(request: DietOptimizationRequest):
+    """
+    Busca o cenário de dieta com maior Δ z-score previsto sob restrições clínicas
+    
+    - **crianca_id**: ID da criança
+    - **energia_min/energia_max**: Faixa de energia permitida (kcal/kg/dia)
+    - **proteina_min/proteina_max**: Faixa de proteína permitida (g/kg/dia)
+    - **frequencias_permitidas**: Frequências permitidas (horas)
+    
+    Retorna o melhor cenário, sua predição e o custo da busca
+    """
+    try:
+        prediction_service = get_prediction_service()
+        
+        result = await run_in_threadpool(
+            prediction_service.optimize_diet_for_crianca,
+            crianca_id=str(request.crianca_id),
+            restricoes={
+                'energia_min': request.energia_min,
+                'energia_max': request.energia_max,
+                'proteina_min': request.proteina_min,
+                'proteina_max': request.proteina_max,
+                'frequencias': request.frequencias_permitidas,
+            },
+            horizonte_dias=request.horizonte_dias,
+            n_pontos=request.n_pontos,
+            n_refinamentos=request.n_refinamentos
+        )
+        
+        return result
+        
+    except ValueError as e:
+        logger.error(f"Erro de validação: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.error(f"Erro ao otimizar dieta: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao processar otimização: {str(e)}"
+        )
+
+
+@router.post("/trajectory", response_model=TrajectoryResponse, status_code=status.HTTP_200_OK)
+async def simulate_trajectory(request: TrajectoryRequest):
+    """
+    Projeta trajetórias de z-score passo a passo para crianças e cenários
+    
+    - **crianca_ids**: IDs das crianças (1 a 50)
+    - **cenarios**: Cenários de dieta (1 a 10)
+    - **n_passos/passo_dias**: Número e tamanho dos passos simulados
+    - **zscore_alvo**: Z-score alvo para estimar dias até o objetivo (opcional)
+    
+    Retorna uma curva projetada por combinação criança × cenário
+    """
+    try:
+        prediction_service = get_prediction_service()
+        
+        cenarios_list = []
+        for cenario in request.cenarios:
+            cenario_dict = {
+                'TaxaEnergeticaKcalKg': cenario.taxa_energetica_kcal_kg,
+                'MetaProteinaGKg': cenario.meta_proteina_g_kg,
+                'FrequenciaHoras': cenario.frequencia_horas,
+            }
+            if cenario.peso_referencia_kg:
+                cenario_dict['PesoReferenciaKg'] = cenario.peso_referencia_kg
+            
+            cenarios_list.append(cenario_dict)
+        
+        result = await run_in_threadpool(
+            prediction_service.simulate_trajectories,
+            crianca_ids=[str(crianca_id) for crianca_id in request.crianca_ids],
+            cenarios=cenarios_list,
+            n_passos=request.n_passos,
+            passo_dias=request.passo_dias,
+            zscore_alvo=request.zscore_alvo
+        )
+        
+        return result
+        
+    except ValueError as e:
+        logger.error(f"Erro de validação: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.error(f"Erro ao simular trajetória: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao processar simulação: {str(e)}"
+        )
+
+
 @router.get("/quick-predict/{crianca_id}")
 async def quick_predict(crianca_id: str, taxa_energia: float = 120, meta_proteina: float = 3.0):
     """
@@ -128,7 +285,8 @@ async def quick_predict(crianca_id: str, taxa_energia: float = 120, meta_protein
             'FrequenciaHoras': 3.0,
         }
         
-        result = prediction_service.predict_growth_for_crianca(
+        result = await run_in_threadpool(
+            prediction_service.predict_growth_for_crianca,
             crianca_id=crianca_id,
             dieta_cenario=cenario,
             horizonte_dias=14
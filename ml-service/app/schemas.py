@@ -1,5 +1,5 @@
 """Schemas Pydantic para validação de dados"""
-from pydantic import BaseModel, Field, UUID4
+from pydantic import BaseModel, Field, UUID4, model_validator
 from typing import Optional, List
 from datetime import datetime
 
@@ -19,12 +19,96 @@ class GrowthPredictionRequest(BaseModel):
     crianca_id: UUID4
     dieta_cenario: DietScenario
     horizonte_dias: int = Field(14, ge=1, le=90, description="Horizonte de predição em dias")
+    zscore_alvo: Optional[float] = Field(None, description="Z-score alvo para estimar dias até o objetivo")
+    incluir_contribuicoes: bool = Field(False, description="Incluir contribuição de cada feature na predição")
 
 
 class CompareDietsRequest(BaseModel):
     """Request para comparação de múltiplos cenários de dieta"""
     crianca_id: UUID4
     cenarios: List[DietScenario] = Field(..., min_length=2, max_length=10)
+    incluir_contribuicoes: bool = Field(False, description="Incluir contribuição de cada feature nas predições")
+
+
+class DietResponseSurfaceRequest(BaseModel):
+    """Request para superfície de resposta energia × proteína × frequência"""
+    crianca_id: UUID4
+    energia_min: float = Field(80, ge=80, le=200, description="Taxa energética mínima (kcal/kg/dia)")
+    energia_max: float = Field(200, ge=80, le=200, description="Taxa energética máxima (kcal/kg/dia)")
+    energia_passos: int = Field(50, ge=2, le=200, description="Número de pontos no eixo de energia")
+    proteina_min: float = Field(1.5, ge=1.5, le=5.0, description="Meta proteica mínima (g/kg/dia)")
+    proteina_max: float = Field(5.0, ge=1.5, le=5.0, description="Meta proteica máxima (g/kg/dia)")
+    proteina_passos: int = Field(50, ge=2, le=200, description="Número de pontos no eixo de proteína")
+    frequencias_horas: List[float] = Field([2, 3, 4, 6], min_length=1, max_length=12, description="Frequências em horas")
+    horizonte_dias: int = Field(14, ge=1, le=90, description="Horizonte de predição em dias")
+    
+    @model_validator(mode='after')
+    def validar_limites(self):
+        if self.energia_min > self.energia_max:
+            raise ValueError("energia_min deve ser menor ou igual a energia_max")
+        if self.proteina_min > self.proteina_max:
+            raise ValueError("proteina_min deve ser menor ou igual a proteina_max")
+        if any(f < 1 or f > 24 for f in self.frequencias_horas):
+            raise ValueError("frequencias_horas devem estar entre 1 e 24")
+        return self
+
+
+class DietOptimizationRequest(BaseModel):
+    """Request para otimização de dieta sob restrições clínicas"""
+    crianca_id: UUID4
+    energia_min: float = Field(80, ge=80, le=200, description="Taxa energética mínima (kcal/kg/dia)")
+    energia_max: float = Field(200, ge=80, le=200, description="Taxa energética máxima (kcal/kg/dia)")
+    proteina_min: float = Field(1.5, ge=1.5, le=5.0, description="Meta proteica mínima (g/kg/dia)")
+    proteina_max: float = Field(5.0, ge=1.5, le=5.0, description="Meta proteica máxima (g/kg/dia)")
+    frequencias_permitidas: List[float] = Field([2, 3, 4, 6], min_length=1, max_length=12, description="Frequências permitidas em horas")
+    horizonte_dias: int = Field(14, ge=1, le=90, description="Horizonte de predição em dias")
+    n_pontos: int = Field(11, ge=3, le=50, description="Pontos por eixo em cada etapa da busca")
+    n_refinamentos: int = Field(3, ge=0, le=8, description="Etapas de refinamento após a grade inicial")
+    
+    @model_validator(mode='after')
+    def validar_limites(self):
+        if self.energia_min > self.energia_max:
+            raise ValueError("energia_min deve ser menor ou igual a energia_max")
+        if self.proteina_min > self.proteina_max:
+            raise ValueError("proteina_min deve ser menor ou igual a proteina_max")
+        if any(f < 1 or f > 24 for f in self.frequencias_permitidas):
+            raise ValueError("frequencias_permitidas devem estar entre 1 e 24")
+        return self
+
+
+class TrajectoryRequest(BaseModel):
+    """Request para simulação de trajetória de z-score"""
+    crianca_ids: List[UUID4] = Field(..., min_length=1, max_length=50)
+    cenarios: List[DietScenario] = Field(..., min_length=1, max_length=10)
+    n_passos: int = Field(6, ge=1, le=52, description="Número de passos simulados")
+    passo_dias: int = Field(14, ge=1, le=90, description="Dias por passo")
+    zscore_alvo: Optional[float] = Field(None, description="Z-score alvo para estimar dias até o objetivo")
+
+
+class SimilarityProfile(BaseModel):
+    """Perfil avulso para busca de casos similares"""
+    identificador: Optional[str] = Field(None, description="Identificador livre devolvido na resposta")
+    idade_gestacional_semanas: Optional[float] = Field(None, ge=20, le=45)
+    peso_nascimento_gr: Optional[float] = Field(None, ge=200, le=6000)
+    sexo: Optional[str] = Field(None, pattern="^[MF]$")
+    apgar_1_minuto: Optional[int] = Field(None, ge=0, le=10)
+    apgar_5_minuto: Optional[int] = Field(None, ge=0, le=10)
+    zscore_peso: Optional[float] = None
+
+
+class SimilarCasesBatchRequest(BaseModel):
+    """Request para busca de casos similares de várias crianças/perfis"""
+    crianca_ids: List[UUID4] = Field(default_factory=list, max_length=500)
+    perfis: List[SimilarityProfile] = Field(default_factory=list, max_length=500)
+    top_n: int = Field(10, ge=1, le=50, description="Casos por criança/perfil")
+    sexo: Optional[str] = Field(None, pattern="^[MF]$", description="Restringir a casos deste sexo")
+    classificacao_ig: Optional[str] = Field(None, description="Restringir a casos desta classificação IG")
+    
+    @model_validator(mode='after')
+    def validar_entrada(self):
+        if not self.crianca_ids and not self.perfis:
+            raise ValueError("Informe crianca_ids e/ou perfis")
+        return self
 
 
 class ChatRequest(BaseModel):
@@ -43,6 +127,13 @@ class IntervalConfidence(BaseModel):
     confidence_level: float = 0.95
 
 
+class FeatureContribution(BaseModel):
+    """Contribuição de uma feature para a predição"""
+    feature: str
+    valor: float = Field(..., description="Valor da feature usado na predição")
+    contribuicao: float = Field(..., description="Contribuição para o Δ z-score previsto")
+
+
 class GrowthPrediction(BaseModel):
     """Predição de crescimento"""
     delta_zscore_pred: float = Field(..., description="Mudança prevista no z-score")
@@ -51,6 +142,8 @@ class GrowthPrediction(BaseModel):
     zscore_final_esperado: Optional[float] = None
     dias_para_objetivo: Optional[int] = None
     confiabilidade: str = Field(..., description="alta, media, baixa")
+    contribuicao_base: Optional[float] = Field(None, description="Valor base do modelo (soma com as contribuições = predição)")
+    contribuicoes: Optional[List[FeatureContribution]] = None
 
 
 class DietComparison(BaseModel):
@@ -85,6 +178,20 @@ class SimilarCase(BaseModel):
     similarity_score: float = Field(..., ge=0, le=1)
 
 
+class SimilarCasesResult(BaseModel):
+    """Casos similares de uma criança ou perfil do lote"""
+    crianca_id: Optional[UUID4] = None
+    identificador: Optional[str] = None
+    casos: List[SimilarCase]
+
+
+class SimilarCasesBatchResponse(BaseModel):
+    """Resposta da busca de casos similares em lote"""
+    resultados: List[SimilarCasesResult]
+    nao_encontradas: List[str] = []
+    tempo_ms: float
+
+
 class CriancaPerfil(BaseModel):
     """Perfil resumido de uma criança"""
     id: UUID4
@@ -117,6 +224,58 @@ class ComparisonResponse(BaseModel):
     timestamp: datetime
 
 
+class DietResponseSurface(BaseModel):
+    """Superfície de Δ z-score previsto sobre a grade de dietas"""
+    crianca_id: UUID4
+    energias_kcal_kg: List[float]
+    proteinas_g_kg: List[float]
+    frequencias_horas: List[float]
+    delta_zscore: List[List[List[float]]] = Field(..., description="Δ z-score indexado por [frequencia][energia][proteina]")
+    melhor_cenario: DietScenario
+    melhor_delta_zscore: float
+    horizonte_dias: int
+    feature_version: str
+    n_avaliacoes: int
+    cache_hit: bool
+    tempo_ms: float
+    timestamp: datetime
+
+
+class SearchCost(BaseModel):
+    """Custo de uma busca por cenários"""
+    n_avaliacoes: int = Field(..., description="Número de cenários avaliados pelo modelo")
+    n_lotes: int = Field(..., description="Número de chamadas em lote ao modelo")
+    tempo_ms: float
+
+
+class DietOptimizationResponse(BaseModel):
+    """Resposta da otimização de dieta"""
+    crianca: CriancaPerfil
+    melhor_cenario: DietScenario
+    predicao: GrowthPrediction
+    custo_busca: SearchCost
+    timestamp: datetime
+
+
+class TrajectoryProjection(BaseModel):
+    """Trajetória projetada de uma criança sob um cenário"""
+    crianca_id: UUID4
+    cenario: DietScenario
+    dias: List[int]
+    zscores: List[float]
+    pesos_gr: List[float]
+    dias_para_objetivo: Optional[int] = None
+
+
+class TrajectoryResponse(BaseModel):
+    """Resposta da simulação de trajetórias"""
+    trajetorias: List[TrajectoryProjection]
+    zscore_alvo: Optional[float] = None
+    n_passos: int
+    passo_dias: int
+    timestamp: datetime
+
+
 class AnalyticsStats(BaseModel):
     """Estatísticas gerais do sistema"""
     total_criancas: int
@@ -128,6 +287,33 @@ class AnalyticsStats(BaseModel):
     updated_at: datetime
 
 
+class RiskScore(BaseModel):
+    """Score de risco de uma criança sob a dieta vigente"""
+    ranking: int
+    crianca_id: UUID4
+    nome: Optional[str] = None
+    dieta_id: Optional[str] = None
+    ultima_consulta: Optional[datetime] = None
+    taxa_energetica_kcal_kg: Optional[float] = None
+    meta_proteina_g_kg: Optional[float] = None
+    frequencia_horas: Optional[float] = None
+    zscore_atual: Optional[float] = None
+    delta_zscore_pred: float
+    zscore_final_esperado: Optional[float] = None
+    probabilidade_melhora: float
+    risco: bool
+
+
+class RiskScoresPage(BaseModel):
+    """Página da lista de scores de risco"""
+    itens: List[RiskScore]
+    total: int
+    pagina: int
+    tamanho_pagina: int
+    gerado_em: Optional[datetime] = None
+    model_version: Optional[str] = None
+
+
 class ChatMessage(BaseModel):
     """Mensagem no chat"""
     role: str = Field(..., pattern="^(user|assistant|system)$")
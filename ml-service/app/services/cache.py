@@ -0,0 +1,89 @@
+"""Cache em memória para resultados de predição"""
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, Optional
+import time
+
+
+class LRUCache:
+    """Cache LRU thread-safe com tamanho máximo e validade opcional (TTL)"""
+
+    def __init__(self, maxsize: int = 256, ttl_seconds: Optional[float] = None):
+        """
+        Inicializa o cache
+
+        Args:
+            maxsize: Número máximo de entradas mantidas
+            ttl_seconds: Validade de cada entrada em segundos (None = sem expiração)
+        """
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict = OrderedDict()  # chave -> (expira_em, valor)
+        self._lock = Lock()
+
+        # Métricas
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Retorna valor em cache (ou None) e marca a entrada como recente"""
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+
+            expira_em, value = self._data[key]
+            if expira_em is not None and time.monotonic() >= expira_em:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """Armazena valor, descartando a entrada menos recente se necessário"""
+        expira_em = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+        with self._lock:
+            self._data[key] = (expira_em, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> bool:
+        """Remove uma entrada; retorna se ela existia"""
+        with self._lock:
+            if self._data.pop(key, None) is None:
+                return False
+            self.invalidations += 1
+            return True
+
+    def clear(self):
+        """Remove todas as entradas"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        """Tamanho, configuração e contadores de acertos, faltas e descartes"""
+        with self._lock:
+            consultas = self.hits + self.misses
+            return {
+                'tamanho': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / consultas if consultas else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def __len__(self) -> int:
+        return len(self._data)
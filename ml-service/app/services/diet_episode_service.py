@@ -0,0 +1,341 @@
+"""Tabela materializada de episódios de dieta e seus desfechos"""
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from typing import Dict, List, Optional
+import logging
+import time
+
+from app.config import settings
+from app.services.cache import LRUCache
+from app.services.etl_service import ETLService
+
+logger = logging.getLogger(__name__)
+
+# Janela (em dias de calendário) da consulta final após a inicial
+DIAS_FINAL_MIN = 7
+DIAS_FINAL_MAX = 21
+
+# Colunas de perfil aceitas como filtro de efetividade
+FILTRO_COLUNAS = {'classificacao_ig': 'ClassificacaoIG', 'sexo': 'Sexo'}
+
+
+class DietEpisodeTable:
+    """
+    Episódios de dieta (dieta × alimento × criança) com desfecho
+
+    Cada item de dieta é associado à primeira consulta com z-score a partir
+    do início da dieta e à primeira consulta 7-21 dias depois dela, como as
+    subconsultas CROSS APPLY TOP 1 usadas antes por alimento. A tabela é
+    montada em memória com duas queries em lote e resumida por alimento ×
+    sexo × classificação IG, de modo que a efetividade de qualquer alimento
+    e filtro é obtida somando estratos.
+    """
+
+    # Estratos dos agregados (chaves de filtro + alimento)
+    ESTRATO_COLUNAS = ['AlimentoId', 'Sexo', 'ClassificacaoIG']
+
+    # Rankings (por filtro/agrupamento) mantidos por versão da tabela
+    MAX_LEADERBOARDS = 32
+
+    def __init__(self):
+        self.episodios: Optional[pd.DataFrame] = None
+        self._agregados: Optional[pd.DataFrame] = None
+        self._alimentos: Dict[str, Dict] = {}
+        self.data_watermark = None  # Consulta final mais recente entre os episódios
+        self.built_at = None
+        self.versao = 0  # Incrementada a cada reconstrução
+        self._refresh_lock = Lock()
+        self._leaderboards = LRUCache(maxsize=self.MAX_LEADERBOARDS)
+
+    @staticmethod
+    def build_episodes(itens: pd.DataFrame, consultas: pd.DataFrame) -> pd.DataFrame:
+        """
+        Associa cada item de dieta às consultas inicial e final
+
+        Args:
+            itens: Itens de dieta (ETLService.get_diet_items)
+            consultas: Consultas com z-score (ETLService.get_weighed_consultations)
+
+        Returns:
+            DataFrame com uma linha por item com desfecho
+        """
+        if itens.empty or consultas.empty:
+            return pd.DataFrame()
+
+        itens = itens.assign(
+            _crianca=itens['CriancaId'].astype(str).str.lower(),
+            DataInicio=pd.to_datetime(itens['DataInicio'])
+        )
+        itens = itens[itens['DataInicio'].notna()]
+
+        consultas = consultas.assign(
+            _crianca=consultas['CriancaId'].astype(str).str.lower(),
+            DataHora=pd.to_datetime(consultas['DataHora'])
+        ).drop(columns='CriancaId')
+        consultas = consultas[consultas['DataHora'].notna()].sort_values('DataHora', kind='stable')
+
+        def consulta(sufixo: str) -> pd.DataFrame:
+            return consultas.rename(columns={
+                'DataHora': f'Data{sufixo}', 'PesoGr': f'Peso{sufixo}', 'ZScorePeso': f'ZScore{sufixo}'
+            })
+
+        # Primeira consulta com DataHora >= início da dieta
+        df = pd.merge_asof(
+            itens.sort_values('DataInicio', kind='stable'), consulta('Inicial'),
+            left_on='DataInicio', right_on='DataInicial', by='_crianca',
+            direction='forward', allow_exact_matches=True
+        )
+        df = df[df['DataInicial'].notna()]
+
+        # Primeira consulta com DATEDIFF(day) >= 7 após a inicial; como a
+        # diferença em dias cresce com a data, ela é a única candidata e só
+        # precisa ainda respeitar o máximo de 21 dias
+        df['_limite'] = df['DataInicial'].dt.normalize() + pd.Timedelta(days=DIAS_FINAL_MIN)
+        df = pd.merge_asof(
+            df.sort_values('_limite', kind='stable'), consulta('Final'),
+            left_on='_limite', right_on='DataFinal', by='_crianca',
+            direction='forward', allow_exact_matches=True
+        )
+
+        dias = (df['DataFinal'].dt.normalize() - df['DataInicial'].dt.normalize()).dt.days
+        df = df[df['DataFinal'].notna() & (dias <= DIAS_FINAL_MAX)].copy()
+
+        df['DiasAcompanhamento'] = dias[df.index].astype(np.int64)
+        df['DiasDeVida'] = (
+            df['DataInicial'].dt.normalize() - pd.to_datetime(df['DataNascimento']).dt.normalize()
+        ).dt.days
+        df['DeltaZScore'] = df['ZScoreFinal'] - df['ZScoreInicial']
+        df['GanhoPesoGrDia'] = (df['PesoFinal'] - df['PesoInicial']) / df['DiasAcompanhamento']
+
+        return df.drop(columns=['_crianca', '_limite']).reset_index(drop=True)
+
+    @classmethod
+    def _agregar(cls, episodios: pd.DataFrame) -> pd.DataFrame:
+        """Somas por alimento × sexo × classificação IG (valores ausentes viram '')"""
+        if episodios.empty:
+            return pd.DataFrame(columns=['n', 'soma_delta', 'n_sucesso', 'soma_ganho', 'n_ganho'])
+
+        chaves = [episodios['AlimentoId'].astype(str).str.lower()] + [
+            episodios[col].fillna('').astype(str) for col in cls.ESTRATO_COLUNAS[1:]
+        ]
+        delta = pd.to_numeric(episodios['DeltaZScore'], errors='coerce')
+        ganho = pd.to_numeric(episodios['GanhoPesoGrDia'], errors='coerce')
+
+        valores = pd.DataFrame({
+            'n': 1,
+            'soma_delta': delta,
+            'n_sucesso': (delta > 0).astype(np.int64),
+            'soma_ganho': ganho.fillna(0.0),
+            'n_ganho': ganho.notna().astype(np.int64),
+        })
+        agregados = valores.groupby(chaves, sort=True).sum()
+        agregados.index.names = cls.ESTRATO_COLUNAS
+        return agregados
+
+    def refresh(self) -> Dict:
+        """
+        Reconstrói a tabela a partir do banco (duas queries em lote)
+
+        Returns:
+            Metadados da reconstrução
+        """
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self) -> Dict:
+        """Reconstrução propriamente dita (chamar com _refresh_lock)"""
+        inicio = time.perf_counter()
+
+        episodios = self.build_episodes(ETLService.get_diet_items(), ETLService.get_weighed_consultations())
+        agregados = self._agregar(episodios)
+
+        alimentos = {}
+        if not episodios.empty:
+            unicos = episodios.drop_duplicates('AlimentoId')
+            alimentos = {
+                str(alimento_id).lower(): {'nome': nome, 'categoria': categoria}
+                for alimento_id, nome, categoria in zip(unicos['AlimentoId'], unicos['AlimentoNome'], unicos['Categoria'])
+            }
+
+        # Troca atômica: consultas concorrentes veem a tabela anterior ou a nova
+        self.episodios, self._agregados, self._alimentos = episodios, agregados, alimentos
+        self.data_watermark = episodios['DataFinal'].max() if not episodios.empty else None
+        self.built_at = datetime.now()
+        self.versao += 1
+
+        info = self.info()
+        info['tempo_s'] = round(time.perf_counter() - inicio, 2)
+        logger.info(f"Tabela de episódios de dieta reconstruída: {info}")
+        return info
+
+    def refresh_async(self) -> bool:
+        """Reconstrói em segundo plano (False se já em andamento)"""
+        if self._refresh_lock.locked():
+            return False
+
+        def _run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Erro ao reconstruir episódios de dieta: {e}", exc_info=True)
+
+        Thread(target=_run, name="diet-episodes-refresh", daemon=True).start()
+        return True
+
+    def _ensure_built(self):
+        """Constrói na primeira consulta e agenda reconstrução quando antiga"""
+        if self.built_at is None:
+            with self._refresh_lock:
+                if self.built_at is None:
+                    self._refresh()
+        elif datetime.now() - self.built_at > timedelta(minutes=settings.DIET_EPISODES_REFRESH_MINUTES):
+            self.refresh_async()
+
+    def get_episodes(self) -> pd.DataFrame:
+        """Tabela de episódios atual (construída na primeira chamada)"""
+        self._ensure_built()
+        return self.episodios
+
+    def get_aggregates(self) -> pd.DataFrame:
+        """Somas por alimento × sexo × classificação IG (construídas na primeira chamada)"""
+        self._ensure_built()
+        return self._agregados
+
+    def food_effectiveness(self, alimento_id: str, perfil_filter: Optional[Dict] = None) -> Dict:
+        """
+        Efetividade de um alimento, opcionalmente para um perfil
+
+        Args:
+            alimento_id: ID do alimento
+            perfil_filter: Filtros de perfil ('classificacao_ig', 'sexo')
+
+        Returns:
+            Dicionário com total de usos, médias de Δ z-score e ganho de peso
+            (g/dia) e taxa de sucesso (%)
+        """
+        agregados = self.get_aggregates()
+        chave = str(alimento_id).lower()
+
+        resumo = None
+        if not agregados.empty and chave in agregados.index.get_level_values('AlimentoId'):
+            linhas = agregados.xs(chave, level='AlimentoId', drop_level=False)
+            for filtro, coluna in FILTRO_COLUNAS.items():
+                valor = (perfil_filter or {}).get(filtro)
+                if valor:
+                    linhas = linhas[linhas.index.get_level_values(coluna) == str(valor)]
+            resumo = linhas.sum()
+
+        if resumo is None or resumo['n'] == 0:
+            return {
+                'alimento_id': alimento_id,
+                'total_usos': 0,
+                'media_delta_zscore': 0,
+                'media_ganho_peso': 0,
+                'taxa_sucesso': 0
+            }
+
+        return {
+            'alimento_id': alimento_id,
+            'total_usos': int(resumo['n']),
+            'media_delta_zscore': float(resumo['soma_delta'] / resumo['n']),
+            'media_ganho_peso': float(resumo['soma_ganho'] / resumo['n_ganho']) if resumo['n_ganho'] else 0.0,
+            'taxa_sucesso': float(resumo['n_sucesso'] * 100.0 / resumo['n'])
+        }
+
+    def leaderboard(
+        self,
+        classificacao_ig: Optional[str] = None,
+        sexo: Optional[str] = None,
+        agrupar_por: Optional[List[str]] = None,
+        min_usos: int = 1
+    ) -> Dict:
+        """
+        Efetividade de todos os alimentos em uma única agregação
+
+        Resultados ficam em cache por versão da tabela: reconstruções
+        invalidam todos os rankings anteriores.
+
+        Args:
+            classificacao_ig: Considerar apenas episódios desta classificação IG
+            sexo: Considerar apenas episódios deste sexo
+            agrupar_por: Dimensões adicionais do ranking ('sexo', 'classificacao_ig')
+            min_usos: Mínimo de usos para o alimento entrar no ranking
+
+        Returns:
+            Dicionário com 'alimentos' (ordenados por taxa de sucesso e número
+            de usos), 'data_watermark', 'versao' e 'built_at'
+        """
+        agrupar_por = [dim for dim in FILTRO_COLUNAS if dim in (agrupar_por or [])]
+        self._ensure_built()
+        versao, agregados = self.versao, self._agregados
+
+        chave = (versao, classificacao_ig, sexo, tuple(agrupar_por), min_usos)
+        resultado = self._leaderboards.get(chave)
+        if resultado is not None:
+            return resultado
+
+        linhas = agregados
+        for filtro, valor in (('classificacao_ig', classificacao_ig), ('sexo', sexo)):
+            if valor and not linhas.empty:
+                linhas = linhas[linhas.index.get_level_values(FILTRO_COLUNAS[filtro]) == str(valor)]
+
+        alimentos = []
+        if not linhas.empty:
+            niveis = ['AlimentoId'] + [FILTRO_COLUNAS[dim] for dim in agrupar_por]
+            soma = linhas.groupby(level=niveis, sort=False).sum()
+            soma = soma[soma['n'] >= max(min_usos, 1)]
+
+            tabela = pd.DataFrame({
+                'total_usos': soma['n'].astype(np.int64),
+                'media_delta_zscore': soma['soma_delta'] / soma['n'],
+                'media_ganho_peso': (soma['soma_ganho'] / soma['n_ganho'].replace(0, np.nan)).fillna(0.0),
+                'taxa_sucesso': soma['n_sucesso'] * 100.0 / soma['n'],
+            }).reset_index()
+            tabela = tabela.sort_values(['taxa_sucesso', 'total_usos'], ascending=False, kind='stable')
+
+            for registro in tabela.to_dict('records'):
+                alimento_id = registro.pop('AlimentoId')
+                item = {'alimento_id': alimento_id, **self._alimentos.get(alimento_id, {'nome': None, 'categoria': None})}
+                for dim in agrupar_por:
+                    valor = registro.pop(FILTRO_COLUNAS[dim])
+                    item[dim] = valor if valor != '' else None
+                item.update(registro)
+                alimentos.append(item)
+
+            for ranking, item in enumerate(alimentos, 1):
+                item['ranking'] = ranking
+
+        resultado = {
+            'alimentos': alimentos,
+            'data_watermark': self.data_watermark,
+            'versao': versao,
+            'built_at': self.built_at,
+        }
+        self._leaderboards.set(chave, resultado)
+        return resultado
+
+    def info(self) -> Dict:
+        """Metadados da tabela em memória"""
+        return {
+            'n_episodios': len(self.episodios) if self.episodios is not None else 0,
+            'n_alimentos': self._agregados.index.get_level_values('AlimentoId').nunique()
+            if self._agregados is not None and not self._agregados.empty else 0,
+            'data_watermark': self.data_watermark,
+            'versao': self.versao,
+            'built_at': self.built_at,
+            'building': self._refresh_lock.locked(),
+        }
+
+
+# Instância global (singleton)
+_diet_episode_table = None
+
+
+def get_diet_episode_table() -> DietEpisodeTable:
+    """Retorna instância singleton da tabela de episódios"""
+    global _diet_episode_table
+    if _diet_episode_table is None:
+        _diet_episode_table = DietEpisodeTable()
+    return _diet_episode_table
@@ -0,0 +1,294 @@
+"""Agregados pré-calculados de padrões de dieta por estrato clínico"""
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from typing import Dict, Optional, Tuple
+import logging
+import time
+
+from app.config import settings
+from app.services.etl_service import ETLService
+
+logger = logging.getLogger(__name__)
+
+# Chave de cada estrato (valores ausentes viram None)
+ESTRATO_COLUNAS = ['ClassificacaoIG', 'Sexo', 'ClassificacaoPeso']
+
+# Melhora mínima do z-score para um caso contar como sucesso
+LIMIAR_SUCESSO = 0.1
+
+# Métricas resumidas nos casos de sucesso: (coluna, mínimo, máximo, largura do bin)
+METRICAS = {
+    'energia': ('TaxaEnergeticaKcalKg', 0.0, 300.0, 0.5),
+    'proteina': ('MetaProteinaGKg', 0.0, 10.0, 0.01),
+    'delta_zscore': ('DeltaZScore', -5.0, 5.0, 0.01),
+}
+
+
+class HistogramSketch:
+    """
+    Resumo mergeável de uma variável: contagem, soma, extremos e histograma
+    de bins fixos
+
+    Dois resumos com os mesmos bins são combinados somando os campos, o que
+    permite agregar estratos e incorporar dados novos sem reprocessar o
+    histórico. Quantis são aproximados com erro máximo de uma largura de bin.
+    """
+
+    def __init__(self, minimo: float, maximo: float, largura: float):
+        self.minimo = minimo
+        self.largura = largura
+        self.n_bins = int(round((maximo - minimo) / largura))
+        self.hist = np.zeros(self.n_bins, dtype=np.int64)
+        self.count = 0
+        self.soma = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, valores) -> 'HistogramSketch':
+        """Incorpora valores (NaN ignorados, fora da faixa vão para os bins extremos)"""
+        valores = np.asarray(valores, dtype=np.float64)
+        valores = valores[~np.isnan(valores)]
+        if len(valores) == 0:
+            return self
+
+        bins = np.clip(np.floor((valores - self.minimo) / self.largura), 0, self.n_bins - 1).astype(np.int64)
+        self.hist += np.bincount(bins, minlength=self.n_bins)
+        self.count += len(valores)
+        self.soma += float(valores.sum())
+        self.min = min(self.min, float(valores.min()))
+        self.max = max(self.max, float(valores.max()))
+        return self
+
+    def merge(self, outro: 'HistogramSketch') -> 'HistogramSketch':
+        """Retorna um novo resumo combinando este com outro de mesmos bins"""
+        combinado = HistogramSketch(self.minimo, self.minimo + self.n_bins * self.largura, self.largura)
+        combinado.hist = self.hist + outro.hist
+        combinado.count = self.count + outro.count
+        combinado.soma = self.soma + outro.soma
+        combinado.min = min(self.min, outro.min)
+        combinado.max = max(self.max, outro.max)
+        return combinado
+
+    def mean(self) -> float:
+        return self.soma / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Quantil com interpolação linear entre estatísticas de ordem (como pandas)"""
+        if self.count == 0:
+            return 0.0
+
+        acumulado = np.cumsum(self.hist)
+        posicao = q * (self.count - 1)
+        k_inf, k_sup = int(np.floor(posicao)), int(np.ceil(posicao))
+
+        def estatistica_ordem(k: int) -> float:
+            # Valores supostos uniformemente distribuídos dentro do bin
+            b = int(np.searchsorted(acumulado, k, side='right'))
+            j = k - (acumulado[b] - self.hist[b])
+            valor = self.minimo + (b + (j + 0.5) / self.hist[b]) * self.largura
+            return float(np.clip(valor, self.min, self.max))
+
+        inferior = estatistica_ordem(k_inf)
+        return inferior + (posicao - k_inf) * (estatistica_ordem(k_sup) - inferior)
+
+
+def _novo_resumo() -> Dict:
+    return {
+        'n_total': 0,
+        'n_sucesso': 0,
+        **{nome: HistogramSketch(*limites) for nome, (_, *limites) in METRICAS.items()}
+    }
+
+
+def _merge_resumos(a: Dict, b: Dict) -> Dict:
+    return {
+        'n_total': a['n_total'] + b['n_total'],
+        'n_sucesso': a['n_sucesso'] + b['n_sucesso'],
+        **{nome: a[nome].merge(b[nome]) for nome in METRICAS}
+    }
+
+
+class DietPatternAggregates:
+    """
+    Padrões de dieta por estrato (ClassificacaoIG × Sexo × ClassificacaoPeso)
+    mantidos em memória
+
+    Cada estrato guarda contagens e resumos mergeáveis de energia, proteína
+    e Δ z-score dos casos de sucesso; consultas combinam os estratos do
+    filtro sem reler o banco. Consultas novas (após o watermark) são
+    incorporadas incrementalmente e o histórico é reprocessado por completo
+    periodicamente para absorver correções.
+    """
+
+    def __init__(self):
+        self._estratos: Dict[Tuple, Dict] = {}
+        self.data_watermark = None
+        self.refreshed_at = None
+        self.full_refreshed_at = None
+        self._refresh_lock = Lock()
+
+    @staticmethod
+    def _resumir(df: pd.DataFrame) -> Dict[Tuple, Dict]:
+        """Resumo por estrato das linhas (já com DeltaZScore)"""
+        df = df.copy()
+        for col in ESTRATO_COLUNAS:
+            if col not in df.columns:
+                df[col] = None
+
+        resumos = {}
+        for chave, grupo in df.groupby(ESTRATO_COLUNAS, dropna=False, sort=False):
+            chave = tuple(None if pd.isna(valor) else valor for valor in chave)
+            sucesso = grupo[grupo['DeltaZScore'] > LIMIAR_SUCESSO]
+
+            resumo = _novo_resumo()
+            resumo['n_total'] = len(grupo)
+            resumo['n_sucesso'] = len(sucesso)
+            for nome, (coluna, *_) in METRICAS.items():
+                resumo[nome].add(pd.to_numeric(sucesso[coluna], errors='coerce'))
+            resumos[chave] = resumo
+
+        return resumos
+
+    def refresh(self, full: bool = False) -> Dict:
+        """
+        Atualiza os agregados
+
+        Args:
+            full: Reprocessar todo o histórico (padrão: apenas consultas após o watermark)
+
+        Returns:
+            Metadados da atualização
+        """
+        with self._refresh_lock:
+            return self._refresh(full)
+
+    def _refresh(self, full: bool) -> Dict:
+        """Atualização propriamente dita (chamar com _refresh_lock)"""
+        inicio = time.perf_counter()
+        incremental = not full and self.data_watermark is not None
+
+        if incremental:
+            df = ETLService.get_timeline_since(self.data_watermark)
+        else:
+            df = ETLService.get_crianca_timeline()
+
+        n_novas = 0
+        if not df.empty:
+            # DeltaZScore em relação à consulta anterior da mesma criança
+            df = df.sort_values(['CriancaId', 'DataConsulta'])
+            df['ZScoreAnterior'] = df.groupby('CriancaId')['ZScorePeso'].shift(1)
+            df['DeltaZScore'] = df['ZScorePeso'] - df['ZScoreAnterior']
+
+            if incremental:
+                df = df[df['DataConsulta'] > pd.Timestamp(self.data_watermark)]
+
+            n_novas = len(df)
+
+        if n_novas:
+            novos = self._resumir(df)
+            estratos = dict(self._estratos) if incremental else {}
+            for chave, resumo in novos.items():
+                estratos[chave] = _merge_resumos(estratos[chave], resumo) if chave in estratos else resumo
+
+            self._estratos = estratos
+            self.data_watermark = df['DataConsulta'].max()
+        elif not incremental:
+            self._estratos = {}
+
+        self.refreshed_at = datetime.now()
+        if not incremental:
+            self.full_refreshed_at = self.refreshed_at
+
+        info = {
+            'modo': 'incremental' if incremental else 'full',
+            'n_consultas': n_novas,
+            'n_estratos': len(self._estratos),
+            'data_watermark': self.data_watermark,
+            'tempo_s': round(time.perf_counter() - inicio, 2),
+        }
+        logger.info(f"Agregados de padrões de dieta atualizados: {info}")
+        return info
+
+    def refresh_async(self) -> bool:
+        """Atualiza em segundo plano conforme a idade dos agregados (False se já em andamento)"""
+        if self._refresh_lock.locked():
+            return False
+
+        full = self.full_refreshed_at is None or (
+            datetime.now() - self.full_refreshed_at > timedelta(hours=settings.DIET_PATTERNS_FULL_REFRESH_HOURS)
+        )
+
+        def _run():
+            try:
+                self.refresh(full=full)
+            except Exception as e:
+                logger.error(f"Erro ao atualizar padrões de dieta: {e}", exc_info=True)
+
+        Thread(target=_run, name="diet-patterns-refresh", daemon=True).start()
+        return True
+
+    def get_patterns(
+        self,
+        classificacao_ig: Optional[str] = None,
+        sexo: Optional[str] = None,
+        classificacao_peso: Optional[str] = None
+    ) -> Dict:
+        """
+        Padrões de dieta dos casos de sucesso para o filtro informado
+
+        Args:
+            classificacao_ig: Filtrar por classificação IG
+            sexo: Filtrar por sexo
+            classificacao_peso: Filtrar por classificação de peso ao nascer
+
+        Returns:
+            Dicionário com padrões encontrados (vazio se não houver casos)
+        """
+        if self.refreshed_at is None:
+            # Primeira consulta: construir de forma síncrona (ou aguardar a
+            # construção iniciada na inicialização)
+            with self._refresh_lock:
+                if self.refreshed_at is None:
+                    self._refresh(full=True)
+        elif datetime.now() - self.refreshed_at > timedelta(minutes=settings.DIET_PATTERNS_REFRESH_MINUTES):
+            self.refresh_async()
+
+        filtro = (classificacao_ig, sexo, classificacao_peso)
+        resumo = None
+        for chave, parcial in self._estratos.items():
+            if all(valor is None or valor == chave[i] for i, valor in enumerate(filtro)):
+                resumo = parcial if resumo is None else _merge_resumos(resumo, parcial)
+
+        if resumo is None or resumo['n_total'] == 0:
+            return {}
+
+        def distribuicao(sketch: HistogramSketch) -> Dict:
+            return {
+                'media': float(sketch.mean()),
+                'mediana': float(sketch.quantile(0.5)),
+                'q25': float(sketch.quantile(0.25)),
+                'q75': float(sketch.quantile(0.75)),
+            }
+
+        return {
+            'total_casos': resumo['n_total'],
+            'casos_sucesso': resumo['n_sucesso'],
+            'taxa_sucesso': resumo['n_sucesso'] / resumo['n_total'],
+            'energia': distribuicao(resumo['energia']),
+            'proteina': distribuicao(resumo['proteina']),
+            'delta_zscore_medio': float(resumo['delta_zscore'].mean()),
+        }
+
+
+# Instância global (singleton)
+_diet_pattern_aggregates = None
+
+
+def get_diet_pattern_aggregates() -> DietPatternAggregates:
+    """Retorna instância singleton dos agregados"""
+    global _diet_pattern_aggregates
+    if _diet_pattern_aggregates is None:
+        _diet_pattern_aggregates = DietPatternAggregates()
+    return _diet_pattern_aggregates
@@ -1,14 +1,20 @@
 """Serviço de ETL para extração e transformação de dados"""
 import pandas as pd
 import numpy as np
-from typing import Optional, Dict, List
+import hashlib
+from typing import Optional, Dict, List, Iterator
 from datetime import datetime, timedelta
 import logging
 
-from app.database import execute_query
+from app.database import execute_query, iter_query
+from app.services.singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+# Consultas por criança em andamento (requisições simultâneas da mesma tela
+# compartilham a mesma query)
+_inflight = SingleFlight()
+
 
 class ETLService:
     """Serviço para extração e transformação de dados do banco"""
@@ -18,15 +24,65 @@ class ETLService:
         """
         Extrai timeline completa de uma ou todas as crianças
         
+        Chamadas simultâneas para a mesma criança compartilham uma única query
+        e o mesmo DataFrame (somente leitura; copiar antes de alterar).
+        
         Args:
             crianca_id: ID da criança (opcional, None = todas)
             
         Returns:
             DataFrame com timeline
         """
-        where_clause = f"AND rn.Id = '{crianca_id}'" if crianca_id else ""
+        if not crianca_id:
+            return execute_query(ETLService._timeline_query(""))
         
-        query = f"""
+        return _inflight.do(
+            ('timeline', str(crianca_id).lower()),
+            execute_query, ETLService._timeline_query(f"AND rn.Id = '{crianca_id}'")
+        )
+    
+    @staticmethod
+    def get_timeline_for_criancas(crianca_ids: List[str]) -> pd.DataFrame:
+        """
+        Extrai timeline de um conjunto de crianças em uma única query
+        
+        Args:
+            crianca_ids: IDs das crianças
+            
+        Returns:
+            DataFrame com timeline de todas as crianças informadas
+        """
+        if len(crianca_ids) == 0:
+            return pd.DataFrame()
+        
+        # Um parâmetro por ID (nada interpolado na query)
+        params = {f"id{i}": str(crianca_id) for i, crianca_id in enumerate(crianca_ids)}
+        marcadores = ", ".join(f":{nome}" for nome in params)
+        
+        return execute_query(ETLService._timeline_query(f"AND rn.Id IN ({marcadores})"), params)
+    
+    @staticmethod
+    def get_timeline_since(desde: datetime) -> pd.DataFrame:
+        """
+        Extrai a timeline completa das crianças com consultas após uma data
+        
+        Args:
+            desde: Data de corte (exclusiva)
+            
+        Returns:
+            DataFrame com a timeline inteira dessas crianças (inclui consultas
+            anteriores ao corte, necessárias para as features de lag)
+        """
+        return execute_query(ETLService._timeline_query("""
+        AND rn.Id IN (
+            SELECT RecemNascidoId FROM clinica.Consulta
+            WHERE DataHora > :desde
+        )"""), {'desde': pd.Timestamp(desde).to_pydatetime()})
+    
+    @staticmethod
+    def _timeline_query(where_clause: str) -> str:
+        """Monta query da timeline com filtro adicional"""
+        return f"""
         SELECT 
             rn.Id as CriancaId,
             rn.Sexo,
@@ -69,9 +125,50 @@ class ETLService:
         {where_clause}
         ORDER BY rn.Id, c.DataHora
         """
+    
+    @staticmethod
+    def iter_active_cohort(chunk_size: int = 500) -> Iterator[pd.DataFrame]:
+        """
+        Percorre em blocos as crianças com dieta vigente
         
-        df = execute_query(query)
-        return df
+        Cada linha traz a criança e sua dieta vigente mais recente
+        (nutricao.Dieta iniciada e não encerrada).
+        
+        Args:
+            chunk_size: Número de crianças por bloco
+            
+        Yields:
+            DataFrames com CriancaId, Nome e campos da dieta vigente
+        """
+        query = """
+        SELECT 
+            CriancaId,
+            Nome,
+            DietaId,
+            DietaDataInicio,
+            TaxaEnergeticaKcalKg,
+            MetaProteinaGKg,
+            FrequenciaHoras
+        FROM (
+            SELECT 
+                rn.Id as CriancaId,
+                rn.Nome,
+                d.Id as DietaId,
+                d.DataInicio as DietaDataInicio,
+                d.TaxaEnergeticaKcalKg,
+                d.MetaProteinaGKg,
+                d.FrequenciaHoras,
+                ROW_NUMBER() OVER (PARTITION BY rn.Id ORDER BY d.DataInicio DESC) as Ordem
+            FROM clinica.RecemNascido rn
+            INNER JOIN nutricao.Dieta d ON rn.Id = d.RecemNascidoId
+            WHERE d.DataInicio <= GETDATE()
+            AND (d.DataFim IS NULL OR d.DataFim >= GETDATE())
+        ) dieta_vigente
+        WHERE Ordem = 1
+        ORDER BY CriancaId
+        """
+        
+        yield from iter_query(query, chunksize=chunk_size)
     
     @staticmethod
     def compute_features(df: pd.DataFrame) -> pd.DataFrame:
@@ -130,18 +227,41 @@ class ETLService:
         return df
     
     @staticmethod
-    def prepare_training_data(horizonte_dias: int = 14) -> pd.DataFrame:
+    def feature_version(df: pd.DataFrame) -> str:
+        """
+        Calcula versão das features a partir do conteúdo da timeline
+        
+        Qualquer consulta ou dieta nova/corrigida altera o hash, o que permite
+        usar a versão como chave de cache de resultados derivados.
+        
+        Args:
+            df: DataFrame com timeline (bruta) de uma criança
+            
+        Returns:
+            Hash hexadecimal curto
+        """
+        row_hashes = pd.util.hash_pandas_object(df, index=False).values
+        return hashlib.sha1(row_hashes.tobytes()).hexdigest()[:16]
+    
+    @staticmethod
+    def prepare_training_data(horizonte_dias: int = 14, desde: Optional[datetime] = None) -> pd.DataFrame:
         """
         Prepara dados para treinamento do modelo
         
         Args:
             horizonte_dias: Horizonte de predição (quantos dias à frente)
+            desde: Se informado, apenas amostras cujo desfecho (DataFutura) é
+                posterior a esta data; a timeline completa das crianças
+                envolvidas ainda é usada para as features de lag
             
         Returns:
             DataFrame com features (X) e target (y)
         """
         # Extrair timeline
-        df = ETLService.get_crianca_timeline()
+        if desde is None:
+            df = ETLService.get_crianca_timeline()
+        else:
+            df = ETLService.get_timeline_since(desde)
         
         if df.empty:
             logger.warning("Nenhum dado encontrado para treinamento")
@@ -177,6 +297,9 @@ class ETLService:
         # Remover linhas com valores nulos no target
         df_train = df_train.dropna(subset=['Target_DeltaZScore'])
         
+        if desde is not None:
+            df_train = df_train[df_train['DataFutura'] > pd.Timestamp(desde)]
+        
         logger.info(f"Dados de treinamento preparados: {len(df_train)} amostras")
         
         return df_train
@@ -186,12 +309,20 @@ class ETLService:
         """
         Obtém perfil completo de uma criança
         
+        Chamadas simultâneas para a mesma criança compartilham uma única query
+        e o mesmo dicionário (somente leitura; copiar antes de alterar).
+        
         Args:
             crianca_id: ID da criança
             
         Returns:
             Dicionário com dados da criança
         """
+        return _inflight.do(('perfil', str(crianca_id).lower()), ETLService._query_crianca_perfil, crianca_id)
+    
+    @staticmethod
+    def _query_crianca_perfil(crianca_id: str) -> Optional[Dict]:
+        """Query do perfil de uma criança (ver get_crianca_perfil)"""
         query = f"""
         SELECT 
             rn.Id,
@@ -264,6 +395,81 @@ class ETLService:
         
         return df.iloc[0].to_dict()
     
+    @staticmethod
+    def get_diet_items() -> pd.DataFrame:
+        """
+        Extrai todos os itens de dieta com dados da dieta, do alimento e da criança
+        
+        Returns:
+            DataFrame com uma linha por item de dieta
+        """
+        query = """
+        SELECT 
+            di.DietaId,
+            di.AlimentoId,
+            d.RecemNascidoId as CriancaId,
+            d.DataInicio,
+            d.TaxaEnergeticaKcalKg,
+            d.MetaProteinaGKg,
+            di.Quantidade,
+            
+            a.Nome as AlimentoNome,
+            a.Categoria,
+            a.EnergiaKcalPor100,
+            a.ProteinaGPor100,
+            a.EhPreTermo,
+            
+            rn.Sexo,
+            rn.DataNascimento,
+            rn.IdadeGestacionalSemanas,
+            rn.PesoNascimentoGr,
+            rn.ClassificacaoIG,
+            rn.ClassificacaoPN as ClassificacaoPeso
+            
+        FROM nutricao.DietaItem di
+        INNER JOIN nutricao.Dieta d ON di.DietaId = d.Id
+        INNER JOIN clinica.RecemNascido rn ON d.RecemNascidoId = rn.Id
+        INNER JOIN nutricao.Alimento a ON di.AlimentoId = a.Id
+        """
+        
+        return execute_query(query)
+    
+    @staticmethod
+    def get_weighed_consultations() -> pd.DataFrame:
+        """
+        Extrai as consultas com z-score de peso das crianças que têm dieta
+        
+        Returns:
+            DataFrame com CriancaId, DataHora, PesoGr e ZScorePeso
+        """
+        query = """
+        SELECT 
+            c.RecemNascidoId as CriancaId,
+            c.DataHora,
+            c.PesoKg * 1000 as PesoGr,
+            c.ZScorePeso
+        FROM clinica.Consulta c
+        WHERE c.ZScorePeso IS NOT NULL
+        AND c.RecemNascidoId IN (SELECT RecemNascidoId FROM nutricao.Dieta)
+        """
+        
+        return execute_query(query)
+    
+    @staticmethod
+    def get_consulta_watermark() -> Optional[datetime]:
+        """
+        Obtém a data da consulta mais recente registrada
+        
+        Returns:
+            Data/hora da última consulta ou None se não houver consultas
+        """
+        df = execute_query("SELECT MAX(DataHora) as Watermark FROM clinica.Consulta")
+        
+        if df.empty or pd.isna(df.iloc[0]['Watermark']):
+            return None
+        
+        return df.iloc[0]['Watermark']
+    
     @staticmethod
     def get_statistics() -> Dict:
         """
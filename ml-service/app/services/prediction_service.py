@@ -1,11 +1,18 @@
 """Serviço de predições - orquestra modelos e ETL"""
 import logging
+import time
+import numpy as np
 from typing import Dict, List, Optional
 from datetime import datetime
+from threading import Lock
 
+from app.config import settings
 from app.models.growth_predictor import get_growth_predictor
 from app.models.diet_analyzer import get_diet_analyzer
+from app.models.trajectory_simulator import get_trajectory_simulator
+from app.services.cache import LRUCache
 from app.services.etl_service import ETLService
+from app.services.singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
@@ -17,13 +24,193 @@ class PredictionService:
         """Inicializa o serviço"""
         self.growth_predictor = get_growth_predictor()
         self.diet_analyzer = get_diet_analyzer()
+        self.trajectory_simulator = get_trajectory_simulator()
         self.etl_service = ETLService()
+        self.surface_cache = LRUCache(maxsize=settings.PREDICTION_CACHE_SIZE)
+        self.contribution_cache = LRUCache(maxsize=settings.PREDICTION_CACHE_SIZE)
+        self._inflight = SingleFlight()
+        self.context_cache = LRUCache(
+            maxsize=settings.CHILD_CONTEXT_CACHE_SIZE,
+            ttl_seconds=settings.CHILD_CONTEXT_CACHE_TTL_SECONDS
+        )
+        # Cargas de contexto em andamento por criança: [geração, nº de cargas];
+        # a geração é incrementada a cada invalidação e a entrada removida
+        # quando a última carga termina
+        self._context_loads: Dict[str, List[int]] = {}
+        self._context_lock = Lock()
+    
+    def _crianca_context(self, crianca_id: str) -> Dict:
+        """
+        Perfil, timeline com features, última medida e versão das features
+        
+        O contexto fica em cache até o backend invalidar a criança (ao salvar
+        consultas ou dietas) ou o TTL expirar, e é compartilhado entre as
+        requisições: é somente leitura (quem precisar alterar a timeline ou os
+        dicionários deve copiá-los). Requisições simultâneas para a mesma
+        criança (a tela dispara predição, casos similares, perfil e timeline
+        juntos) compartilham uma única carga e cálculo de features.
+        
+        Args:
+            crianca_id: ID da criança
+            
+        Returns:
+            Dicionário com 'perfil' (None se não encontrada), 'timeline'
+            (None se não encontrada; vazia se sem consultas), 'ultima_medida'
+            e 'feature_version' (None se sem consultas)
+        """
+        chave = str(crianca_id).lower()
+        
+        contexto = self.context_cache.get(chave)
+        if contexto is not None:
+            return contexto
+        
+        # A geração na chave impede que uma carga iniciada antes de uma
+        # invalidação seja aproveitada ou guardada depois dela
+        with self._context_lock:
+            cargas = self._context_loads.setdefault(chave, [0, 0])
+            cargas[1] += 1
+            geracao = cargas[0]
+        
+        contexto = None
+        try:
+            contexto = self._inflight.do(('contexto', chave, geracao), self._build_crianca_context, crianca_id)
+        finally:
+            with self._context_lock:
+                cargas[1] -= 1
+                if cargas[1] == 0:
+                    del self._context_loads[chave]
+                if contexto is not None and cargas[0] == geracao:
+                    self.context_cache.set(chave, contexto)
+        
+        return contexto
+    
+    def invalidate_crianca_context(self, crianca_id: str) -> bool:
+        """
+        Descarta o contexto em cache de uma criança
+        
+        Chamado pelo backend sempre que consultas ou dietas da criança são
+        salvas; a próxima requisição recarrega do banco.
+        
+        Args:
+            crianca_id: ID da criança
+            
+        Returns:
+            Se havia contexto em cache
+        """
+        chave = str(crianca_id).lower()
+        with self._context_lock:
+            cargas = self._context_loads.get(chave)
+            if cargas is not None:
+                cargas[0] += 1
+            return self.context_cache.delete(chave)
+    
+    def context_cache_stats(self) -> Dict:
+        """Métricas do cache de contexto e das cargas compartilhadas"""
+        return {
+            **self.context_cache.stats(),
+            'cargas': self._inflight.stats(),
+        }
+    
+    def _build_crianca_context(self, crianca_id: str) -> Dict:
+        """Carga do contexto da criança (ver _crianca_context)"""
+        contexto = {'perfil': None, 'timeline': None, 'ultima_medida': None, 'feature_version': None}
+        
+        # Obter perfil da criança
+        contexto['perfil'] = self.etl_service.get_crianca_perfil(crianca_id)
+        if not contexto['perfil']:
+            return contexto
+        
+        # Obter timeline para calcular features
+        df_timeline = self.etl_service.get_crianca_timeline(crianca_id)
+        contexto['timeline'] = df_timeline
+        if df_timeline.empty:
+            return contexto
+        
+        contexto['feature_version'] = self.etl_service.feature_version(df_timeline)
+        
+        # Computar features e pegar última medida
+        df_timeline = self.etl_service.compute_features(df_timeline)
+        contexto['timeline'] = df_timeline
+        contexto['ultima_medida'] = df_timeline.iloc[-1].to_dict()
+        
+        return contexto
+    
+    def _load_crianca_context(self, crianca_id: str) -> Dict:
+        """
+        Carrega perfil, timeline com features e versão das features
+        
+        Args:
+            crianca_id: ID da criança
+            
+        Returns:
+            Dicionário com 'perfil', 'timeline' (features computadas),
+            'ultima_medida' e 'feature_version'
+        """
+        contexto = self._crianca_context(crianca_id)
+        
+        if not contexto['perfil']:
+            raise ValueError(f"Criança {crianca_id} não encontrada")
+        
+        if contexto['timeline'].empty:
+            raise ValueError(f"Nenhum dado de timeline encontrado para criança {crianca_id}")
+        
+        return contexto
+    
+    def _explain_scenarios(
+        self,
+        crianca_id: str,
+        contexto: Dict,
+        cenarios: List[Dict],
+        horizonte_dias: int = 14
+    ) -> List[Dict]:
+        """
+        Predições com contribuição por feature, em cache por versão das features
+        
+        Cenários ausentes do cache são calculados juntos em um único lote.
+        
+        Args:
+            crianca_id: ID da criança
+            contexto: Contexto carregado por _load_crianca_context
+            cenarios: Cenários de dieta
+            horizonte_dias: Horizonte em dias
+            
+        Returns:
+            Lista de predições (com 'contribuicoes') na ordem dos cenários
+        """
+        chaves = [
+            (
+                crianca_id,
+                contexto['feature_version'],
+                self.growth_predictor.model_version,
+                tuple(sorted(cenario.items())),
+                horizonte_dias
+            )
+            for cenario in cenarios
+        ]
+        resultados = [self.contribution_cache.get(chave) for chave in chaves]
+        
+        faltantes = [i for i, resultado in enumerate(resultados) if resultado is None]
+        if faltantes:
+            novos = self.growth_predictor.predict_scenarios(
+                crianca_features=contexto['ultima_medida'],
+                cenarios=[cenarios[i] for i in faltantes],
+                horizonte_dias=horizonte_dias,
+                incluir_contribuicoes=True
+            )
+            for i, resultado in zip(faltantes, novos):
+                self.contribution_cache.set(chaves[i], resultado)
+                resultados[i] = resultado
+        
+        # Cópias rasas: o chamador pode acrescentar campos à predição
+        return [dict(resultado) for resultado in resultados]
     
     def predict_growth_for_crianca(
         self, 
         crianca_id: str,
         dieta_cenario: Dict,
-        horizonte_dias: int = 14
+        horizonte_dias: int = 14,
+        zscore_alvo: Optional[float] = None,
+        incluir_contribuicoes: bool = False
     ) -> Dict:
         """
         Faz predição de crescimento para uma criança
@@ -32,27 +219,14 @@ class PredictionService:
             crianca_id: ID da criança
             dieta_cenario: Cenário de dieta
             horizonte_dias: Horizonte em dias
+            zscore_alvo: Z-score alvo para estimar dias até o objetivo (opcional)
+            incluir_contribuicoes: Incluir contribuição de cada feature na predição
             
         Returns:
             Dicionário com predição completa
         """
-        # Obter perfil da criança
-        crianca_perfil = self.etl_service.get_crianca_perfil(crianca_id)
-        
-        if not crianca_perfil:
-            raise ValueError(f"Criança {crianca_id} não encontrada")
-        
-        # Obter timeline para calcular features
-        df_timeline = self.etl_service.get_crianca_timeline(crianca_id)
-        
-        if df_timeline.empty:
-            raise ValueError(f"Nenhum dado de timeline encontrado para criança {crianca_id}")
-        
-        # Computar features
-        df_timeline = self.etl_service.compute_features(df_timeline)
-        
-        # Pegar última medida
-        ultima_medida = df_timeline.iloc[-1].to_dict()
+        contexto = self._load_crianca_context(crianca_id)
+        crianca_perfil, ultima_medida = contexto['perfil'], contexto['ultima_medida']
         
         # Combinar com cenário de dieta
         features = {
@@ -61,11 +235,26 @@ class PredictionService:
         }
         
         # Fazer predição
-        predicao = self.growth_predictor.predict_zscore_change(
-            crianca_features=features,
-            dieta_features=dieta_cenario,
-            horizonte_dias=horizonte_dias
-        )
+        if incluir_contribuicoes:
+            predicao = self._explain_scenarios(crianca_id, contexto, [dieta_cenario], horizonte_dias)[0]
+        else:
+            predicao = self.growth_predictor.predict_zscore_change(
+                crianca_features=features,
+                dieta_features=dieta_cenario,
+                horizonte_dias=horizonte_dias
+            )
+        
+        # Estimar dias até o objetivo simulando a trajetória
+        if zscore_alvo is not None:
+            trajetoria = self.trajectory_simulator.simulate(
+                timelines=[contexto['timeline']],
+                cenarios=[dieta_cenario],
+                n_passos=settings.TRAJECTORY_MAX_PASSOS,
+                passo_dias=horizonte_dias,
+                zscore_alvo=zscore_alvo
+            )
+            dias = trajetoria['dias_para_objetivo'][0, 0]
+            predicao['dias_para_objetivo'] = None if np.isnan(dias) else int(np.ceil(dias))
         
         # Buscar casos similares
         casos_similares = self.diet_analyzer.find_similar_cases(
@@ -87,7 +276,8 @@ class PredictionService:
     def compare_diets_for_crianca(
         self, 
         crianca_id: str,
-        cenarios: List[Dict]
+        cenarios: List[Dict],
+        incluir_contribuicoes: bool = False
     ) -> Dict:
         """
         Compara múltiplos cenários de dieta para uma criança
@@ -95,33 +285,29 @@ class PredictionService:
         Args:
             crianca_id: ID da criança
             cenarios: Lista de cenários de dieta
+            incluir_contribuicoes: Incluir contribuição de cada feature nas predições
             
         Returns:
             Dicionário com comparações
         """
-        # Obter perfil da criança
-        crianca_perfil = self.etl_service.get_crianca_perfil(crianca_id)
-        
-        if not crianca_perfil:
-            raise ValueError(f"Criança {crianca_id} não encontrada")
-        
-        # Obter timeline
-        df_timeline = self.etl_service.get_crianca_timeline(crianca_id)
-        
-        if df_timeline.empty:
-            raise ValueError(f"Nenhum dado de timeline encontrado para criança {crianca_id}")
+        contexto = self._load_crianca_context(crianca_id)
+        crianca_perfil, ultima_medida = contexto['perfil'], contexto['ultima_medida']
         
-        # Computar features
-        df_timeline = self.etl_service.compute_features(df_timeline)
-        ultima_medida = df_timeline.iloc[-1].to_dict()
+        predicoes = None
+        if incluir_contribuicoes:
+            predicoes = self._explain_scenarios(crianca_id, contexto, cenarios)
         
         # Comparar cenários
         comparacoes = self.diet_analyzer.compare_diet_scenarios(
             crianca_perfil=ultima_medida,
             dietas_cenarios=cenarios,
-            growth_predictor=self.growth_predictor
+            growth_predictor=self.growth_predictor,
+            predicoes=predicoes
         )
         
+        for comparacao in comparacoes:
+            comparacao['cenario'] = self._format_cenario(comparacao['cenario'])
+        
         # Melhor cenário
         melhor_cenario = comparacoes[0]['cenario'] if comparacoes else None
         
@@ -132,40 +318,308 @@ class PredictionService:
             'timestamp': datetime.now()
         }
     
-    def get_similar_cases(self, crianca_id: str, top_n: int = 10) -> List[Dict]:
+    def optimize_diet_for_crianca(
+        self,
+        crianca_id: str,
+        restricoes: Dict,
+        horizonte_dias: int = 14,
+        n_pontos: int = 11,
+        n_refinamentos: int = 3
+    ) -> Dict:
+        """
+        Busca o cenário de dieta com maior Δ z-score previsto para uma criança
+        
+        Args:
+            crianca_id: ID da criança
+            restricoes: Limites de energia/proteína e frequências permitidas
+            horizonte_dias: Horizonte em dias
+            n_pontos: Pontos por eixo em cada etapa da busca
+            n_refinamentos: Etapas de refinamento
+            
+        Returns:
+            Dicionário com melhor cenário, predição e custo da busca
+        """
+        contexto = self._load_crianca_context(crianca_id)
+        crianca_perfil, ultima_medida = contexto['perfil'], contexto['ultima_medida']
+        
+        resultado = self.diet_analyzer.optimize_diet_scenario(
+            crianca_perfil=ultima_medida,
+            growth_predictor=self.growth_predictor,
+            energia_min=restricoes['energia_min'],
+            energia_max=restricoes['energia_max'],
+            proteina_min=restricoes['proteina_min'],
+            proteina_max=restricoes['proteina_max'],
+            frequencias=restricoes['frequencias'],
+            horizonte_dias=horizonte_dias,
+            n_pontos=n_pontos,
+            n_refinamentos=n_refinamentos
+        )
+        
+        return {
+            'crianca': self._format_crianca_perfil(crianca_perfil),
+            'melhor_cenario': self._format_cenario(resultado['cenario']),
+            'predicao': resultado['predicao'],
+            'custo_busca': resultado['custo_busca'],
+            'timestamp': datetime.now()
+        }
+    
+    def get_diet_response_surface(
+        self,
+        crianca_id: str,
+        energias: List[float],
+        proteinas: List[float],
+        frequencias: List[float],
+        horizonte_dias: int = 14
+    ) -> Dict:
+        """
+        Avalia a superfície de resposta Δ z-score sobre uma grade de dietas
+        
+        A grade inteira é predita em um único lote e o resultado fica em cache
+        por versão das features da criança e versão do modelo.
+        
+        Args:
+            crianca_id: ID da criança
+            energias: Taxas energéticas da grade (kcal/kg/dia)
+            proteinas: Metas proteicas da grade (g/kg/dia)
+            frequencias: Frequências da grade (horas)
+            horizonte_dias: Horizonte em dias
+            
+        Returns:
+            Dicionário com a superfície e o melhor ponto da grade
+        """
+        inicio = time.perf_counter()
+        
+        contexto = self._load_crianca_context(crianca_id)
+        ultima_medida, feature_version = contexto['ultima_medida'], contexto['feature_version']
+        
+        cache_key = (
+            crianca_id,
+            feature_version,
+            self.growth_predictor.model_version,
+            tuple(energias),
+            tuple(proteinas),
+            tuple(frequencias),
+            horizonte_dias
+        )
+        surface = self.surface_cache.get(cache_key)
+        cache_hit = surface is not None
+        
+        if not cache_hit:
+            grid = self.growth_predictor.predict_diet_grid(
+                crianca_features=ultima_medida,
+                energias=np.asarray(energias),
+                proteinas=np.asarray(proteinas),
+                frequencias=np.asarray(frequencias)
+            )
+            
+            # Melhor ponto da grade
+            i_freq, i_energia, i_proteina = np.unravel_index(np.argmax(grid), grid.shape)
+            
+            surface = {
+                'crianca_id': crianca_id,
+                'energias_kcal_kg': list(energias),
+                'proteinas_g_kg': list(proteinas),
+                'frequencias_horas': list(frequencias),
+                'delta_zscore': grid.tolist(),
+                'melhor_cenario': {
+                    'taxa_energetica_kcal_kg': float(energias[i_energia]),
+                    'meta_proteina_g_kg': float(proteinas[i_proteina]),
+                    'frequencia_horas': float(frequencias[i_freq]),
+                },
+                'melhor_delta_zscore': float(grid[i_freq, i_energia, i_proteina]),
+                'horizonte_dias': horizonte_dias,
+                'feature_version': feature_version,
+                'n_avaliacoes': int(grid.size),
+            }
+            self.surface_cache.set(cache_key, surface)
+        
+        return {
+            **surface,
+            'cache_hit': cache_hit,
+            'tempo_ms': (time.perf_counter() - inicio) * 1000,
+            'timestamp': datetime.now()
+        }
+    
+    def simulate_trajectories(
+        self,
+        crianca_ids: List[str],
+        cenarios: List[Dict],
+        n_passos: int = 6,
+        passo_dias: int = 14,
+        zscore_alvo: Optional[float] = None
+    ) -> Dict:
+        """
+        Projeta trajetórias de z-score para várias crianças e cenários
+        
+        Args:
+            crianca_ids: IDs das crianças
+            cenarios: Cenários de dieta
+            n_passos: Número de passos simulados
+            passo_dias: Dias por passo
+            zscore_alvo: Z-score alvo (opcional)
+            
+        Returns:
+            Dicionário com uma trajetória por combinação criança × cenário
+        """
+        timelines = [self._load_crianca_context(crianca_id)['timeline'] for crianca_id in crianca_ids]
+        
+        resultado = self.trajectory_simulator.simulate(
+            timelines=timelines,
+            cenarios=cenarios,
+            n_passos=n_passos,
+            passo_dias=passo_dias,
+            zscore_alvo=zscore_alvo
+        )
+        
+        trajetorias = []
+        for i, crianca_id in enumerate(crianca_ids):
+            for j, cenario in enumerate(cenarios):
+                dias = resultado['dias_para_objetivo'][i, j]
+                trajetorias.append({
+                    'crianca_id': crianca_id,
+                    'cenario': self._format_cenario(cenario),
+                    'dias': resultado['dias'].tolist(),
+                    'zscores': resultado['zscores'][i, j].tolist(),
+                    'pesos_gr': resultado['pesos'][i, j].tolist(),
+                    'dias_para_objetivo': None if np.isnan(dias) else int(np.ceil(dias))
+                })
+        
+        return {
+            'trajetorias': trajetorias,
+            'zscore_alvo': zscore_alvo,
+            'n_passos': n_passos,
+            'passo_dias': passo_dias,
+            'timestamp': datetime.now()
+        }
+    
+    def get_similar_cases(
+        self,
+        crianca_id: str,
+        top_n: int = 10,
+        sexo: Optional[str] = None,
+        classificacao_ig: Optional[str] = None
+    ) -> List[Dict]:
         """
         Busca casos similares
         
         Args:
             crianca_id: ID da criança
             top_n: Número de casos
+            sexo: Restringir a casos deste sexo (opcional)
+            classificacao_ig: Restringir a casos desta classificação IG (opcional)
             
         Returns:
             Lista de casos similares
         """
-        # Obter perfil da criança
-        crianca_perfil = self.etl_service.get_crianca_perfil(crianca_id)
+        contexto = self._crianca_context(crianca_id)
         
-        if not crianca_perfil:
+        if not contexto['perfil']:
             raise ValueError(f"Criança {crianca_id} não encontrada")
         
-        # Obter timeline
-        df_timeline = self.etl_service.get_crianca_timeline(crianca_id)
-        
-        if not df_timeline.empty:
-            df_timeline = self.etl_service.compute_features(df_timeline)
-            ultima_medida = df_timeline.iloc[-1].to_dict()
-        else:
-            ultima_medida = crianca_perfil
+        # Última medida da timeline (ou perfil cadastral, se sem consultas)
+        ultima_medida = contexto['ultima_medida'] or contexto['perfil']
         
         # Buscar similares
         casos = self.diet_analyzer.find_similar_cases(
             crianca_perfil=ultima_medida,
-            top_n=top_n
+            top_n=top_n,
+            sexo=sexo,
+            classificacao_ig=classificacao_ig
         )
         
         return casos
     
+    def get_similar_cases_batch(
+        self,
+        crianca_ids: List[str],
+        perfis: Optional[List[Dict]] = None,
+        top_n: int = 10,
+        sexo: Optional[str] = None,
+        classificacao_ig: Optional[str] = None
+    ) -> Dict:
+        """
+        Busca casos similares para várias crianças e perfis avulsos
+        
+        As timelines são extraídas em uma única query e todas as consultas
+        ao índice são feitas em um único lote.
+        
+        Args:
+            crianca_ids: IDs das crianças
+            perfis: Perfis avulsos já no formato do índice (opcional)
+            top_n: Número de casos por criança/perfil
+            sexo: Restringir a casos deste sexo (opcional)
+            classificacao_ig: Restringir a casos desta classificação IG (opcional)
+            
+        Returns:
+            Dicionário com 'resultados' (na ordem recebida, crianças primeiro),
+            'nao_encontradas' e 'tempo_ms'
+        """
+        inicio = time.perf_counter()
+        perfis = perfis or []
+        
+        # Última medida de cada criança a partir da timeline em lote
+        ultimas = {}
+        if crianca_ids:
+            df_timeline = self.etl_service.get_timeline_for_criancas(crianca_ids)
+            if not df_timeline.empty:
+                df_timeline = self.etl_service.compute_features(df_timeline)
+                for registro in df_timeline.groupby('CriancaId').tail(1).to_dict('records'):
+                    ultimas[str(registro['CriancaId']).lower()] = registro
+        
+        consultas = []
+        nao_encontradas = []
+        for crianca_id in crianca_ids:
+            ultima_medida = ultimas.get(str(crianca_id).lower())
+            if ultima_medida is None:
+                # Sem consultas: usar perfil cadastral, como na busca individual
+                ultima_medida = self.etl_service.get_crianca_perfil(crianca_id)
+            if not ultima_medida:
+                nao_encontradas.append(str(crianca_id))
+                continue
+            consultas.append(({'crianca_id': str(crianca_id)}, ultima_medida))
+        
+        for perfil in perfis:
+            consultas.append(({'identificador': perfil.get('identificador')}, perfil))
+        
+        casos = self.diet_analyzer.find_similar_cases_batch(
+            perfis=[perfil for _, perfil in consultas],
+            top_n=top_n,
+            sexo=sexo,
+            classificacao_ig=classificacao_ig
+        )
+        
+        return {
+            'resultados': [{**chave, 'casos': c} for (chave, _), c in zip(consultas, casos)],
+            'nao_encontradas': nao_encontradas,
+            'tempo_ms': (time.perf_counter() - inicio) * 1000
+        }
+    
+    def refresh_similarity_index_for_crianca(self, crianca_id: str) -> Dict:
+        """
+        Atualiza no índice de casos similares as consultas de uma criança
+        
+        Chamado quando consultas são registradas, corrigidas ou excluídas;
+        uma criança sem consultas é removida do índice.
+        
+        Args:
+            crianca_id: ID da criança
+            
+        Returns:
+            Resultado da atualização incremental
+        """
+        self.invalidate_crianca_context(crianca_id)
+        
+        # Query própria (não compartilhada com cargas em andamento, que podem
+        # ter começado antes da alteração das consultas)
+        df_timeline = self.etl_service.get_timeline_for_criancas([crianca_id])
+        
+        if df_timeline.empty:
+            return self.diet_analyzer.remove_crianca(crianca_id)
+        
+        return self.diet_analyzer.upsert_crianca(
+            crianca_id, self.etl_service.compute_features(df_timeline)
+        )
+    
     def get_analytics_stats(self) -> Dict:
         """Retorna estatísticas gerais do sistema"""
         stats = self.etl_service.get_statistics()
@@ -188,6 +642,15 @@ class PredictionService:
             'dias_de_vida': int(crianca_dict.get('DiasDeVida', 0))
         }
     
+    def _format_cenario(self, cenario: Dict) -> Dict:
+        """Formata cenário de dieta (colunas do modelo) para resposta"""
+        return {
+            'taxa_energetica_kcal_kg': cenario['TaxaEnergeticaKcalKg'],
+            'meta_proteina_g_kg': cenario['MetaProteinaGKg'],
+            'frequencia_horas': cenario['FrequenciaHoras'],
+            'peso_referencia_kg': cenario.get('PesoReferenciaKg'),
+        }
+    
     def _gerar_recomendacao(self, predicao: Dict, casos_similares: List[Dict]) -> str:
         """Gera recomendação baseada na predição e casos similares"""
         delta_esperado = predicao['delta_zscore_pred']
@@ -0,0 +1,82 @@
+"""Coalescência de chamadas simultâneas com a mesma chave"""
+from threading import Event, Lock
+from typing import Any, Callable, Dict, Hashable
+
+
+class _Chamada:
+    """Execução em andamento e seu resultado"""
+
+    def __init__(self):
+        self.concluida = Event()
+        self.resultado = None
+        self.erro = None
+
+
+class SingleFlight:
+    """
+    Garante uma única execução em andamento por chave
+
+    A primeira thread a pedir uma chave executa a função; as que pedirem a
+    mesma chave enquanto ela roda aguardam e recebem o mesmo resultado (ou a
+    mesma exceção). Nada é guardado após a conclusão: chamadas posteriores
+    executam de novo. O resultado é o mesmo objeto para todas as threads,
+    sem cópia: é somente leitura, e quem precisar alterá-lo deve copiá-lo.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._chamadas: Dict[Hashable, _Chamada] = {}
+        self.executadas = 0
+        self.compartilhadas = 0
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Executa fn(*args, **kwargs) ou aguarda a execução em andamento da chave
+
+        Args:
+            key: Chave da execução (ex.: ('perfil', crianca_id))
+            fn: Função a executar
+
+        Returns:
+            Resultado de fn (compartilhado; não alterar)
+        """
+        with self._lock:
+            chamada = self._chamadas.get(key)
+            lider = chamada is None
+            if lider:
+                chamada = self._chamadas[key] = _Chamada()
+                self.executadas += 1
+            else:
+                self.compartilhadas += 1
+
+        if not lider:
+            chamada.concluida.wait()
+            if chamada.erro is not None:
+                raise chamada.erro
+            return chamada.resultado
+
+        try:
+            resultado = fn(*args, **kwargs)
+        except BaseException as e:
+            chamada.erro = e
+            self._concluir(key, chamada)
+            raise
+
+        chamada.resultado = resultado
+        self._concluir(key, chamada)
+        return resultado
+
+    def _concluir(self, key: Hashable, chamada: _Chamada):
+        """Libera a chave e as threads em espera"""
+        with self._lock:
+            del self._chamadas[key]
+        chamada.concluida.set()
+
+    def stats(self) -> Dict:
+        """Contadores de execuções e de chamadas que aproveitaram uma em andamento"""
+        with self._lock:
+            return {
+                'executadas': self.executadas,
+                'compartilhadas': self.compartilhadas,
+                'em_andamento': len(self._chamadas),
+            }
@@ -0,0 +1,212 @@
+"""Snapshot colunar versionado de dados de treinamento"""
+import json
+import os
+import shutil
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+
+# Tipos aceitos no esquema do snapshot
+TIPOS = ('str', 'float', 'bool', 'datetime')
+
+
+class ColumnarSnapshot:
+    """
+    Dados de treinamento gravados em disco como partes colunares (.npz)
+
+    Cada versão é um diretório com partes numeradas; o manifesto na raiz
+    aponta para a versão atual, lista as partes e guarda o watermark (maior
+    valor da coluna de watermark já gravado). Uma reconstrução completa
+    grava uma nova versão e só troca o manifesto no final; novas linhas são
+    acrescentadas como partes adicionais da versão atual.
+    """
+
+    def __init__(self, path: str, schema: Dict[str, str], watermark_column: str):
+        """
+        Inicializa o snapshot
+
+        Args:
+            path: Diretório raiz do snapshot
+            schema: Colunas e tipos ('str', 'float', 'bool' ou 'datetime')
+            watermark_column: Coluna datetime usada para acréscimos incrementais
+        """
+        invalidos = {col: tipo for col, tipo in schema.items() if tipo not in TIPOS}
+        if invalidos:
+            raise ValueError(f"Tipos de coluna inválidos no snapshot: {invalidos}")
+
+        self.path = path
+        self.schema = schema
+        self.watermark_column = watermark_column
+        self._write_lock = Lock()
+
+    @property
+    def manifest(self) -> Optional[Dict]:
+        """Manifesto da versão atual (None se não houver snapshot)"""
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    @property
+    def watermark(self) -> Optional[pd.Timestamp]:
+        """Maior valor da coluna de watermark já gravado"""
+        manifest = self.manifest
+        if manifest is None or manifest.get('watermark') is None:
+            return None
+        return pd.Timestamp(manifest['watermark'])
+
+    def _write_manifest(self, manifest: Dict):
+        """Grava o manifesto de forma atômica"""
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def _write_part(self, diretorio: str, numero: int, df: pd.DataFrame) -> Dict:
+        """Grava um bloco como parte colunar e retorna sua entrada no manifesto"""
+        arrays = {}
+        for col, tipo in self.schema.items():
+            serie = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+
+            if tipo == 'float':
+                arrays[col] = pd.to_numeric(serie, errors='coerce').to_numpy(dtype=np.float64)
+            elif tipo == 'bool':
+                arrays[col] = serie.fillna(False).astype(bool).to_numpy()
+            elif tipo == 'datetime':
+                arrays[col] = pd.to_datetime(serie).to_numpy(dtype='datetime64[ns]')
+            else:
+                # Strings sem pickle: ausentes gravados como '' com máscara
+                nulos = serie.isna().to_numpy()
+                arrays[col] = np.where(nulos, '', serie.astype(str).to_numpy()).astype(str)
+                arrays[f'{col}__nulo'] = nulos
+
+        arquivo = f"part-{numero:05d}.npz"
+        np.savez(os.path.join(diretorio, arquivo), **arrays)
+
+        watermark = pd.to_datetime(df[self.watermark_column]).max() if len(df) else None
+        return {
+            'arquivo': arquivo,
+            'n_linhas': len(df),
+            'watermark': None if pd.isna(watermark) else pd.Timestamp(watermark).isoformat(),
+        }
+
+    def _write_parts(self, diretorio: str, primeiro: int, chunks: Iterable[pd.DataFrame]) -> List[Dict]:
+        """Grava cada bloco não vazio como uma parte"""
+        partes = []
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            partes.append(self._write_part(diretorio, primeiro + len(partes), chunk))
+            logger.info(f"Snapshot {self.path}: parte {primeiro + len(partes) - 1} ({len(chunk)} linhas)")
+        return partes
+
+    @staticmethod
+    def _watermark(partes: List[Dict]) -> Optional[str]:
+        marcas = [p['watermark'] for p in partes if p['watermark'] is not None]
+        return max(marcas, key=pd.Timestamp) if marcas else None
+
+    def rebuild(self, chunks: Iterable[pd.DataFrame]) -> Dict:
+        """
+        Grava uma nova versão completa a partir dos blocos e a torna atual
+
+        Args:
+            chunks: Blocos de linhas (ex.: iter_query)
+
+        Returns:
+            Manifesto da nova versão
+        """
+        with self._write_lock:
+            anterior = self.manifest
+            versao = datetime.now().strftime('%Y%m%d%H%M%S%f')
+            diretorio = os.path.join(self.path, versao)
+            os.makedirs(diretorio, exist_ok=True)
+
+            try:
+                partes = self._write_parts(diretorio, 0, chunks)
+            except Exception:
+                shutil.rmtree(diretorio, ignore_errors=True)
+                raise
+
+            agora = datetime.now().isoformat()
+            manifest = {
+                'versao': versao,
+                'schema': self.schema,
+                'partes': partes,
+                'n_linhas': sum(p['n_linhas'] for p in partes),
+                'watermark': self._watermark(partes),
+                'criado_em': agora,
+                'atualizado_em': agora,
+            }
+            self._write_manifest(manifest)
+
+            # Versão anterior só é removida depois da troca do manifesto
+            if anterior is not None and anterior['versao'] != versao:
+                shutil.rmtree(os.path.join(self.path, anterior['versao']), ignore_errors=True)
+
+            return manifest
+
+    def append(self, chunks: Iterable[pd.DataFrame]) -> Dict:
+        """
+        Acrescenta blocos como novas partes da versão atual
+
+        Args:
+            chunks: Blocos de linhas novas (após o watermark)
+
+        Returns:
+            Manifesto atualizado
+
+        Raises:
+            ValueError: Se ainda não houver snapshot
+        """
+        with self._write_lock:
+            manifest = self.manifest
+            if manifest is None:
+                raise ValueError("Snapshot inexistente; execute uma reconstrução completa")
+
+            diretorio = os.path.join(self.path, manifest['versao'])
+            novas = self._write_parts(diretorio, len(manifest['partes']), chunks)
+            if not novas:
+                return manifest
+
+            manifest['partes'] = manifest['partes'] + novas
+            manifest['n_linhas'] += sum(p['n_linhas'] for p in novas)
+            manifest['watermark'] = self._watermark(manifest['partes'])
+            manifest['atualizado_em'] = datetime.now().isoformat()
+            self._write_manifest(manifest)
+            return manifest
+
+    def read(self, colunas: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Lê o snapshot atual (todas as partes, na ordem de gravação)
+
+        Args:
+            colunas: Colunas a carregar (padrão: todas do esquema)
+
+        Returns:
+            DataFrame (vazio se não houver snapshot)
+        """
+        manifest = self.manifest
+        colunas = colunas or list(self.schema)
+        if manifest is None or not manifest['partes']:
+            return pd.DataFrame(columns=colunas)
+
+        diretorio = os.path.join(self.path, manifest['versao'])
+        blocos = {col: [] for col in colunas}
+        for parte in manifest['partes']:
+            with np.load(os.path.join(diretorio, parte['arquivo'])) as dados:
+                for col in colunas:
+                    valores = dados[col]
+                    if self.schema[col] == 'str':
+                        valores = np.where(dados[f'{col}__nulo'], None, valores.astype(object))
+                    blocos[col].append(valores)
+
+        return pd.DataFrame({col: np.concatenate(valores) for col, valores in blocos.items()})